@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Benchmark comparing lookup throughput of the synchronous record API against the async
+(executor + future based) one, with many concurrent clients querying a synthetic phonebook.
+
+    python bench/bench_async.py --records 100000 --clients 64 --queries 20
+"""
+
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.api.async_record_handler import AsyncDatabaseRecordReader
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+
+NAMES = ["Jack", "Susan", "Mary", "Trevor", "Jacob", "Kevin", "Mike", "Paul", "John", "Tim"]
+
+
+def populate(record_count):
+    random.seed(1)
+    DatabaseRecordWriter.create_records_database()
+    DatabaseRecordWriter.add_records(DatabaseRecord("{} {}".format(random.choice(NAMES), index),
+                                                    random.randrange(2000000000, 9999999999),
+                                                    "{} Benchmark Street".format(index))
+                                     for index in range(record_count))
+
+
+def client_queries(clients, queries, hot_queries):
+    # skewed lookups: most clients ask for one of a few hot phone prefixes
+    random.seed(2)
+    return [[DatabaseRecord(phone=str(random.randrange(200, 200 + hot_queries))) for _ in range(queries)]
+            for _ in range(clients)]
+
+
+def run_sync(workload):
+    def client(client_queries):
+        for query in client_queries:
+            DatabaseRecordReader.get_records(query)
+        DatabaseRecordReader.release_connection()
+
+    threads = [threading.Thread(target=client, args=(queries,)) for queries in workload]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def run_async(workload):
+    start = time.time()
+    futures = [AsyncDatabaseRecordReader.get_records(query) for queries in workload for query in queries]
+    for future in futures:
+        future.result()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=100000, help="Number of synthetic records.")
+    parser.add_argument("--clients", type=int, default=64, help="Number of concurrent clients.")
+    parser.add_argument("--queries", type=int, default=20, help="Queries per client.")
+    parser.add_argument("--hot", type=int, default=10, help="Number of distinct phone prefixes queried.")
+    args = parser.parse_args()
+
+    handle, database_path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    DatabaseRecordWriter.database_path = DatabaseRecordReader.database_path = database_path
+    try:
+        populate(args.records)
+        workload = client_queries(args.clients, args.queries, args.hot)
+        total = args.clients * args.queries
+        for name, run in [("sync", run_sync), ("async", run_async)]:
+            elapsed = run(workload)
+            sys.stdout.write("{:<6} {:>8} queries in {:.3f}s  {:>10.1f} queries/s\n"
+                             .format(name, total, elapsed, total / elapsed))
+        AsyncDatabaseRecordReader.shutdown()
+    finally:
+        for path in [database_path + suffix for suffix in ["", "-wal", "-shm"]]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
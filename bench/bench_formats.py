@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+File size, write time and read time of every supported serial format (SerialFormats.ALL_FORMATS) on seeded
+synthetic records. Columnar formats are only measured when pyarrow is installed, zstd compressed ones when
+zstandard is. Sizes are compared against the JSON export.
+
+    python bench/bench_formats.py --count 200000
+"""
+
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import generate_records
+from lib.api.serialize import SerialFormats
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = default_timer()
+        function()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def read_all(reader, path):
+    for _ in reader.read(path):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000, help="Number of synthetic records.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per format, the best one is reported.")
+    parser.add_argument("--formats", nargs="*", help="Extensions of the formats to measure, all of them by default.")
+    args = parser.parse_args()
+
+    records = list(generate_records(args.count))
+    # json first, the other sizes are compared against it
+    formats = sorted([_format for _format in SerialFormats.ALL_FORMATS
+                      if not args.formats or _format['extension'] in args.formats],
+                     key=lambda _format: _format['extension'] != 'json')
+    output_dir = tempfile.mkdtemp()
+    # the writers log every export they write, the results are written straight to the real stdout
+    output, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    output.write("{} records\n\n{:<12} {:>10} {:>9} {:>8} {:>14} {:>14}\n"
+                 .format(args.count, "format", "size MiB", "B/record", "vs json", "write rec/s", "read rec/s"))
+    try:
+        json_size = None
+        for _format in formats:
+            path = os.path.join(output_dir, "records.{}".format(_format['extension']))
+            write_seconds = best_of(args.repeat, lambda: _format['writer'].write(iter(records), path))
+            read_seconds = best_of(args.repeat, lambda: read_all(_format['reader'], path)) \
+                if _format['reader'] else None
+            size = os.path.getsize(path)
+            os.remove(path)
+            if _format['extension'] == 'json':
+                json_size = size
+            output.write("{:<12} {:>10.2f} {:>9.1f} {:>8} {:>14.0f} {:>14}\n"
+                         .format(_format['extension'], size / 2.0 ** 20, float(size) / args.count,
+                                 "{:.2f}x".format(float(json_size) / size) if json_size else "-",
+                                 args.count / write_seconds,
+                                 "{:.0f}".format(args.count / read_seconds) if read_seconds else "-"))
+            output.flush()
+    finally:
+        sys.stdout.close()
+        sys.stdout = output
+        shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    main()
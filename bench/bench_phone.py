@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the phone number normalization/formatting functions in lib.utils, against the original
+per-row implementations they replaced, on seeded synthetic phone numbers.
+
+    python bench/bench_phone.py --count 100000 --repeat 5
+"""
+
+
+import os
+import sys
+import argparse
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import phone_for
+from lib import utils
+
+
+def legacy_phone_number_to_integer_stream(phone_number):
+    phone_number = str(phone_number)
+    number = phone_number.replace('(', "").replace(')', "").replace('-', "").replace(" ", "")
+    return int("".join(number.split(" ")))
+
+
+def legacy_integer_stream_to_phone_number(phone_number):
+    phone_number = str(phone_number)
+    if len(phone_number) != 10:
+        raise ValueError("\nInvalid phone number provided. Please use a 10 digit integer stream.")
+    area_code = phone_number[:3]
+    middle = phone_number[3:6]
+    tail = phone_number[-4:]
+    return "({area}) {middle}-{tail}".format(area=area_code, middle=middle, tail=tail)
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = default_timer()
+        function()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000, help="Number of phone numbers per run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per function, the best one is reported.")
+    args = parser.parse_args()
+
+    phones = [phone_for(index) for index in range(args.count)]
+    formatted = [utils.integer_stream_to_phone_number(phone) for phone in phones]
+    cases = [
+        ("format  legacy per row", lambda: [legacy_integer_stream_to_phone_number(phone) for phone in phones]),
+        ("format  per row", lambda: [utils.integer_stream_to_phone_number(phone) for phone in phones]),
+        ("format  batch", lambda: utils.integer_streams_to_phone_numbers(phones, use_numpy=False)),
+        ("parse   legacy per row", lambda: [legacy_phone_number_to_integer_stream(phone) for phone in formatted]),
+        ("parse   per row", lambda: [utils.phone_number_to_integer_stream(phone) for phone in formatted]),
+        ("parse   batch", lambda: utils.phone_numbers_to_integer_streams(formatted)),
+    ]
+    numpy = utils.load_numpy()
+    if numpy is not None:
+        array = numpy.asarray(phones, dtype=numpy.int64)
+        cases.insert(3, ("format  batch numpy", lambda: utils.integer_streams_to_phone_numbers(array, use_numpy=True)))
+
+    baseline = {}
+    for name, function in cases:
+        elapsed = best_of(args.repeat, function)
+        kind = name.split()[0]
+        baseline.setdefault(kind, elapsed)
+        sys.stdout.write("{:<26} {:>8.1f} ms  {:>12.0f} numbers/s  {:>5.2f}x\n"
+                         .format(name, elapsed * 1000.0, args.count / elapsed, baseline[kind] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Load generator for the HTTP record service (lib.api.server). Concurrent clients each keep one connection alive and
+send a mix of exact phone lookups and record additions for a fixed duration, then the throughput and latency
+percentiles are reported. Without --url, a server is started in its own process on a temporary database seeded
+with synthetic records, so the clients and the server don't compete for the same interpreter.
+
+    python bench/bench_server.py --records 100000 --clients 32 --duration 10
+    python bench/bench_server.py --url 127.0.0.1:8080 --clients 16 --write-ratio 0
+    python bench/bench_server.py --close
+
+With --close, every request opens a new connection, to compare against keep-alive.
+"""
+
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from timeit import default_timer
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import generate_records, phone_for
+
+
+def serve(database_path, port, workers):
+    from lib.api.conf import AppConfig
+    from lib.api.auth import WriteAuthRules
+    from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader
+    from lib.api.server import serve as serve_records
+    DatabaseRecordWriter.database_path = DatabaseRecordReader.database_path = database_path
+    AppConfig.write_auth_rule = WriteAuthRules.WRITE_ALL_NO_RULE
+    serve_records('127.0.0.1', port, workers)
+
+
+def populate(database_path, record_count):
+    from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+    DatabaseRecordWriter.database_path = DatabaseRecordReader.database_path = database_path
+    DatabaseRecordWriter.create_records_database()
+    DatabaseRecordWriter.add_records((DatabaseRecord(*record) for record in generate_records(record_count)),
+                                     batch_size=10000)
+    DatabaseRecordWriter.release_connection()
+
+
+def start_server(database_path, workers):
+    """
+    Start a server process on a free port
+    :return: server process and its host:port
+    :rtype: tuple
+    """
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", database_path,
+                                    "--port", str(port), "--workers", str(workers)], stdout=devnull, cwd=ROOT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process, "127.0.0.1:{}".format(port)
+        except socket.error:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start within 30 seconds.")
+
+
+def client(address, deadline, record_count, write_ratio, close, seed, latencies, errors):
+    rng = random.Random(seed)
+    connection = None
+    added = 0
+    while default_timer() < deadline:
+        if rng.random() < write_ratio:
+            added += 1
+            method, path = "POST", "/records"
+            body = json.dumps({"name": "Load {} {}".format(seed, added), "phone": 1000000000 + seed * 1000000 + added,
+                               "address": "{} Load Street".format(added)})
+        else:
+            method, path, body = "GET", "/records?match=exact&phone={}".format(
+                phone_for(rng.randrange(record_count))), None
+        start = default_timer()
+        try:
+            if connection is None:
+                connection = HTTPConnection(address, timeout=30)
+                connection.connect()
+                connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection.request(method, path, body, {"Connection": "close"} if close else {})
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+        except (socket.error, IOError) as error:
+            errors.append(repr(error))
+            connection.close()
+            connection = None
+            continue
+        latencies.append(default_timer() - start)
+        if close:
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_load(address, clients, duration, record_count, write_ratio, close):
+    """
+    Run every client for duration seconds
+    :return: sorted request latencies in seconds, errors, and elapsed wall time
+    :rtype: tuple
+    """
+    latencies, errors = [], []
+    deadline = default_timer() + duration
+    threads = [threading.Thread(target=client, args=(address, deadline, record_count, write_ratio, close, index,
+                                                     latencies, errors))
+               for index in range(clients)]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors, default_timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="host:port of a running server, one is started on a temporary db otherwise.")
+    parser.add_argument("--records", type=int, default=100000, help="Number of synthetic records in the temporary "
+                                                                    "db, also the range of phones looked up.")
+    parser.add_argument("--clients", type=int, default=16, help="Number of concurrent clients.")
+    parser.add_argument("--workers", type=int, default=16, help="Worker threads of the started server.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds the load is applied for.")
+    parser.add_argument("--write-ratio", type=float, default=0.05, help="Fraction of requests adding a record.")
+    parser.add_argument("--close", action="store_true", help="Open a new connection for every request.")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port, args.workers)
+
+    process, database_path = None, None
+    address = args.url
+    try:
+        if address is None:
+            handle, database_path = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
+            populate(database_path, args.records)
+            process, address = start_server(database_path, args.workers)
+        latencies, errors, elapsed = run_load(address, args.clients, args.duration, args.records, args.write_ratio,
+                                              args.close)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if database_path is not None:
+            for path in [database_path + suffix for suffix in ["", "-wal", "-shm"]]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    if not latencies:
+        sys.stdout.write("No request succeeded, {} errors: {}\n".format(len(errors), errors[:5]))
+        return 1
+    sys.stdout.write("{} requests in {:.2f}s from {} clients ({})\n"
+                     .format(len(latencies), elapsed, args.clients, "new connection per request" if args.close
+                             else "keep-alive"))
+    sys.stdout.write("{:>10.1f} requests/s\n".format(len(latencies) / elapsed))
+    for name, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]:
+        sys.stdout.write("{:>10.2f} ms {}\n".format(percentile(latencies, fraction) * 1000.0, name))
+    sys.stdout.write("{:>10.2f} ms max\n{:>10} errors\n".format(latencies[-1] * 1000.0, len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
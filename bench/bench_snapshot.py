@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Memory and lookup time of the columnar RecordSnapshot against keeping the same records in memory as a list of
+tuples or of DatabaseRecord objects, on seeded synthetic records. Memory is the deep size of each representation,
+reported per million records.
+
+    python bench/bench_snapshot.py --count 1000000
+"""
+
+
+import os
+import sys
+import argparse
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import generate_records
+from lib.api.record_handler import DatabaseRecord, RecordMatch
+from lib.api.snapshot import RecordSnapshot
+
+
+class LegacyRecord(object):
+    """
+    DatabaseRecord as it was before it had __slots__
+    """
+    def __init__(self, name=None, phone=None, address=None):
+        self.name = name
+        self.phone = phone
+        self.address = address
+
+
+def deep_size(records, fields):
+    """
+    Size of a list of records, counting every record and every field value it holds
+    """
+    return sys.getsizeof(records) + sum(sys.getsizeof(record) + sum(sys.getsizeof(value) for value in fields(record))
+                                        for record in records)
+
+
+def scan(records, name):
+    return [record for record in records if name in record[0]]
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = default_timer()
+        function()
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000000, help="Number of synthetic records.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per lookup, the best one is reported.")
+    args = parser.parse_args()
+    per_million = 1000000.0 / args.count
+
+    tuples = list(generate_records(args.count))
+    records = [DatabaseRecord(*row) for row in tuples]
+    legacy_records = [LegacyRecord(*row) for row in tuples]
+    start = default_timer()
+    snapshot = RecordSnapshot.from_records(tuples)
+    build_seconds = default_timer() - start
+
+    sizes = [("tuples", deep_size(tuples, lambda record: record)),
+             ("DatabaseRecord (__dict__)", deep_size(legacy_records, lambda record: (
+                 record.__dict__, record.name, record.phone, record.address))),
+             ("DatabaseRecord (__slots__)", deep_size(records, lambda record: (record.name, record.phone,
+                                                                               record.address))),
+             ("RecordSnapshot", snapshot.memory_usage())]
+    sys.stdout.write("{} records, snapshot built in {:.2f} s\n\n".format(args.count, build_seconds))
+    for name, size in sizes:
+        sys.stdout.write("{:<28} {:>10.1f} MiB per million records  {:>5.2f}x\n"
+                         .format(name, size * per_million / 2 ** 20, float(sizes[0][1]) / size))
+
+    target = tuples[args.count // 2]
+    lookups = [("name substring", lambda: scan(tuples, target[0][2:]),
+                lambda: snapshot.get_records(DatabaseRecord(target[0][2:]))),
+               ("phone exact", lambda: [record for record in tuples if record[1] == target[1]],
+                lambda: snapshot.get_records(DatabaseRecord(phone=target[1]), RecordMatch.EXACT)),
+               ("phone prefix", lambda: [record for record in tuples if str(record[1]).startswith("647")],
+                lambda: snapshot.get_records(DatabaseRecord(phone="647"), RecordMatch.PREFIX))]
+    sys.stdout.write("\n")
+    for name, tuple_lookup, snapshot_lookup in lookups:
+        tuple_seconds = best_of(args.repeat, tuple_lookup)
+        snapshot_seconds = best_of(args.repeat, snapshot_lookup)
+        sys.stdout.write("{:<16} tuple scan {:>9.1f} ms  snapshot {:>9.1f} ms  {:>6.2f}x\n"
+                         .format(name, tuple_seconds * 1000.0, snapshot_seconds * 1000.0,
+                                 tuple_seconds / snapshot_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Startup time of bin/phonebook_cli. Each command is run as a fresh process, as our users run it, and the best wall
+time of each is reported. Commands which never touch the db (help, changing the serial format to the current one)
+should only pay for the interpreter and our own modules, so the benchmark also checks that none of the modules we
+import lazily (yaml, csv, configparser, multiprocessing, numpy, difflib) get loaded by importing the CLI's modules.
+On interpreters supporting `-X importtime` (python 3.7+), the slowest imports of each command are listed too.
+The commands run against a temporary copy of the CLI, config/ and data/, so they never change the real config.ini
+or database.
+
+    python bench/bench_startup.py --repeat 10
+    python bench/bench_startup.py --max-ms 150
+
+With --max-ms, exits with status 1 when any command takes longer, or when a lazy module is imported at startup,
+so it can gate CI runs.
+"""
+
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# {serial_format} is the format configured in config.ini, so changing to it leaves the config as it is
+COMMANDS = [("help", ["-h"]),
+            ("config only", ["-s", "{serial_format}"]),
+            ("phone lookup", ["-q", "-p", "6470000000", "-m", "exact"])]
+# copied to the sandbox the commands run in, see sandbox
+SANDBOX_DIRS = ['bin', 'lib', 'config', 'data']
+# modules only loaded by the code paths using them, see lib.api.serialize, lib.api.conf and lib.utils
+LAZY_MODULES = ['yaml', 'csv', 'configparser', 'multiprocessing', 'numpy', 'difflib']
+CLI_MODULES = ['lib.api.auth', 'lib.api.conf', 'lib.api.export', 'lib.api.delta', 'lib.api.record_handler',
+               'lib.api.instrument', 'lib.utils']
+
+
+def environment(root=ROOT):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    return env
+
+
+def sandbox():
+    """
+    Copy the CLI, its modules, config and data to a temporary directory, with config.ini pointing at the copied
+    data directory
+    :return: path of the copy, and the serial format configured in it
+    :rtype: tuple
+    """
+    import configparser
+    root = tempfile.mkdtemp()
+    for directory in SANDBOX_DIRS:
+        shutil.copytree(os.path.join(ROOT, directory), os.path.join(root, directory),
+                        ignore=shutil.ignore_patterns('*.pyc', '__pycache__'))
+    config_path = os.path.join(root, 'config', 'config.ini')
+    parser = configparser.ConfigParser()
+    parser.read(config_path)
+    parser['DEFAULT']['data_dir'] = os.path.join(root, 'data')
+    with open(config_path, 'w') as config_file:
+        parser.write(config_file)
+    return root, parser['DEFAULT'].get('serial_format', 'json')
+
+
+def run(root, arguments, flags=()):
+    """
+    Run the CLI once in a new interpreter
+    :param root: copy of the repo the CLI is run from, see sandbox
+    :type root: str
+    :return: wall time in seconds, and what it wrote to stderr
+    :rtype: tuple
+    """
+    with open(os.devnull, 'w') as devnull:
+        start = default_timer()
+        process = subprocess.Popen([sys.executable] + list(flags) + [os.path.join(root, 'bin', 'phonebook_cli')] +
+                                   arguments, stdout=devnull, stderr=subprocess.PIPE, env=environment(root), cwd=root)
+        _, errors = process.communicate()
+        return default_timer() - start, errors.decode('utf-8', 'replace')
+
+
+def eager_modules():
+    """
+    :return: lazy modules loaded anyway when the CLI's modules are imported
+    :rtype: list
+    """
+    script = "import sys\n{}\nsys.stdout.write(' '.join(module for module in {!r} if module in sys.modules))" \
+        .format("\n".join("import {}".format(module) for module in CLI_MODULES), LAZY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", script], env=environment(), cwd=ROOT)
+    return output.decode('utf-8').split()
+
+
+def slowest_imports(errors, count):
+    """
+    Parse `-X importtime` output into the modules with the largest cumulative import time
+    :return: (cumulative microseconds, module) pairs, slowest first
+    :rtype: list
+    """
+    imports = []
+    for line in errors.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command, the best one is reported.")
+    parser.add_argument("--top", type=int, default=8, help="Number of slowest imports listed per command.")
+    parser.add_argument("--max-ms", type=float, help="Fail when any command takes longer than this.")
+    args = parser.parse_args()
+    importtime = sys.version_info >= (3, 7)
+
+    failed = False
+    eager = eager_modules()
+    sys.stdout.write("lazy modules imported at startup: {}\n\n".format(", ".join(eager) or "none"))
+    if eager:
+        failed = True
+    root, serial_format = sandbox()
+    try:
+        for name, arguments in COMMANDS:
+            arguments = [argument.format(serial_format=serial_format) for argument in arguments]
+            best = min(run(root, arguments)[0] for _ in range(args.repeat))
+            too_slow = args.max_ms is not None and best * 1000.0 > args.max_ms
+            failed = failed or too_slow
+            sys.stdout.write("{:<14} {:>8.1f} ms{}\n".format(name, best * 1000.0, "  SLOWER THAN --max-ms" if too_slow
+                                                             else ""))
+            if importtime:
+                for cumulative, module in slowest_imports(run(root, arguments, ["-X", "importtime"])[1], args.top):
+                    sys.stdout.write("    {:>8.1f} ms  {}\n".format(cumulative / 1000.0, module))
+    finally:
+        shutil.rmtree(root)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
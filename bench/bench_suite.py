@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""
+Benchmark suite covering ingest, auth rule checks, queries, updates, deletes and exports on seeded synthetic
+phonebooks of increasing size. For each size a fresh database is bulk loaded, then every benchmark runs a fixed
+number of operations against it, recording throughput, latency percentiles and the peak RSS of the process.
+Results are written to a JSON file, which a later run can use as a baseline to flag regressions.
+
+    python bench/bench_suite.py --sizes 1000,100000,1000000 --output results.json
+    python bench/bench_suite.py --sizes 1000,100000 --compare results.json --threshold 0.25
+
+Compare mode exits with status 1 when any benchmark's throughput dropped, or its p99 latency grew, by more than
+the threshold, so it can gate CI runs.
+"""
+
+
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import sqlite3
+import tempfile
+import time
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import generate_records, phone_for
+from lib.api.auth import WriteAuthRules, WriteAuthRuleHandler
+from lib.api.conf import AppConfig
+from lib.api.connection import ConnectionManager
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch
+from lib.api.serialize import SerialFormats
+
+RESULTS_VERSION = 1
+# number of disjoint target sets drawn from the loaded records (one per mutating benchmark)
+TARGET_SETS = 6
+
+
+def peak_rss_kb():
+    """
+    Peak resident set size of this process so far, in KiB. None where the resource module is missing (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KiB, macOS reports bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))]
+
+
+def summarize(samples, operations, seconds):
+    """
+    Turn per-operation timings into the result entry of a benchmark
+    :param samples: seconds taken by each timed call
+    :type samples: list
+    :param operations: number of operations (records) the timed calls processed
+    :type operations: int
+    :param seconds: total seconds taken
+    :type seconds: float
+    :return: result entry
+    :rtype: dict
+    """
+    samples = sorted(samples)
+    latency = None
+    if len(samples) > 1:
+        latency = dict((name, percentile(samples, fraction) * 1000.0)
+                       for name, fraction in [('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('max', 1.0)])
+    return {'operations': operations,
+            'seconds': seconds,
+            'throughput': operations / seconds if seconds else None,
+            'latency_ms': latency,
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def timed(function, arguments):
+    """
+    Call function once per argument tuple, timing each call
+    """
+    samples = []
+    start = default_timer()
+    for args in arguments:
+        call_start = default_timer()
+        function(*args)
+        samples.append(default_timer() - call_start)
+    return summarize(samples, len(samples), default_timer() - start)
+
+
+def timed_once(function, operations):
+    """
+    Time a single call processing many records (bulk loads, exports)
+    """
+    start = default_timer()
+    function()
+    return summarize([], operations, default_timer() - start)
+
+
+def run_size(size, operations, seed, only):
+    """
+    Run every benchmark on a fresh database of size synthetic records
+    :return: result entry of each benchmark, by name
+    :rtype: dict
+    """
+    results = {}
+
+    def record(name, run):
+        if only and not any(pattern in name for pattern in only):
+            return
+        results[name] = run()
+        sys.stderr.write("  {:<32} {}\n".format(name, format_result(results[name])))
+
+    operations = max(1, min(operations, size // TARGET_SETS))
+    rng = random.Random(seed)
+    targets, drawn = [], set()
+    while len(targets) < operations * TARGET_SETS:
+        target = rng.randrange(size)
+        if target not in drawn:
+            drawn.add(target)
+            targets.append(target)
+    target_sets = [[DatabaseRecord(*row) for row in targets_records(targets[index::TARGET_SETS], seed)]
+                   for index in range(TARGET_SETS)]
+    new_records = [DatabaseRecord(*row) for row in generate_records(operations, seed, start=size)]
+    spare_phones = [phone_for(size + operations + index, seed) for index in range(operations)]
+
+    results['ingest'] = timed_once(lambda: DatabaseRecordWriter.add_records(
+        DatabaseRecord(*row) for row in generate_records(size, seed)), size)
+    sys.stderr.write("  {:<32} {}\n".format('ingest', format_result(results['ingest'])))
+
+    record('add_record', lambda: timed(DatabaseRecordWriter.add_record, [(item,) for item in new_records]))
+
+    cursor = DatabaseRecordWriter.connection().cursor()
+    # half the checked records clash with a stored record, half are new
+    checked = [item for pair in zip(target_sets[0], new_records) for item in pair][:operations]
+    for rule in WriteAuthRules.ALL_RULES:
+        record('auth_check_rule_{}'.format(rule), lambda: timed(
+            WriteAuthRuleHandler.can_add_with_auth_rule,
+            [(DatabaseRecordWriter.records_table, cursor, rule, item) for item in checked]))
+    index = DatabaseRecordWriter.enable_uniqueness_index()
+    record('auth_check_rule_{}_index'.format(WriteAuthRules.WRITE_IF_PHONE_UNIQUE), lambda: timed(
+        WriteAuthRuleHandler.can_add_with_auth_rule,
+        [(DatabaseRecordWriter.records_table, cursor, WriteAuthRules.WRITE_IF_PHONE_UNIQUE, item, index)
+         for item in checked]))
+    DatabaseRecordWriter.disable_uniqueness_index()
+    cursor.close()
+
+    record('get_records_name_substring', lambda: timed(
+        DatabaseRecordReader.get_records, [(DatabaseRecord(item.name.split()[-1][1:]),) for item in target_sets[0]]))
+    record('get_records_phone_substring', lambda: timed(
+        DatabaseRecordReader.get_records, [(DatabaseRecord(phone=str(item.phone)[3:8]),) for item in target_sets[0]]))
+    record('get_records_phone_exact', lambda: timed(
+        DatabaseRecordReader.get_records, [(DatabaseRecord(phone=item.phone),) for item in target_sets[0]]))
+
+    record('update_record_names', lambda: timed(
+        DatabaseRecordWriter.update_record_names,
+        [(DatabaseRecord(item.name), DatabaseRecord(item.name + u" Jr")) for item in target_sets[1]]))
+    record('update_record_phones', lambda: timed(
+        DatabaseRecordWriter.update_record_phones,
+        [(DatabaseRecord(phone=item.phone), DatabaseRecord(phone=phone))
+         for item, phone in zip(target_sets[2], spare_phones)]))
+    record('update_record_address', lambda: timed(
+        DatabaseRecordWriter.update_record_address,
+        [(DatabaseRecord(address=item.address), DatabaseRecord(address=item.address + u" Unit 1"))
+         for item in target_sets[3]]))
+    record('update_records_by_all_fields', lambda: timed(
+        DatabaseRecordWriter.update_records_by_all_fields,
+        [(DatabaseRecord(phone=item.phone), DatabaseRecord(item.name, item.phone, item.address + u" Unit 2"),
+          RecordMatch.EXACT) for item in target_sets[4]]))
+    record('delete_record', lambda: timed(
+        DatabaseRecordWriter.delete_record,
+        [(DatabaseRecord(phone=item.phone), RecordMatch.EXACT) for item in target_sets[5]]))
+
+    export_dir = tempfile.mkdtemp()
+    try:
+        record_count = DatabaseRecordWriter.connection().execute(
+            "SELECT count(*) FROM {}".format(DatabaseRecordWriter.records_table)).fetchone()[0]
+        for serial_format in SerialFormats.ALL_FORMATS:
+            output_path = os.path.join(export_dir, "records.{}".format(serial_format['extension']))
+            record('export_{}'.format(serial_format['extension']), lambda: timed_once(
+                lambda: serial_format['writer'].write(DatabaseRecordReader.iter_all_records(), output_path),
+                record_count))
+    finally:
+        for name in os.listdir(export_dir):
+            os.remove(os.path.join(export_dir, name))
+        os.rmdir(export_dir)
+    return results
+
+
+def targets_records(indexes, seed):
+    """
+    Regenerate the records stored at the given dataset indexes, without keeping the whole dataset around
+    """
+    wanted = set(indexes)
+    found = dict((index, row) for index, row in enumerate(generate_records(max(indexes) + 1, seed))
+                 if index in wanted)
+    return [found[index] for index in indexes]
+
+
+def format_result(result):
+    latency = result['latency_ms']
+    return "{:>12.1f} ops/s{}".format(result['throughput'] or 0.0,
+                                      "  p50 {p50:.3f}ms  p99 {p99:.3f}ms".format(**latency) if latency else "")
+
+
+def run_suite(sizes, operations, seed, only, keep_cache):
+    """
+    Run the benchmarks for each dataset size, each on its own temporary database
+    :return: results document
+    :rtype: dict
+    """
+    document = {'version': RESULTS_VERSION,
+                'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'python': platform.python_version(),
+                         'sqlite': sqlite3.sqlite_version,
+                         'platform': platform.platform(),
+                         'seed': seed,
+                         'operations': operations},
+                'results': {}}
+    prev_path = DatabaseRecordWriter.database_path
+    prev_cache_size = AppConfig.query_cache_size
+    if not keep_cache:
+        # measure the database, not the query result cache
+        AppConfig.query_cache_size = 0
+    try:
+        for size in sizes:
+            sys.stderr.write("{} records\n".format(size))
+            handle, database_path = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
+            DatabaseRecordWriter.database_path = DatabaseRecordReader.database_path = database_path
+            try:
+                DatabaseRecordWriter.create_records_database()
+                document['results'][str(size)] = run_size(size, operations, seed, only)
+            finally:
+                ConnectionManager.for_path(database_path).close_all()
+                for path in [database_path + suffix for suffix in ["", "-wal", "-shm"]]:
+                    if os.path.exists(path):
+                        os.remove(path)
+    finally:
+        DatabaseRecordWriter.database_path = DatabaseRecordReader.database_path = prev_path
+        AppConfig.query_cache_size = prev_cache_size
+    return document
+
+
+def compare(document, baseline, threshold, min_latency_ms=0.1):
+    """
+    Compare results against a baseline run, for every size/benchmark present in both
+    :param document: results of this run
+    :type document: dict
+    :param baseline: results of the baseline run
+    :type baseline: dict
+    :param threshold: allowed relative slowdown, ie. 0.25 for 25%
+    :type threshold: float
+    :param min_latency_ms: p99 latencies below this are timer noise and never flagged
+    :type min_latency_ms: float
+    :return: regressions, as (size, benchmark, metric, baseline value, current value)
+    :rtype: list
+    """
+    regressions = []
+    for size, benchmarks in sorted(document['results'].items(), key=lambda item: int(item[0])):
+        for name, result in sorted(benchmarks.items()):
+            base = baseline.get('results', {}).get(size, {}).get(name)
+            if base is None:
+                continue
+            if base['throughput'] and result['throughput'] < base['throughput'] * (1 - threshold):
+                regressions.append((size, name, 'throughput', base['throughput'], result['throughput']))
+            if base['latency_ms'] and result['latency_ms'] and result['latency_ms']['p99'] >= min_latency_ms and \
+                    result['latency_ms']['p99'] > base['latency_ms']['p99'] * (1 + threshold):
+                regressions.append((size, name, 'p99_ms', base['latency_ms']['p99'], result['latency_ms']['p99']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Phonebook benchmark suite.")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="Comma separated dataset sizes, ie. 1000,100000,10000000.")
+    parser.add_argument("--operations", type=int, default=200,
+                        help="Operations timed per benchmark (capped by dataset size).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic datasets.")
+    parser.add_argument("--only", default="", help="Comma separated substrings of the benchmarks to run.")
+    parser.add_argument("--keep_cache", action="store_true", help="Leave the query result cache enabled.")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file the results are written to.")
+    parser.add_argument("--compare", help="Baseline results JSON file to check for regressions against.")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative slowdown flagged as a regression in compare mode.")
+    parser.add_argument("--min_latency_ms", type=float, default=0.1,
+                        help="p99 latencies below this are never flagged in compare mode.")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    only = [pattern for pattern in args.only.split(",") if pattern]
+    document = run_suite(sizes, args.operations, args.seed, only, args.keep_cache)
+    with open(args.output, 'w') as output_file:
+        json.dump(document, output_file, indent=2, sort_keys=True)
+    sys.stderr.write("Wrote results to {}\n".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(document, baseline, args.threshold, args.min_latency_ms)
+        for size, name, metric, base, current in regressions:
+            sys.stdout.write("REGRESSION {:>9} records  {:<32} {:<10} {:>12.3f} -> {:.3f}\n"
+                             .format(size, name, metric, base, current))
+        if regressions:
+            sys.exit(1)
+        sys.stdout.write("No regressions against {} (threshold {:.0%})\n".format(args.compare, args.threshold))
+
+
+if __name__ == '__main__':
+    main()
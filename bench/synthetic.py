@@ -0,0 +1,51 @@
+"""
+Seeded synthetic phonebook data for the benchmarks. The same seed and count always produce the same
+records, and records are generated lazily, so even 10M record datasets never have to sit in memory.
+"""
+
+
+import random
+
+FIRST_NAMES = ["Jack", "Susan", "Mary", "Trevor", "Jacob", "Kevin", "Mike", "Paul", "John", "Tim", "Anna", "Laura",
+               "Omar", "Priya", "Wei", "Carlos", "Fatima", "Noah", "Emma", "Liam", "Olivia", "Sofia", "Mateo", "Yuki"]
+LAST_NAMES = ["Smith", "Wilson", "Chase", "Kal", "Cook", "Nguyen", "Garcia", "Patel", "Kim", "Brown", "Lopez",
+              "Martin", "Lee", "Walker", "Young", "King", "Wright", "Scott", "Green", "Baker", "Adams", "Nelson"]
+STREETS = ["Testing Road", "Long St", "Main St", "Queen St", "King St", "Lake Shore Blvd", "Bay St", "Dundas St",
+           "College St", "Bloor St", "Yonge St", "Spadina Ave", "Church St", "Front St", "Wellington St"]
+
+FIRST_PHONE = 2000000000
+PHONE_RANGE = 8000000000
+# coprime with PHONE_RANGE, so index -> phone is a permutation and phones never repeat
+PHONE_STEP = 7919
+
+
+def phone_for(index, seed=0):
+    """
+    Unique, well spread 10 digit phone number of the index-th synthetic record
+    :param index: index of the record
+    :type index: int
+    :param seed: dataset seed
+    :type seed: int
+    :return: phone number
+    :rtype: int
+    """
+    return FIRST_PHONE + (index * PHONE_STEP + seed * 104729) % PHONE_RANGE
+
+
+def generate_records(count, seed=0, start=0):
+    """
+    Generate synthetic (name, phone, address) records
+    :param count: number of records
+    :type count: int
+    :param seed: seed of the dataset, equal seeds produce equal records
+    :type seed: int
+    :param start: index of the first record, to extend a dataset generated earlier
+    :type start: int
+    :return: generator of records
+    :rtype: generator
+    """
+    rng = random.Random("{}:{}".format(seed, start))
+    for index in range(start, start + count):
+        yield (u"{} {}".format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+               phone_for(index, seed),
+               u"{} {}".format(rng.randrange(1, 10000), rng.choice(STREETS)))
@@ -0,0 +1,403 @@
+"""
+Module used to run record operations without blocking the caller. Every method of the async reader/writer
+submits the SQLite work to a dedicated executor (a small pool of worker threads, each holding its own
+connection) and immediately returns a RecordFuture, which callers can wait on or attach callbacks to.
+Concurrent identical queries are coalesced, so a burst of callers asking for the same records only
+costs a single execution. Writes go through a single writer thread, as SQLite only allows one writer.
+"""
+
+
+import threading
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+from record_handler import DatabaseRecordReader, DatabaseRecordWriter, RecordMatch
+
+# marks the end of a record stream / tells executor workers to exit
+_END = object()
+
+
+class RecordFuture(object):
+    """
+    Result of a record operation submitted to a RecordExecutor
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._finished = False
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the operation to finish and return its result, raising its error if it failed
+        :param timeout: max number of seconds to wait, waits forever if not provided
+        :type timeout: float
+        :return: result of the operation
+        :rtype: object
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Record operation did not finish within {} seconds.".format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with this future once the operation finishes, right away if it already has
+        :param callback: function taking the future as its only argument
+        :type callback: function
+        :return: None
+        """
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        with self._lock:
+            self._result, self._error = result, error
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        # callbacks run before waiters wake up, so anything they clean up is done by the time result returns
+        for callback in callbacks:
+            callback(self)
+        self._done.set()
+
+
+class RecordExecutor(object):
+    """
+    Dedicated pool of worker threads running record operations. Workers are started lazily on the first
+    submit, and each one returns its database connection to the pool when the executor shuts down.
+    """
+    def __init__(self, workers, handler):
+        self.workers = workers
+        self.handler = handler
+        self._tasks = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) on one of the executor's workers
+        :param function: function we want to run
+        :type function: function
+        :return: future of the function's result
+        :rtype: RecordFuture
+        """
+        with self._lock:
+            if not self._threads:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        future = RecordFuture()
+        self._tasks.put((future, function, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once they've finished the operations already submitted
+        :param wait: whether we want to wait for the workers to exit
+        :type wait: bool
+        :return: None
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+            for _ in threads:
+                self._tasks.put(_END)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is _END:
+                    return
+                future, function, args, kwargs = task
+                try:
+                    future.set_result(function(*args, **kwargs))
+                except Exception as error:
+                    future.set_exception(error)
+        finally:
+            self.handler.release_connection()
+
+
+class StreamBuffer(object):
+    """
+    Bounded buffer between the executor worker producing a stream and the RecordStream consuming it. The worker
+    only holds the buffer, never the stream, so a stream dropped without being closed is still closed by its
+    __del__, which stops the worker.
+    """
+    # seconds a full buffer is waited on before checking whether the stream was closed
+    put_timeout = 0.1
+
+    def __init__(self, buffer_size):
+        self.queue = Queue(maxsize=buffer_size)
+        self.closed = threading.Event()
+
+    def put(self, item):
+        """
+        Put an item in the buffer, waiting for room until the stream is closed
+        :param item: record, error or _END
+        :type item: object
+        :return: False if the stream was closed, and the item dropped
+        :rtype: bool
+        """
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=self.put_timeout)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce(self, function, *args):
+        """
+        Executor worker entry point, buffers the records of function(*args) until they run out or the stream is
+        closed
+        """
+        records = None
+        try:
+            records = function(*args)
+            for record in records:
+                if not self.put(record):
+                    return
+        except Exception as error:
+            self.put(error)
+            return
+        finally:
+            # frees the cursor of records left unread
+            if hasattr(records, 'close'):
+                records.close()
+        self.put(_END)
+
+
+class RecordStream(object):
+    """
+    Iterator over records produced by an executor worker. The worker fetches ahead into a bounded buffer
+    while the caller consumes, so neither side ever holds the full result set. Close streams which aren't
+    read to the end (or use them as context managers), streams dropped without being closed are closed
+    when they're garbage collected.
+    """
+    def __init__(self, buffer_size):
+        self.buffer = StreamBuffer(buffer_size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.buffer.closed.is_set():
+            raise StopIteration
+        item = self.buffer.queue.get()
+        if item is _END:
+            self.buffer.queue.put(_END)
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.buffer.queue.put(_END)
+            raise item
+        return item
+
+    next = __next__
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker producing this stream early, if we don't need the remaining records
+        :return: None
+        """
+        self.buffer.closed.set()
+        while not self.buffer.queue.empty():
+            self.buffer.queue.get()
+
+
+class AsyncDatabaseRecordReader(object):
+    """
+    Class responsible for all non-blocking read operations in database. Reads run on a pool of reader
+    workers, which in WAL mode can all read at once, even while the writer commits.
+    """
+    reader          = DatabaseRecordReader
+    workers         = 4
+    buffer_size     = 1000
+    executor        = None
+    executor_lock   = threading.Lock()
+    in_flight       = {}
+    in_flight_lock  = threading.Lock()
+
+    @classmethod
+    def get_executor(cls):
+        with cls.executor_lock:
+            if cls.executor is None:
+                cls.executor = RecordExecutor(cls.workers, cls.reader)
+            return cls.executor
+
+    @classmethod
+    def shutdown(cls, wait=True):
+        with cls.executor_lock:
+            executor, cls.executor = cls.executor, None
+        if executor is not None:
+            executor.shutdown(wait)
+
+    @classmethod
+    def submit_coalesced(cls, key, function, *args):
+        """
+        Submit a read to the executor, unless an identical read is already running, in which case
+        the caller shares its future instead. Results of coalesced reads are shared between all
+        their callers, so they shouldn't be modified.
+        :param key: identity of the read, equal keys must produce equal results
+        :type key: tuple
+        :param function: read function we want to run
+        :type function: function
+        :return: future of the read's result
+        :rtype: RecordFuture
+        """
+        with cls.in_flight_lock:
+            future = cls.in_flight.get(key)
+            if future is not None:
+                return future
+            future = cls.get_executor().submit(function, *args)
+            cls.in_flight[key] = future
+
+        def forget(done_future):
+            with cls.in_flight_lock:
+                if cls.in_flight.get(key) is done_future:
+                    del cls.in_flight[key]
+
+        future.add_done_callback(forget)
+        return future
+
+    @classmethod
+    def get_all_records(cls):
+        """
+        Fetch all the records currently stored in the database
+        :return: future of all records
+        :rtype: RecordFuture
+        """
+        return cls.submit_coalesced(('get_all_records',), cls.reader.get_all_records)
+
+    @classmethod
+    def get_records(cls, db_record, match=RecordMatch.SUBSTRING):
+        """
+        Fetch all the records in database based on the query data we provide as a record
+        :param db_record: record to use as query data for db
+        :type db_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :return: future of the records matching query criteria
+        :rtype: RecordFuture
+        """
+        return cls.submit_coalesced(('get_records', db_record.name, db_record.phone, db_record.address, match),
+                                    cls.reader.get_records, db_record, match)
+
+    @classmethod
+    def search_records(cls, text, limit=20, fuzzy=False):
+        """
+        Full text search of all record fields, see DatabaseRecordReader.search_records
+        :return: future of the matching records, best match first
+        :rtype: RecordFuture
+        """
+        return cls.submit_coalesced(('search_records', text, limit, fuzzy), cls.reader.search_records,
+                                    text, limit, fuzzy)
+
+    @classmethod
+    def iter_all_records(cls):
+        """
+        Stream all the records currently stored in the database
+        :return: iterator of all records
+        :rtype: RecordStream
+        """
+        stream = RecordStream(cls.buffer_size)
+        cls.get_executor().submit(stream.buffer.produce, cls.reader.iter_all_records)
+        return stream
+
+    @classmethod
+    def iter_records(cls, db_record, match=RecordMatch.SUBSTRING):
+        """
+        Stream the records in database matching the query data we provide as a record
+        :param db_record: record to use as query data for db
+        :type db_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :return: iterator of records matching query criteria
+        :rtype: RecordStream
+        """
+        stream = RecordStream(cls.buffer_size)
+        cls.get_executor().submit(stream.buffer.produce, cls.reader.iter_records, db_record, match)
+        return stream
+
+
+class AsyncDatabaseRecordWriter(object):
+    """
+    Class responsible for all non-blocking write operations in database. Writes are run one at a time, in
+    submission order, by a single writer worker.
+    """
+    writer          = DatabaseRecordWriter
+    executor        = None
+    executor_lock   = threading.Lock()
+
+    @classmethod
+    def get_executor(cls):
+        with cls.executor_lock:
+            if cls.executor is None:
+                cls.executor = RecordExecutor(1, cls.writer)
+            return cls.executor
+
+    @classmethod
+    def shutdown(cls, wait=True):
+        with cls.executor_lock:
+            executor, cls.executor = cls.executor, None
+        if executor is not None:
+            executor.shutdown(wait)
+
+    @classmethod
+    def add_record(cls, db_record):
+        return cls.get_executor().submit(cls.writer.add_record, db_record)
+
+    @classmethod
+    def add_records(cls, db_records, batch_size=None, auth_rule=None):
+        return cls.get_executor().submit(cls.writer.add_records, db_records, batch_size, auth_rule)
+
+    @classmethod
+    def delete_record(cls, query_record, match=RecordMatch.SUBSTRING):
+        return cls.get_executor().submit(cls.writer.delete_record, query_record, match)
+
+    @classmethod
+    def update_record_names(cls, query_record, updated_record):
+        return cls.get_executor().submit(cls.writer.update_record_names, query_record, updated_record)
+
+    @classmethod
+    def update_record_phones(cls, query_record, updated_record):
+        return cls.get_executor().submit(cls.writer.update_record_phones, query_record, updated_record)
+
+    @classmethod
+    def update_record_address(cls, query_record, updated_record):
+        return cls.get_executor().submit(cls.writer.update_record_address, query_record, updated_record)
+
+    @classmethod
+    def update_records_by_all_fields(cls, query_record, updated_record, match=RecordMatch.SUBSTRING):
+        return cls.get_executor().submit(cls.writer.update_records_by_all_fields, query_record, updated_record,
+                                         match)
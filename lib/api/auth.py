@@ -6,6 +6,10 @@ component usage implementation level, rather than the writer interface level.
 """
 
 
+import threading
+from collections import Counter
+
+
 class WriteAuthRules(object):
     """
     Rules for determining whether or not we can write new database records based on the new record data.
@@ -18,6 +22,108 @@ class WriteAuthRules(object):
 
     ALL_RULES = [WRITE_ALL_NO_RULE, WRITE_IF_NAME_UNIQUE, WRITE_IF_PHONE_UNIQUE, WRITE_IF_ADDRESS_UNIQUE, WRITE_IF_ALL_UNIQUE]
 
+    # record fields which must be unique for each rule
+    RULE_FIELDS = {WRITE_ALL_NO_RULE:       (),
+                   WRITE_IF_NAME_UNIQUE:    ('name',),
+                   WRITE_IF_PHONE_UNIQUE:   ('phone',),
+                   WRITE_IF_ADDRESS_UNIQUE: ('address',),
+                   WRITE_IF_ALL_UNIQUE:     ('name', 'phone', 'address')}
+
+
+class UniquenessIndex(object):
+    """
+    In-process index of the values each write authority rule needs to be unique, so rules can be checked
+    in O(1) without querying the db. Values are reference counted, as rules can change and the table may
+    hold duplicates written under a looser rule. The index is loaded once and must then be told about every
+    write (DatabaseRecordWriter does this for the index it owns), so it assumes this process is the only
+    writer. In verify mode every check is also run through SQL and a mismatch raises an error.
+    """
+    def __init__(self, verify=False):
+        self.verify = verify
+        self._counts = dict((fields, Counter()) for fields in set(WriteAuthRules.RULE_FIELDS.values()) if fields)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, table, db_cursor, verify=False):
+        """
+        Build an index of all the records currently in a table
+        :param table: db table we want to index
+        :type table: str
+        :param db_cursor: db cursor we want to use
+        :type db_cursor: Cursor
+        :param verify: whether every check should also be verified against the db
+        :type verify: bool
+        :return: loaded index
+        :rtype: UniquenessIndex
+        """
+        index = cls(verify)
+        db_cursor.execute("SELECT name, phone, address FROM {}".format(table))
+        rows = db_cursor.fetchmany(1000)
+        while rows:
+            index.add_rows(rows)
+            rows = db_cursor.fetchmany(1000)
+        return index
+
+    @staticmethod
+    def normalize(fields, values):
+        # phones are compared as integers by the db, whether they come in as integers or digit strings
+        return tuple(int(value) if field == 'phone' and str(value).isdigit() else value
+                     for field, value in zip(fields, values))
+
+    def key(self, fields, db_record):
+        return self.normalize(fields, [getattr(db_record, field) for field in fields])
+
+    @classmethod
+    def row_key(cls, fields, row):
+        return cls.normalize(fields, [row[('name', 'phone', 'address').index(field)] for field in fields])
+
+    def is_unique(self, auth_rule, db_record, pending=None):
+        """
+        Check whether a record can be written under a rule, according to the index
+        :param auth_rule: authority rule we want to check against
+        :type auth_rule: int
+        :param db_record: record we want to write
+        :type db_record: DatabaseRecord
+        :param pending: keys of the rule's fields written (+1) or replaced (-1) in a transaction which the index
+                        hasn't been told about yet
+        :type pending: Counter
+        :return: whether or not we can write the record
+        :rtype: bool
+        """
+        fields = WriteAuthRules.RULE_FIELDS[auth_rule]
+        if not fields:
+            return True
+        key = self.key(fields, db_record)
+        if None in key:
+            # NULL never equals anything in SQL, so records missing a rule field are always unique
+            return True
+        with self._lock:
+            return self._counts[fields][key] + (pending[key] if pending else 0) <= 0
+
+    def add_rows(self, rows):
+        """
+        Register (name, phone, address) rows written to the db
+        """
+        with self._lock:
+            for row in rows:
+                for fields, counts in self._counts.items():
+                    counts[self.row_key(fields, row)] += 1
+
+    def remove_rows(self, rows):
+        """
+        Unregister (name, phone, address) rows deleted from the db, or replaced by an update
+        """
+        with self._lock:
+            for row in rows:
+                for fields, counts in self._counts.items():
+                    key = self.row_key(fields, row)
+                    counts[key] -= 1
+                    if counts[key] <= 0:
+                        del counts[key]
+
+    def add_records(self, db_records):
+        self.add_rows([(record.name, record.phone, record.address) for record in db_records])
+
 
 class WriteAuthRuleHandler(object):
     """
@@ -43,7 +149,7 @@ class WriteAuthRuleHandler(object):
         return True
 
     @classmethod
-    def can_add_with_auth_rule(cls, table, db_cursor, auth_rule, db_record):
+    def can_add_with_auth_rule(cls, table, db_cursor, auth_rule, db_record, uniqueness_index=None, pending=None):
         """
         Method used to map the different auth rules to select method above, based on criteria we pass in
         :param table: db table we want to check against
@@ -54,9 +160,20 @@ class WriteAuthRuleHandler(object):
         :type auth_rule: int
         :param db_record: record we want to use as query data
         :type db_record: DatabaseRecord
+        :param uniqueness_index: index of the table used to answer the rule instead of querying the db
+        :type uniqueness_index: UniquenessIndex
+        :param pending: writes of the current transaction the index doesn't know about yet, see
+                        UniquenessIndex.is_unique
+        :type pending: Counter
         :return: whether or not we can write the record based on query data passed in
         :rtype: bool
         """
+        if uniqueness_index is not None:
+            can_add = uniqueness_index.is_unique(auth_rule, db_record, pending)
+            if uniqueness_index.verify and can_add != cls.can_add_with_auth_rule(table, db_cursor, auth_rule, db_record):
+                raise RuntimeError("Uniqueness index out of sync with table {} for record: {}. Please reload the "
+                                   "index.".format(table, db_record))
+            return can_add
         if auth_rule == WriteAuthRules.WRITE_ALL_NO_RULE:
             return True
         elif auth_rule == WriteAuthRules.WRITE_IF_NAME_UNIQUE:
@@ -68,3 +185,78 @@ class WriteAuthRuleHandler(object):
         elif auth_rule == WriteAuthRules.WRITE_IF_ALL_UNIQUE:
             return cls.filter_by_string("SELECT * FROM {} WHERE name=? and phone=? and address=?".format(table), db_cursor,
                                         (db_record.name, db_record.phone, db_record.address))
+
+    @classmethod
+    def create_candidates_table(cls, db_cursor):
+        """
+        Create the temp table used by filter_records_with_auth_rule, if the connection doesn't have it yet. Only
+        issues the CREATE when needed, as the sqlite3 module commits any open transaction before DDL statements,
+        so callers running a transaction should call this before their first write.
+        :param db_cursor: cursor to the db
+        :type db_cursor: Cursor
+        :return: None
+        """
+        db_cursor.execute("SELECT 1 FROM sqlite_temp_master WHERE type = 'table' and name = 'auth_candidates'")
+        if not db_cursor.fetchone():
+            db_cursor.execute("CREATE TEMP TABLE auth_candidates(name, phone, address)")
+
+    @classmethod
+    def filter_records_with_auth_rule(cls, table, db_cursor, auth_rule, db_records, uniqueness_index=None,
+                                      pending=None):
+        """
+        Set-wise version of can_add_with_auth_rule used for bulk writes. All candidate records are loaded
+        into a temp table and checked against the db with a single join, instead of one SELECT per record.
+        Records which clash with another candidate earlier in the same set are rejected as well.
+        :param table: db table we want to check against
+        :type table: str
+        :param db_cursor: db cursor we want to use
+        :type db_cursor: Cursor
+        :param auth_rule: authority rule we want to check against
+        :type auth_rule: int
+        :param db_records: records we want to write
+        :type db_records: list
+        :param uniqueness_index: index of the table used to answer the rule instead of querying the db
+        :type uniqueness_index: UniquenessIndex
+        :param pending: writes of the current transaction the index doesn't know about yet, see
+                        UniquenessIndex.is_unique
+        :type pending: Counter
+        :return: records which can be written, and records which were rejected
+        :rtype: tuple
+        """
+        fields = WriteAuthRules.RULE_FIELDS[auth_rule]
+        if not fields:
+            return list(db_records), []
+        if uniqueness_index is not None:
+            accepted, rejected, taken = [], [], set()
+            for record in db_records:
+                key = uniqueness_index.key(fields, record)
+                if key in taken or not uniqueness_index.is_unique(auth_rule, record, pending):
+                    rejected.append(record)
+                else:
+                    taken.add(key)
+                    accepted.append(record)
+            if uniqueness_index.verify and \
+                    (accepted, rejected) != cls.filter_records_with_auth_rule(table, db_cursor, auth_rule, db_records):
+                raise RuntimeError("Uniqueness index out of sync with table {}. Please reload the index."
+                                   .format(table))
+            return accepted, rejected
+
+        cls.create_candidates_table(db_cursor)
+        db_cursor.execute("DELETE FROM auth_candidates")
+        db_cursor.executemany("INSERT INTO auth_candidates VALUES(?, ?, ?)",
+                              [(record.name, record.phone, record.address) for record in db_records])
+        db_cursor.execute("SELECT DISTINCT {columns} FROM auth_candidates AS c JOIN {table} AS r ON {join}"
+                          .format(columns=", ".join("c.{}".format(field) for field in fields), table=table,
+                                  join=" and ".join("c.{0} = r.{0}".format(field) for field in fields)))
+        taken = set(db_cursor.fetchall())
+        db_cursor.execute("DELETE FROM auth_candidates")
+
+        accepted, rejected = [], []
+        for record in db_records:
+            key = tuple(getattr(record, field) for field in fields)
+            if key in taken:
+                rejected.append(record)
+            else:
+                taken.add(key)
+                accepted.append(record)
+        return accepted, rejected
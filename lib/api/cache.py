@@ -0,0 +1,104 @@
+"""
+Module used to cache the results of record queries. Lookups are heavily skewed towards the same few name/phone
+fragments, so DatabaseRecordReader keeps the results of its recent queries in a bounded LRU cache, with an
+optional time to live. Every write done through DatabaseRecordWriter bumps the cache generation, which drops
+all cached results, and results read before a write can never be stored after it. Writes made by other
+processes aren't seen by the cache, the time to live bounds how stale results can get in that case.
+"""
+
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """
+    Thread safe LRU cache of query results, with hit/miss/eviction stats. Only writes made in this process
+    invalidate it, so it assumes a single process writes to the database (the CLI, the server or a script, not
+    several at once); otherwise cached results can be up to ttl seconds stale. The cache is off by default
+    (query_cache_size = 0 in config.ini).
+    """
+    def __init__(self, max_entries, ttl=0):
+        """
+        :param max_entries: max number of cached query results, least recently used results are evicted first
+        :type max_entries: int
+        :param ttl: number of seconds a result stays valid, results never expire if 0
+        :type ttl: float
+        """
+        if max_entries < 1:
+            raise ValueError("Invalid cache size provided. Please use a positive integer.")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Look up a cached query result
+        :param key: normalized query the result was cached under
+        :type key: tuple
+        :return: whether the result was found, and the result
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl and entry[0] < time.time():
+                entry = None
+                self.evictions += 1
+            if entry is None:
+                self.misses += 1
+                return False, None
+            # re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value, generation):
+        """
+        Cache a query result, unless the records were written to since the query started
+        :param key: normalized query the result belongs to
+        :type key: tuple
+        :param value: query result
+        :type value: object
+        :param generation: cache generation read before running the query
+        :type generation: int
+        :return: whether the result was cached
+        :rtype: bool
+        """
+        with self._lock:
+            if generation != self.generation:
+                return False
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self):
+        """
+        Drop every cached result, called whenever the records are written to
+        :return: None
+        """
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: cache size and hit/miss/eviction/invalidation counts
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.0}
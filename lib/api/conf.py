@@ -10,10 +10,10 @@ the AppConfig class down below.
 
 import os
 import sys
+from collections import OrderedDict
 from os.path import dirname as dir_up
 from auth import WriteAuthRules
 from serialize import SerialFormats, SerialWriter
-import configparser
 
 # keys for easy access/avoiding incorrect key names in this module as well as others
 DB_NAME = 'phonebook'
@@ -24,11 +24,31 @@ DATA_DIR = 'data'
 DATA_DIR_KEY = 'data_dir'
 SERIAL_FORMAT_KEY = 'serial_format'
 WRITE_AUTH_RULE_KEY = 'write_auth_rule'
+SYNCHRONOUS_KEY = 'synchronous'
+CACHE_SIZE_KEY = 'cache_size'
+MMAP_SIZE_KEY = 'mmap_size'
+POOL_SIZE_KEY = 'pool_size'
+QUERY_CACHE_SIZE_KEY = 'query_cache_size'
+QUERY_CACHE_TTL_KEY = 'query_cache_ttl'
+SHARD_COUNT_KEY = 'shard_count'
+SHARD_LAYOUT_KEY = 'shard_layout'
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
 SUPPORTED_SERIAL_FORMATS = SerialFormats.ALL_FORMATS
 APP_CONFIG_INI_PATH = os.path.join(dir_up(dir_up(dir_up(__file__))), CONFIG_DIR, 'config.ini')
-APP_CONFIG_DEFAULTS = {DATA_DIR_KEY: os.path.join(dir_up(dir_up(dir_up(__file__))), DATA_DIR),
-                       SERIAL_FORMAT_KEY: SerialFormats.JSON,
-                       WRITE_AUTH_RULE_KEY: WriteAuthRules.WRITE_IF_PHONE_UNIQUE}
+# ordered, so config.ini is always written with its settings in the same order
+APP_CONFIG_DEFAULTS = OrderedDict([(WRITE_AUTH_RULE_KEY, WriteAuthRules.WRITE_IF_PHONE_UNIQUE),
+                                   (DATA_DIR_KEY, os.path.join(dir_up(dir_up(dir_up(__file__))), DATA_DIR)),
+                                   (SERIAL_FORMAT_KEY, SerialFormats.JSON),
+                                   (SYNCHRONOUS_KEY, 'NORMAL'),
+                                   (CACHE_SIZE_KEY, -2000),
+                                   (MMAP_SIZE_KEY, 0),
+                                   (POOL_SIZE_KEY, 5),
+                                   (QUERY_CACHE_SIZE_KEY, 0),
+                                   (QUERY_CACHE_TTL_KEY, 2.0),
+                                   (SHARD_COUNT_KEY, 1),
+                                   (SHARD_LAYOUT_KEY, 'phonebook_{shard}_of_{count}')])
+# whether setup_app_config already configured the app in this process
+_config_loaded = False
 
 
 class AppConfig(object):
@@ -40,6 +60,14 @@ class AppConfig(object):
     data_directory          = APP_CONFIG_DEFAULTS[DATA_DIR_KEY]
     serial_format           = APP_CONFIG_DEFAULTS[SERIAL_FORMAT_KEY]
     write_auth_rule         = APP_CONFIG_DEFAULTS[WRITE_AUTH_RULE_KEY]
+    synchronous             = APP_CONFIG_DEFAULTS[SYNCHRONOUS_KEY]
+    cache_size              = APP_CONFIG_DEFAULTS[CACHE_SIZE_KEY]
+    mmap_size               = APP_CONFIG_DEFAULTS[MMAP_SIZE_KEY]
+    pool_size               = APP_CONFIG_DEFAULTS[POOL_SIZE_KEY]
+    query_cache_size        = APP_CONFIG_DEFAULTS[QUERY_CACHE_SIZE_KEY]
+    query_cache_ttl         = APP_CONFIG_DEFAULTS[QUERY_CACHE_TTL_KEY]
+    shard_count             = APP_CONFIG_DEFAULTS[SHARD_COUNT_KEY]
+    shard_layout            = APP_CONFIG_DEFAULTS[SHARD_LAYOUT_KEY]
 
     @classmethod
     def update_setting(cls, setting, value):
@@ -58,13 +86,15 @@ class AppConfig(object):
             sys.stderr.write(err.message)
 
     @classmethod
-    def change_serial_format(cls, serial_format, quiet=False):
+    def change_serial_format(cls, serial_format, quiet=False, save=True):
         """
         Change the serial output format to use when exporting database records to a serial file (ie. json, csv, etc.).
         :param serial_format: serial format we want to change to
         :type serial_format: SerialFormats
         :param quiet: whether we want to print the updated settings confirmation message
         :type quiet: bool
+        :param save: whether we want to write the change to config.ini
+        :type save: bool
         :return: None
         """
         if not issubclass(serial_format['writer'], SerialWriter):
@@ -80,10 +110,11 @@ class AppConfig(object):
                 cls._confirm_and_display()
 
         APP_CONFIG_DEFAULTS[SERIAL_FORMAT_KEY] = serial_format['extension']
-        write_config_ini(APP_CONFIG_DEFAULTS)
+        if save:
+            write_config_ini(APP_CONFIG_DEFAULTS)
 
     @classmethod
-    def change_data_directory(cls, data_directory, quiet=False):
+    def change_data_directory(cls, data_directory, quiet=False, save=True):
         """
         Change the data directory filepath where we want all of our
         record data to go (ie. db file, results in serial formats, etc.)
@@ -91,6 +122,8 @@ class AppConfig(object):
         :type data_directory: str
         :param quiet: whether we want to print the updated settings confirmation message
         :type quiet: bool
+        :param save: whether we want to write the change to config.ini
+        :type save: bool
         :return: None
         """
         if not os.path.exists(data_directory) or not os.path.isdir(data_directory):
@@ -102,16 +135,19 @@ class AppConfig(object):
                 cls._confirm_and_display()
 
         APP_CONFIG_DEFAULTS[DATA_DIR_KEY] = data_directory
-        write_config_ini(APP_CONFIG_DEFAULTS)
+        if save:
+            write_config_ini(APP_CONFIG_DEFAULTS)
 
     @classmethod
-    def change_write_auth_rule(cls, write_auth_rule, quiet=False):
+    def change_write_auth_rule(cls, write_auth_rule, quiet=False, save=True):
         """
         Change the record write authority rule used to determine data criteria for new records
         :param write_auth_rule: authority rule to change to
         :type write_auth_rule: WriteAuthRules
         :param quiet: whether we want to print the updated settings confirmation message
         :type quiet: bool
+        :param save: whether we want to write the change to config.ini
+        :type save: bool
         :return: None
         """
         if cls.update_setting('write_auth_rule', write_auth_rule):
@@ -119,7 +155,109 @@ class AppConfig(object):
                 cls._confirm_and_display()
 
         APP_CONFIG_DEFAULTS[WRITE_AUTH_RULE_KEY] = write_auth_rule
-        write_config_ini(APP_CONFIG_DEFAULTS)
+        if save:
+            write_config_ini(APP_CONFIG_DEFAULTS)
+
+    @classmethod
+    def change_database_settings(cls, synchronous=None, cache_size=None, mmap_size=None, pool_size=None, quiet=False,
+                                 save=True):
+        """
+        Change the settings used for new database connections (see lib.api.connection). Settings which
+        aren't provided are left unchanged.
+        :param synchronous: SQLite synchronous pragma, one of SYNCHRONOUS_MODES
+        :type synchronous: str
+        :param cache_size: SQLite cache_size pragma (pages, or KiB if negative)
+        :type cache_size: int
+        :param mmap_size: SQLite mmap_size pragma in bytes, 0 disables memory mapped I/O
+        :type mmap_size: int
+        :param pool_size: max number of open connections per database file
+        :type pool_size: int
+        :param quiet: whether we want to print the updated settings confirmation message
+        :type quiet: bool
+        :param save: whether we want to write the change to config.ini
+        :type save: bool
+        :return: None
+        """
+        if synchronous is not None and str(synchronous).upper() not in SYNCHRONOUS_MODES:
+            raise ValueError("Invalid synchronous mode provided. Supported modes: {}".format(SYNCHRONOUS_MODES))
+        if pool_size is not None and int(pool_size) < 1:
+            raise ValueError("Invalid pool size provided. Please use a positive integer.")
+        settings = {SYNCHRONOUS_KEY: str(synchronous).upper() if synchronous is not None else None,
+                    CACHE_SIZE_KEY: int(cache_size) if cache_size is not None else None,
+                    MMAP_SIZE_KEY: int(mmap_size) if mmap_size is not None else None,
+                    POOL_SIZE_KEY: int(pool_size) if pool_size is not None else None}
+        for setting, value in settings.items():
+            if value is not None:
+                cls.update_setting(setting, value)
+                APP_CONFIG_DEFAULTS[setting] = value
+        if not quiet:
+            cls._confirm_and_display()
+        if save:
+            write_config_ini(APP_CONFIG_DEFAULTS)
+
+    @classmethod
+    def change_query_cache_settings(cls, query_cache_size=None, query_cache_ttl=None, quiet=False, save=True):
+        """
+        Change the settings of the query result cache used by DatabaseRecordReader (see lib.api.cache).
+        Settings which aren't provided are left unchanged.
+        :param query_cache_size: max number of cached query results, 0 disables the cache
+        :type query_cache_size: int
+        :param query_cache_ttl: number of seconds a cached result stays valid, 0 keeps results until the next write
+        :type query_cache_ttl: float
+        :param quiet: whether we want to print the updated settings confirmation message
+        :type quiet: bool
+        :param save: whether we want to write the change to config.ini
+        :type save: bool
+        :return: None
+        """
+        if query_cache_size is not None and int(query_cache_size) < 0:
+            raise ValueError("Invalid query cache size provided. Please use 0 or a positive integer.")
+        if query_cache_ttl is not None and float(query_cache_ttl) < 0:
+            raise ValueError("Invalid query cache TTL provided. Please use 0 or a positive number of seconds.")
+        settings = {QUERY_CACHE_SIZE_KEY: int(query_cache_size) if query_cache_size is not None else None,
+                    QUERY_CACHE_TTL_KEY: float(query_cache_ttl) if query_cache_ttl is not None else None}
+        for setting, value in settings.items():
+            if value is not None:
+                cls.update_setting(setting, value)
+                APP_CONFIG_DEFAULTS[setting] = value
+        if not quiet:
+            cls._confirm_and_display()
+        if save:
+            write_config_ini(APP_CONFIG_DEFAULTS)
+
+    @classmethod
+    def change_shard_settings(cls, shard_count=None, shard_layout=None, quiet=False, save=True):
+        """
+        Change how records are stored (see lib.api.shard). With a shard count of 1 every record is in the single
+        phonebook file of the data directory, otherwise records are split by phone across shard_count files named
+        after the shard layout. Changing the count of a phonebook holding records should be done with
+        lib.api.shard.rebalance_shards, which moves the records. Settings which aren't provided are left unchanged.
+        :param shard_count: number of database files records are split across
+        :type shard_count: int
+        :param shard_layout: file name of each shard, next to the phonebook file, with {shard} (index of the shard)
+                             and optionally {count} (shard count) placeholders
+        :type shard_layout: str
+        :param quiet: whether we want to print the updated settings confirmation message
+        :type quiet: bool
+        :param save: whether we want to write the change to config.ini
+        :type save: bool
+        :return: None
+        """
+        if shard_count is not None and int(shard_count) < 1:
+            raise ValueError("Invalid shard count provided. Please use a positive integer.")
+        if shard_layout is not None and "{shard}" not in shard_layout:
+            raise ValueError("Invalid shard layout provided. Please include the {shard} placeholder in the file "
+                             "name, ie. phonebook_{shard}_of_{count}.")
+        settings = {SHARD_COUNT_KEY: int(shard_count) if shard_count is not None else None,
+                    SHARD_LAYOUT_KEY: shard_layout}
+        for setting, value in settings.items():
+            if value is not None:
+                cls.update_setting(setting, value)
+                APP_CONFIG_DEFAULTS[setting] = value
+        if not quiet:
+            cls._confirm_and_display()
+        if save:
+            write_config_ini(APP_CONFIG_DEFAULTS)
 
     @classmethod
     def show_config_info(cls):
@@ -137,10 +275,11 @@ class AppConfig(object):
 def write_config_ini(config_settings):
     """
     Create/update config.ini file based on settings passed in
-    :param config_settings: application settings to write/update
-    :type config_settings: dict
+    :param config_settings: application settings to write/update, written in their iteration order
+    :type config_settings: OrderedDict
     :return: None
     """
+    import configparser
     parser = configparser.ConfigParser()
     parser["DEFAULT"] = config_settings
     with open(APP_CONFIG_INI_PATH, 'w') as f:
@@ -151,7 +290,8 @@ def read_config_ini(config_settings_path):
     """
     Read the config.ini file from disk, parse the values for each of the settings,
     then set the AppConfig settings based on the parsed values, as settings can be
-    changed via the API, or by editing the serial config.ini with valid values
+    changed via the API, or by editing the serial config.ini with valid values. The parsed
+    values are only applied, config.ini isn't written back.
     :param config_settings_path: path to the config.ini used to read app settings
     :type config_settings_path: str
     :return: None
@@ -159,29 +299,49 @@ def read_config_ini(config_settings_path):
     if not os.path.exists(config_settings_path) or not os.path.isfile(config_settings_path):
         raise IOError("Could not parse settings INI. Please provide a valid INI filepath.\n")
 
+    import configparser
     parser = configparser.ConfigParser()
     parser.read(config_settings_path)
     data_dir = parser['DEFAULT'][DATA_DIR_KEY] if parser['DEFAULT'][DATA_DIR_KEY] != "" else APP_CONFIG_DEFAULTS[DATA_DIR_KEY]
-    AppConfig.change_data_directory(data_dir, quiet=True)
+    AppConfig.change_data_directory(data_dir, quiet=True, save=False)
     if parser["DEFAULT"][SERIAL_FORMAT_KEY] in [key['extension'] for key in AppConfig.supported_serial_formats]:
         AppConfig.change_serial_format([_format for _format in AppConfig.supported_serial_formats if
-                                        _format['extension'] == parser['DEFAULT'][SERIAL_FORMAT_KEY]][0], quiet=True)
+                                        _format['extension'] == parser['DEFAULT'][SERIAL_FORMAT_KEY]][0], quiet=True,
+                                       save=False)
     if int(parser["DEFAULT"][WRITE_AUTH_RULE_KEY]) in WriteAuthRules.ALL_RULES:
         AppConfig.change_write_auth_rule(([rule for rule in WriteAuthRules.ALL_RULES if
-                                           rule == int(parser['DEFAULT'][WRITE_AUTH_RULE_KEY])][0]), quiet=True)
+                                           rule == int(parser['DEFAULT'][WRITE_AUTH_RULE_KEY])][0]), quiet=True,
+                                         save=False)
+    # database settings were added later on, so older config.ini files may not have them
+    settings = parser['DEFAULT']
+    AppConfig.change_database_settings(quiet=True, save=False,
+                                       **dict((key, settings.get(key, APP_CONFIG_DEFAULTS[key]))
+                                              for key in [SYNCHRONOUS_KEY, CACHE_SIZE_KEY, MMAP_SIZE_KEY, POOL_SIZE_KEY]))
+    AppConfig.change_query_cache_settings(quiet=True, save=False,
+                                          **dict((key, settings.get(key, APP_CONFIG_DEFAULTS[key]))
+                                                 for key in [QUERY_CACHE_SIZE_KEY, QUERY_CACHE_TTL_KEY]))
+    AppConfig.change_shard_settings(quiet=True, save=False,
+                                    **dict((key, settings.get(key, APP_CONFIG_DEFAULTS[key]))
+                                           for key in [SHARD_COUNT_KEY, SHARD_LAYOUT_KEY]))
 
 
-def setup_app_config():
+def setup_app_config(reload=False):
     """
     Entry point for configuring our app settings. If a config.ini file exists, parse this
     file and set the app settings equal to parsed values. If it doesn't exist, create one
-    using the default settings and write it to disk.
-    :return:
+    using the default settings and write it to disk. config.ini is only parsed on the first
+    call in a process, later calls keep the settings already applied.
+    :param reload: whether we want to parse config.ini again, ie. after it was edited by hand
+    :type reload: bool
+    :return: path of config.ini
+    :rtype: str
     """
-    if not os.path.isfile(APP_CONFIG_INI_PATH) or \
-            not os.path.exists(APP_CONFIG_INI_PATH):
-        write_config_ini(APP_CONFIG_DEFAULTS)
+    global _config_loaded
+    if _config_loaded and not reload:
         return APP_CONFIG_INI_PATH
-    elif os.path.isfile(APP_CONFIG_INI_PATH):
+    if not os.path.isfile(APP_CONFIG_INI_PATH):
+        write_config_ini(APP_CONFIG_DEFAULTS)
+    else:
         read_config_ini(APP_CONFIG_INI_PATH)
-        return APP_CONFIG_INI_PATH
+    _config_loaded = True
+    return APP_CONFIG_INI_PATH
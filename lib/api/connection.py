@@ -0,0 +1,207 @@
+"""
+Module used to manage connections to the database files. Connections are opened lazily, on first use,
+and each thread gets its own connection checked out from a bounded pool, so the record API can be used
+from multi-threaded services. Every connection is put in WAL journal mode, which lets readers in other
+threads keep going while a writer commits, and is set up with the pragmas configured in AppConfig.
+"""
+
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from conf import AppConfig, SYNCHRONOUS_MODES
+
+# sqlite3 only has trace callbacks from python 3.3, older versions report statements through TracedConnection
+NATIVE_TRACE = hasattr(sqlite3.Connection, 'set_trace_callback')
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor reporting the statements it runs to its connection's trace callback, for sqlite3 versions
+    without set_trace_callback
+    """
+    def execute(self, sql, parameters=()):
+        if self.connection.trace_callback is not None:
+            self.connection.trace_callback(sql)
+        return sqlite3.Cursor.execute(self, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if self.connection.trace_callback is not None:
+            self.connection.trace_callback(sql)
+        return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        if self.connection.trace_callback is not None:
+            self.connection.trace_callback(sql_script)
+        return sqlite3.Cursor.executescript(self, sql_script)
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Connection handing out TracedCursors, which Connection.execute and friends use as well
+    """
+    trace_callback = None
+
+    def cursor(self, factory=TracedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+def set_trace_callback(connection, callback):
+    """
+    Set the function called with the text of every statement the connection runs, None removes it
+    """
+    if NATIVE_TRACE:
+        connection.set_trace_callback(callback)
+    else:
+        connection.trace_callback = callback
+
+
+class ConnectionManager(object):
+    """
+    Pool of connections to a single database file, handing out one connection per thread. Use
+    ConnectionManager.for_path to get the shared manager of a database file.
+    """
+    managers        = {}
+    managers_lock   = threading.Lock()
+    timeout         = 30.0
+    # sqlite3 trace callback set on every connection when it's checked out, see set_trace_callback
+    trace_callback  = None
+
+    def __init__(self, database_path, pool_size=None):
+        self.database_path = database_path
+        self.pool_size = pool_size or AppConfig.pool_size
+        self._local = threading.local()
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+
+    @classmethod
+    def for_path(cls, database_path):
+        """
+        Get the shared connection manager of a database file, creating it on first use
+        :param database_path: path of the database file
+        :type database_path: str
+        :return: connection manager of the database file
+        :rtype: ConnectionManager
+        """
+        with cls.managers_lock:
+            if database_path not in cls.managers:
+                cls.managers[database_path] = cls(database_path)
+            return cls.managers[database_path]
+
+    @classmethod
+    def set_trace_callback(cls, callback):
+        """
+        Set (or clear, with None) the sqlite3 trace callback of every pooled connection. The idle connections and
+        the calling thread's connection are updated right away, connections held by other threads when they're
+        next checked out.
+        :param callback: function called with the text of every SQL statement run, or None
+        :type callback: function
+        :return: None
+        """
+        cls.trace_callback = callback
+        with cls.managers_lock:
+            managers = list(cls.managers.values())
+        for manager in managers:
+            with manager._idle_lock:
+                connections = list(manager._idle)
+            held = getattr(manager._local, 'connection', None)
+            for connection in connections + ([held] if held is not None else []):
+                set_trace_callback(connection, callback)
+
+    @classmethod
+    def close_all_managers(cls):
+        with cls.managers_lock:
+            for manager in cls.managers.values():
+                manager.close_all()
+            cls.managers.clear()
+
+    @classmethod
+    def close_for_path(cls, database_path):
+        """
+        Close the pool of a database file and forget its manager, ie. before the file is deleted. The next
+        connection to the file starts a new pool.
+        :param database_path: path of the database file
+        :type database_path: str
+        :return: None
+        """
+        with cls.managers_lock:
+            manager = cls.managers.pop(database_path, None)
+        if manager is not None:
+            manager.close_all()
+
+    def connection(self):
+        """
+        Get the calling thread's connection, checking one out of the pool if the thread doesn't hold one yet.
+        Blocks while all pool_size connections are held by other threads. The thread keeps its connection
+        until it calls release.
+        :return: connection to the database file
+        :rtype: Connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            self._slots.acquire()
+            with self._idle_lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                try:
+                    connection = self._connect()
+                except sqlite3.Error:
+                    self._slots.release()
+                    raise
+            set_trace_callback(connection, self.trace_callback)
+            self._local.connection = connection
+        return connection
+
+    def release(self):
+        """
+        Return the calling thread's connection to the pool, rolling back anything it left uncommitted.
+        Threads that are done with the database should call this, or use the connected context manager.
+        :return: None
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        connection.rollback()
+        with self._idle_lock:
+            self._idle.append(connection)
+        self._slots.release()
+
+    @contextmanager
+    def connected(self):
+        """
+        Context manager holding the calling thread's connection for the duration of a block. The connection
+        goes back to the pool afterwards, unless the thread already held it before the block.
+        """
+        held = getattr(self._local, 'connection', None) is not None
+        try:
+            yield self.connection()
+        finally:
+            if not held:
+                self.release()
+
+    def close_all(self):
+        """
+        Close the idle connections and the calling thread's connection. Connections held by
+        other threads are closed once they're released and the pool is closed again.
+        :return: None
+        """
+        self.release()
+        with self._idle_lock:
+            for connection in self._idle:
+                connection.close()
+            del self._idle[:]
+
+    def _connect(self):
+        if str(AppConfig.synchronous).upper() not in SYNCHRONOUS_MODES:
+            raise ValueError("Invalid synchronous mode configured. Supported modes: {}".format(SYNCHRONOUS_MODES))
+        # connections are only ever used by one thread at a time, but not always the thread that opened them
+        connection = sqlite3.connect(self.database_path, timeout=self.timeout, check_same_thread=False,
+                                     factory=sqlite3.Connection if NATIVE_TRACE else TracedConnection)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = {}".format(str(AppConfig.synchronous).upper()))
+        connection.execute("PRAGMA cache_size = {}".format(int(AppConfig.cache_size)))
+        connection.execute("PRAGMA mmap_size = {}".format(int(AppConfig.mmap_size)))
+        return connection
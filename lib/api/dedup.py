@@ -0,0 +1,357 @@
+"""
+Module used to find and merge near-duplicate records, ie. "John Kal" and "Jon Kal" at "1554 Long St" and
+"1554 Long Street". The write authority rules only stop exact duplicates from being written, so records differing by
+a typo or an abbreviation pile up over time. Comparing every record with every other one doesn't scale past a few
+thousand records, so records are first grouped into blocks sharing a blocking key (same phone, names sounding alike,
+same normalized address), and only the pairs of records within a block are scored. Pairs scoring above a threshold
+are linked into duplicate groups, each collapsed into its most complete record. Groups are written to a JSON merge
+report, which can be reviewed before its merges are applied in a single transaction.
+"""
+
+
+import re
+import json
+import codecs
+from collections import namedtuple
+
+from record_handler import DatabaseRecordWriter, RECORD_FIELDS
+from lib.utils import phone_number_to_integer_stream
+
+# a record to keep, the records merged into it, and the record it ends up as. Records are (id, name, phone, address)
+# rows, and scores has the similarity of each duplicate to the kept record.
+DuplicateGroup = namedtuple('DuplicateGroup', ['keep', 'duplicates', 'merged', 'scores'])
+# duplicate groups found, and counters of the work done finding them
+DedupResult = namedtuple('DedupResult', ['groups', 'stats'])
+
+# words of an address spelled out or abbreviated, mapped to a single spelling
+ADDRESS_ABBREVIATIONS = {'street': 'st', 'road': 'rd', 'avenue': 'ave', 'av': 'ave', 'boulevard': 'blvd',
+                         'drive': 'dr', 'court': 'ct', 'crescent': 'cres', 'place': 'pl', 'lane': 'ln',
+                         'square': 'sq', 'terrace': 'terr', 'highway': 'hwy', 'parkway': 'pkwy', 'circle': 'cir',
+                         'apartment': 'apt', 'suite': 'ste', 'unit': 'apt', 'north': 'n', 'south': 's', 'east': 'e',
+                         'west': 'w'}
+SOUNDEX_CODES = dict((letter, str(code)) for code, letters in enumerate(['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l',
+                                                                        'mn', 'r'])
+                     for letter in letters)
+_NON_WORD = re.compile(r"[^\w]+", re.UNICODE)
+
+
+def _text(value):
+    if value is None:
+        return u""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return u"{}".format(value)
+
+
+def normalize_name(name):
+    """
+    Lowercase words of a name, without punctuation, ie. "O'Brien,  John" => "o brien john"
+    """
+    return u" ".join(_NON_WORD.sub(u" ", _text(name).lower()).split())
+
+
+def normalize_address(address):
+    """
+    Lowercase words of an address, without punctuation and with abbreviations spelled the same way,
+    ie. "1554 Long Street, Apt. 2" => "1554 long st apt 2"
+    """
+    return u" ".join(ADDRESS_ABBREVIATIONS.get(word, word)
+                     for word in _NON_WORD.sub(u" ", _text(address).lower()).split())
+
+
+def normalize_phone(phone):
+    """
+    :return: phone as an integer stream, None if it's missing or not a valid phone
+    :rtype: int
+    """
+    if phone is None or phone == "":
+        return None
+    try:
+        return phone_number_to_integer_stream(phone)
+    except ValueError:
+        return None
+
+
+def soundex(word):
+    """
+    American Soundex code of a word, equal for most words sounding alike, ie. "John" and "Jon" => "j500"
+    :param word: word we want the code of, letters other than a-z are ignored
+    :type word: str
+    :return: first letter and three digits, empty if the word has no a-z letter
+    :rtype: str
+    """
+    letters = [letter for letter in _text(word).lower() if letter in SOUNDEX_CODES]
+    if not letters:
+        return u""
+    digits, previous = [], SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        code = SOUNDEX_CODES[letter]
+        if code != '0' and code != previous:
+            digits.append(code)
+        # h and w don't separate letters with the same code, vowels do
+        if letter not in 'hw':
+            previous = code
+    return (letters[0] + u"".join(digits) + u"000")[:4]
+
+
+class DuplicateFinder(object):
+    """
+    Class responsible for finding duplicate records with blocking and pairwise scoring, and merging them
+    """
+    # pairs scoring at least this much are duplicates
+    threshold       = 0.9
+    # blocks with more records than this are skipped, as scoring them is quadratic. Their records can still be
+    # paired through their other blocking keys.
+    max_block_size  = 500
+    # share of each field in the score of a pair
+    weights         = (('name', 0.4), ('phone', 0.35), ('address', 0.25))
+
+    @classmethod
+    def normalize(cls, row):
+        """
+        :param row: (id, name, phone, address) row
+        :type row: tuple
+        :return: normalized (name, phone, address) fields
+        :rtype: tuple
+        """
+        return normalize_name(row[1]), normalize_phone(row[2]), normalize_address(row[3])
+
+    @classmethod
+    def blocking_keys(cls, normalized, codes=None):
+        """
+        Keys of the blocks a record goes in: its phone, its normalized address, and the sound-alike codes of its first
+        and last name along with its house number. Common names alone would make blocks of thousands of records, so
+        the name codes are narrowed down by the first word of the address.
+        :param normalized: normalized (name, phone, address) fields
+        :type normalized: tuple
+        :param codes: sound-alike codes of the words seen so far, names repeat a lot so their codes are memoized
+        :type codes: dict
+        :return: blocking keys
+        :rtype: list
+        """
+        name, phone, address = normalized
+        keys = []
+        if phone is not None:
+            keys.append(('phone', phone))
+        if address:
+            keys.append(('address', address))
+        codes = {} if codes is None else codes
+        words = name.split()
+        if words:
+            for word in (words[0], words[-1]):
+                if word not in codes:
+                    codes[word] = soundex(word)
+            keys.append(('name', codes[words[0]] + codes[words[-1]], address.split(u" ", 1)[0]))
+        return keys
+
+    @classmethod
+    def score(cls, first, second, minimum=0.0):
+        """
+        Similarity of two normalized records between 0 and 1: the weighted similarity of their names and addresses
+        (see difflib.SequenceMatcher) and whether their phones are equal. Fields missing from either record are left
+        out of the weighted average.
+        :param minimum: score we're looking for. Cheap upper bounds of the similarities are tried first, and most
+                        unrelated pairs are rejected on them without being fully compared.
+        :type minimum: float
+        :return: similarity of the records, 0 if they have no field in common. A score below minimum may only be an
+                 upper bound of the similarity.
+        :rtype: float
+        """
+        from difflib import SequenceMatcher
+        total = compared = 0.0
+        matchers = []
+        for (field, weight), value, other in zip(cls.weights, first, second):
+            if value in (None, u"") or other in (None, u""):
+                continue
+            compared += weight
+            if value == other:
+                total += weight
+            elif field != 'phone':
+                matchers.append((weight, SequenceMatcher(None, value, other)))
+        if not compared:
+            return 0.0
+        # each ratio is an upper bound of the next, slower one
+        for bound in ('real_quick_ratio', 'quick_ratio', 'ratio'):
+            score = (total + sum(weight * getattr(matcher, bound)() for weight, matcher in matchers)) / compared
+            if score < minimum:
+                break
+        return score
+
+    @classmethod
+    def find_in_rows(cls, rows, threshold=None):
+        """
+        Find the duplicate groups of a set of records
+        :param rows: (id, name, phone, address) rows
+        :type rows: iterable
+        :param threshold: score from which a pair is a duplicate, cls.threshold if not provided
+        :type threshold: float
+        :return: duplicate groups, ordered by the id of the record they keep, and stats
+        :rtype: DedupResult
+        """
+        threshold = cls.threshold if threshold is None else threshold
+        records, normalized, blocks, codes = {}, {}, {}, {}
+        for row in rows:
+            records[row[0]] = tuple(row)
+            normalized[row[0]] = cls.normalize(row)
+            for key in cls.blocking_keys(normalized[row[0]], codes):
+                blocks.setdefault(key, []).append(row[0])
+
+        # union-find of the records linked by a duplicate pair
+        parents = {}
+
+        def root(record_id):
+            while parents.get(record_id, record_id) != record_id:
+                parents[record_id] = parents.get(parents[record_id], parents[record_id])
+                record_id = parents[record_id]
+            return record_id
+
+        scored, skipped, duplicate_pairs = set(), 0, 0
+        for ids in blocks.values():
+            if len(ids) > cls.max_block_size:
+                skipped += 1
+                continue
+            for index, first in enumerate(ids):
+                for second in ids[index + 1:]:
+                    pair = (first, second) if first < second else (second, first)
+                    if pair in scored:
+                        continue
+                    scored.add(pair)
+                    if cls.score(normalized[first], normalized[second], threshold) >= threshold:
+                        duplicate_pairs += 1
+                        parents.setdefault(first, first)
+                        parents.setdefault(second, second)
+                        parents[root(pair[1])] = root(pair[0])
+
+        members = {}
+        for record_id in parents:
+            members.setdefault(root(record_id), []).append(record_id)
+        groups = [cls.merge_group([records[record_id] for record_id in sorted(ids)],
+                                  [normalized[record_id] for record_id in sorted(ids)])
+                  for ids in members.values() if len(ids) > 1]
+        groups.sort(key=lambda group: group.keep[0])
+        stats = {"records": len(records), "blocks": len(blocks), "skipped_blocks": skipped,
+                 "scored_pairs": len(scored), "duplicate_pairs": duplicate_pairs, "groups": len(groups),
+                 "duplicates": sum(len(group.duplicates) for group in groups)}
+        return DedupResult(groups, stats)
+
+    @classmethod
+    def merge_group(cls, group_rows, group_normalized):
+        """
+        Collapse a group of duplicates into the most complete of its records (the oldest one on ties), filling the
+        fields it's missing from the other records
+        :return: duplicate group
+        :rtype: DuplicateGroup
+        """
+        completeness = [sum(1 for value in row[1:] if value not in (None, "")) for row in group_rows]
+        keep_index = max(range(len(group_rows)), key=lambda index: (completeness[index], -group_rows[index][0]))
+        keep = group_rows[keep_index]
+        merged = list(keep[1:])
+        for row in group_rows:
+            for column, value in enumerate(row[1:]):
+                if merged[column] in (None, "") and value not in (None, ""):
+                    merged[column] = value
+        duplicates = [row for index, row in enumerate(group_rows) if index != keep_index]
+        scores = [round(cls.score(group_normalized[keep_index], normalized), 4)
+                  for index, normalized in enumerate(group_normalized) if index != keep_index]
+        return DuplicateGroup(keep, duplicates, tuple(merged), scores)
+
+    @classmethod
+    def find(cls, database_driver, table, threshold=None, fetch_size=1000):
+        """
+        Find the duplicate groups of a records table, see find_in_rows
+        :param database_driver: connection to the db
+        :type database_driver: Connection
+        :param table: records table we want to deduplicate
+        :type table: str
+        :return: duplicate groups and stats
+        :rtype: DedupResult
+        """
+        cursor = database_driver.execute("SELECT id, name, phone, address FROM {table} ORDER BY id"
+                                         .format(table=table))
+
+        def rows():
+            results = cursor.fetchmany(fetch_size)
+            while results:
+                for result in results:
+                    yield result
+                results = cursor.fetchmany(fetch_size)
+        try:
+            return cls.find_in_rows(rows(), threshold)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _row_dict(row):
+        return dict(zip(('id',) + RECORD_FIELDS, row))
+
+    @classmethod
+    def write_report(cls, result, output_path, threshold=None):
+        """
+        Write a JSON merge report of the duplicate groups found, which apply_report can apply once reviewed
+        :param result: duplicate groups and stats, see find
+        :type result: DedupResult
+        :param output_path: full path of the report
+        :type output_path: str
+        :return: None
+        """
+        report = {"threshold": cls.threshold if threshold is None else threshold, "stats": result.stats,
+                  "groups": [{"keep": cls._row_dict(group.keep),
+                              "merged": dict(zip(RECORD_FIELDS, group.merged)),
+                              "duplicates": [dict(cls._row_dict(row), score=score)
+                                             for row, score in zip(group.duplicates, group.scores)]}
+                             for group in result.groups]}
+        with codecs.open(output_path, 'w', 'utf-8') as report_file:
+            report_file.write(json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False))
+
+    @classmethod
+    def read_report(cls, input_path):
+        """
+        :return: duplicate groups of a merge report written by write_report
+        :rtype: list
+        """
+        with codecs.open(input_path, 'r', 'utf-8') as report_file:
+            report = json.load(report_file)
+        row = lambda values: tuple(values.get(field) for field in ('id',) + RECORD_FIELDS)
+        return [DuplicateGroup(row(group["keep"]), [row(duplicate) for duplicate in group["duplicates"]],
+                               tuple(group["merged"].get(field) for field in RECORD_FIELDS),
+                               [duplicate.get("score") for duplicate in group["duplicates"]])
+                for group in report["groups"]]
+
+    @classmethod
+    def apply(cls, groups):
+        """
+        Collapse every duplicate group in a single transaction: the kept record is set to the merged record, and the
+        duplicates are deleted. Records are only changed if they're still as they were when the groups were found,
+        otherwise nothing is written.
+        :param groups: duplicate groups, see find/read_report
+        :type groups: list
+        :return: number of records deleted
+        :rtype: int
+        """
+        table = DatabaseRecordWriter.records_table
+        unchanged = "id = ? and name IS ? and phone IS ? and address IS ?"
+        deleted = 0
+        with DatabaseRecordWriter.transaction() as connection:
+            cursor = connection.cursor()
+            try:
+                for group in groups:
+                    cursor.execute("UPDATE {table} SET name = ?, phone = ?, address = ? WHERE {unchanged}"
+                                   .format(table=table, unchanged=unchanged), tuple(group.merged) + tuple(group.keep))
+                    if cursor.rowcount != 1:
+                        raise ValueError("Record {} changed since the duplicates were found. Please find them "
+                                         "again.".format(group.keep[0]))
+                    for row in group.duplicates:
+                        cursor.execute("DELETE FROM {table} WHERE {unchanged}".format(table=table,
+                                                                                     unchanged=unchanged), tuple(row))
+                        if cursor.rowcount != 1:
+                            raise ValueError("Record {} changed since the duplicates were found. Please find them "
+                                             "again.".format(row[0]))
+                        deleted += 1
+            finally:
+                cursor.close()
+        index = DatabaseRecordWriter.uniqueness_index()
+        if index is not None:
+            index.remove_rows([group.keep[1:] for group in groups] +
+                              [row[1:] for group in groups for row in group.duplicates])
+            index.add_rows([group.merged for group in groups])
+        return deleted
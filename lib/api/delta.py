@@ -0,0 +1,323 @@
+"""
+Module used to export only what changed in the records table since a previous export. Every write to the records
+table is appended to a change log by triggers (see SCHEMA_MIGRATIONS in lib.api.record_handler), each change
+numbered by a monotonic sequence number. An export remembers the sequence number it's up to date with (its
+checkpoint), and the changes after it are either written out as a delta file, or merged straight into the export,
+so refreshing an export only reads the changes from the db instead of the whole table.
+"""
+
+
+import os
+import json
+import codecs
+import sqlite3
+from serialize import open_serial_file
+from collections import namedtuple, OrderedDict, deque
+
+# net change of a single record since a checkpoint. old is the record as of the checkpoint (None for inserts),
+# new the record as it is now (None for deletes), both (name, phone, address) tuples.
+RecordChange = namedtuple('RecordChange', ['op', 'record_id', 'old', 'new'])
+# changes since a checkpoint, and the sequence number of the checkpoint they bring an export up to
+Delta = namedtuple('Delta', ['changes', 'sequence'])
+
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+
+
+class ChangeOp(object):
+    """
+    Kinds of changes, as stored in the op column of the change log
+    """
+    INSERT = 'insert'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    ALL_OPS = [INSERT, UPDATE, DELETE]
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _record_key(record):
+    """
+    Comparable form of a record, as readers of the different serial formats return NULL and text fields differently
+    """
+    return tuple(u"" if value is None else _text(value) for value in record)
+
+
+class DeltaExporter(object):
+    """
+    Class responsible for reading the change log of the records table, and exporting its changes
+    """
+    changelog_suffix = '_changelog'
+
+    @classmethod
+    def changelog_table(cls, table):
+        return table + cls.changelog_suffix
+
+    @classmethod
+    def current_sequence(cls, database_driver, table):
+        """
+        :return: sequence number of the last logged change, 0 if nothing was logged yet
+        :rtype: int
+        """
+        return database_driver.execute("SELECT coalesce(max(seq), 0) FROM {changelog}"
+                                       .format(changelog=cls.changelog_table(table))).fetchone()[0]
+
+    @classmethod
+    def changes_since(cls, database_driver, table, since):
+        """
+        Fetch the net change of each record changed after a checkpoint. Successive changes of a record are collapsed,
+        ie. a record inserted then updated is a single insert of its latest values, and a record inserted then
+        deleted isn't reported at all.
+        :param database_driver: connection to the db
+        :type database_driver: Connection
+        :param table: records table the changes were made to
+        :type table: str
+        :param since: checkpoint, sequence number of the last change already exported
+        :type since: int
+        :return: changes in the order each record was first changed, and the sequence number they're up to
+        :rtype: Delta
+        """
+        changelog = cls.changelog_table(table)
+        first_seq, sequence = database_driver.execute("SELECT min(seq), coalesce(max(seq), 0) FROM {changelog}"
+                                                      .format(changelog=changelog)).fetchone()
+        if since < 0 or since > sequence:
+            raise ValueError("Invalid checkpoint provided. Please use a sequence number between 0 and {}."
+                             .format(sequence))
+        if first_seq is not None and since < first_seq - 1:
+            raise ValueError("Changes after checkpoint {} were pruned from the change log. Please run a full export."
+                             .format(since))
+        cursor = database_driver.execute("SELECT op, record_id, name, phone, address, old_name, old_phone, "
+                                         "old_address FROM {changelog} WHERE seq > ? and seq <= ? ORDER BY seq"
+                                         .format(changelog=changelog), (since, sequence))
+        first_ops, olds, news = OrderedDict(), {}, {}
+        for op, record_id, name, phone, address, old_name, old_phone, old_address in cursor:
+            if record_id not in first_ops:
+                first_ops[record_id] = op
+                olds[record_id] = None if op == ChangeOp.INSERT else (old_name, old_phone, old_address)
+            news[record_id] = None if op == ChangeOp.DELETE else (name, phone, address)
+        changes = []
+        for record_id, first_op in first_ops.items():
+            old, new = olds[record_id], news[record_id]
+            if old is None and new is None:
+                continue
+            op = ChangeOp.INSERT if old is None else ChangeOp.DELETE if new is None else ChangeOp.UPDATE
+            changes.append(RecordChange(op, record_id, old, new))
+        return Delta(changes, sequence)
+
+    @classmethod
+    def prune(cls, database_driver, table, before):
+        """
+        Remove the logged changes up to a checkpoint every consumer has already exported, to bound the log's size
+        :param database_driver: connection to the db
+        :type database_driver: Connection
+        :param table: records table the changes were made to
+        :type table: str
+        :param before: last sequence number we want to remove
+        :type before: int
+        :return: number of removed changes
+        :rtype: int
+        """
+        cursor = database_driver.execute("DELETE FROM {changelog} WHERE seq <= ?"
+                                         .format(changelog=cls.changelog_table(table)), (before,))
+        database_driver.commit()
+        return cursor.rowcount
+
+    @classmethod
+    def write_delta(cls, database_driver, table, since, output_path):
+        """
+        Write the changes after a checkpoint as newline delimited JSON, one change per line, ending with a line
+        holding the checkpoint the delta brings an export up to
+        :param database_driver: connection to the db
+        :type database_driver: Connection
+        :param table: records table the changes were made to
+        :type table: str
+        :param since: checkpoint the delta starts after
+        :type since: int
+        :param output_path: full path of the delta file
+        :type output_path: str
+        :return: changes written and new checkpoint
+        :rtype: Delta
+        """
+        delta = cls.changes_since(database_driver, table, since)
+        with codecs.open(output_path, 'w', 'utf-8') as output_file:
+            for change in delta.changes:
+                output_file.write(json.dumps({"op": change.op, "id": change.record_id,
+                                              "old": cls._record_dict(change.old), "new": cls._record_dict(change.new)},
+                                             sort_keys=True) + "\n")
+            output_file.write(json.dumps({"checkpoint": delta.sequence, "since": since}, sort_keys=True) + "\n")
+        return delta
+
+    @staticmethod
+    def _record_dict(record):
+        if record is None:
+            return None
+        return {"name": record[0], "phone": record[1], "address": record[2]}
+
+    @classmethod
+    def write_full(cls, database_driver, table, serial_format, output_path, records):
+        """
+        Write a full export along with its checkpoint. The records and the checkpoint are read in the same read
+        transaction, so no change can slip in between them.
+        :param database_driver: connection the records are read through
+        :type database_driver: Connection
+        :param table: records table we want to export
+        :type table: str
+        :param serial_format: serial format we want to export to, see SerialFormats
+        :type serial_format: dict
+        :param output_path: full path of the exported file
+        :type output_path: str
+        :param records: function returning an iterable of all the records, read through database_driver
+        :type records: callable
+        :return: checkpoint of the export
+        :rtype: int
+        """
+        started = cls._begin_read(database_driver)
+        try:
+            sequence = cls.current_sequence(database_driver, table)
+            serial_format['writer'].write(records(), output_path)
+        finally:
+            if started:
+                database_driver.commit()
+        cls.write_checkpoint(output_path, sequence)
+        return sequence
+
+    @classmethod
+    def merge(cls, database_driver, table, serial_format, export_path, since=None):
+        """
+        Bring an existing export up to date by applying the changes after its checkpoint: deleted records are
+        removed, updated records replaced in place, and inserted records appended. The old export is streamed
+        through the writer into a new file, which replaces it once it's completely written. When there are only
+        inserts and the format allows it (see SerialWriter.appendable), they're appended to the export in place.
+        :param database_driver: connection to the db
+        :type database_driver: Connection
+        :param table: records table the export was made from
+        :type table: str
+        :param serial_format: serial format of the export, it needs a reader, see SerialFormats
+        :type serial_format: dict
+        :param export_path: full path of the export
+        :type export_path: str
+        :param since: checkpoint of the export, read from its checkpoint file if not provided
+        :type since: int
+        :return: changes merged and new checkpoint
+        :rtype: Delta
+        """
+        if not serial_format['reader']:
+            raise ValueError("{} exports can't be read back, so they can't be merged. Please run a full export."
+                             .format(serial_format['writer'].format_name))
+        if since is None:
+            since = cls.read_checkpoint(export_path)
+        delta = cls.changes_since(database_driver, table, since)
+        writer = serial_format['writer']
+        if delta.changes and writer.appendable and all(change.old is None for change in delta.changes):
+            cls.append(writer, export_path, [change.new for change in delta.changes])
+        elif delta.changes:
+            # keeps the format extension, so compressed exports stay compressed
+            temporary_path = '{}.merging.{}'.format(export_path, serial_format['extension'])
+            try:
+                writer.write(cls._merged_records(serial_format['reader'].read(export_path), delta, since,
+                                                 export_path), temporary_path)
+            except Exception:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                raise
+            if os.path.exists(export_path):
+                os.remove(export_path)
+            os.rename(temporary_path, export_path)
+        cls.write_checkpoint(export_path, delta.sequence)
+        return delta
+
+    @staticmethod
+    def _merged_records(records, delta, since, export_path):
+        """
+        Lazily apply a delta to the records of an export, see merge
+        :param records: records of the export, in order
+        :type records: iterable
+        :return: generator of the merged records
+        :rtype: generator
+        """
+        # new record (None for deletes) of each changed record, keyed on the record as of the checkpoint.
+        # Equal records can appear more than once, their changes are applied in order.
+        replacements, appended = {}, []
+        for change in delta.changes:
+            if change.old is None:
+                appended.append(change.new)
+            else:
+                replacements.setdefault(_record_key(change.old), deque()).append(change.new)
+        for record in records:
+            key = _record_key(record)
+            if key not in replacements:
+                yield record
+                continue
+            new = replacements[key].popleft()
+            if not replacements[key]:
+                del replacements[key]
+            if new is not None:
+                yield new
+        if replacements:
+            raise ValueError("Record {} changed since checkpoint {} is missing from {}. Please run a full export."
+                             .format(next(iter(replacements)), since, export_path))
+        for record in appended:
+            yield record
+
+    @staticmethod
+    def append(writer, export_path, records):
+        """
+        Append records to an export in place, see SerialWriter.appendable
+        :param writer: serial writer the export was written with
+        :type writer: SerialWriter
+        :param export_path: full path of the export, compressed if its extension is one of COMPRESSIONS
+        :type export_path: str
+        :param records: records we want to append
+        :type records: list
+        :return: None
+        """
+        with codecs.getwriter('utf-8')(open_serial_file(export_path, 'ab')) as export_file:
+            for chunk in writer.iter_record_chunks(records):
+                export_file.write(chunk)
+
+    @classmethod
+    def refresh(cls, database_driver, table, serial_format, export_path, records):
+        """
+        Keep an export up to date: merge the changes since its checkpoint if it has one, write it in full otherwise
+        :param records: function returning an iterable of all the records, used for full exports, see write_full
+        :type records: callable
+        :return: checkpoint of the export, and number of changes merged (None for full exports)
+        :rtype: tuple
+        """
+        if os.path.isfile(export_path) and os.path.isfile(export_path + CHECKPOINT_SUFFIX):
+            delta = cls.merge(database_driver, table, serial_format, export_path)
+            return delta.sequence, len(delta.changes)
+        return cls.write_full(database_driver, table, serial_format, export_path, records), None
+
+    @staticmethod
+    def write_checkpoint(export_path, sequence):
+        with open(export_path + CHECKPOINT_SUFFIX, 'w') as checkpoint_file:
+            json.dump({"checkpoint": sequence}, checkpoint_file)
+
+    @staticmethod
+    def read_checkpoint(export_path):
+        """
+        :return: checkpoint of an export, written alongside it by write_full/merge
+        :rtype: int
+        """
+        if not os.path.isfile(export_path + CHECKPOINT_SUFFIX):
+            raise IOError("No checkpoint found for {}. Please run a full export first.".format(export_path))
+        with open(export_path + CHECKPOINT_SUFFIX) as checkpoint_file:
+            return int(json.load(checkpoint_file)["checkpoint"])
+
+    @staticmethod
+    def _begin_read(database_driver):
+        """
+        Start a read transaction, unless the connection is already in one
+        :return: whether a transaction was started
+        :rtype: bool
+        """
+        try:
+            database_driver.execute("BEGIN")
+        except sqlite3.OperationalError:
+            return False
+        return True
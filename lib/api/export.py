@@ -0,0 +1,203 @@
+"""
+Module used to export the records table to a serial format in parallel. The table is split into rowid
+ranges (shards), and each shard is serialized by its own worker process with its own read-only connection
+to the database. The shards are then either concatenated into a single valid output file, or kept as
+separate part files listed in a manifest.
+"""
+
+
+import codecs
+import json
+import os
+import shutil
+import sqlite3
+from serialize import open_serial_file
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def _iter_shard(database_path, table, first_id, last_id, fetch_size):
+    """
+    Lazily fetch the records of a single shard, in rowid order, through a read-only connection
+    """
+    database_driver = sqlite3.connect(database_path)
+    try:
+        database_driver.execute("PRAGMA query_only = ON")
+        cursor = database_driver.execute("SELECT name, phone, address FROM {table} WHERE id BETWEEN ? AND ? "
+                                         "ORDER BY id".format(table=table), (first_id, last_id))
+        results = cursor.fetchmany(fetch_size)
+        while results:
+            for result in results:
+                yield result
+            results = cursor.fetchmany(fetch_size)
+    finally:
+        database_driver.close()
+
+
+def _counting(records, counter):
+    """
+    Pass records through, counting them in counter[0]
+    """
+    for record in records:
+        counter[0] += 1
+        yield record
+
+
+def _export_shard(task):
+    """
+    Worker process entry point. Serializes a single shard to its part file, either as a complete document
+    or as bare uncompressed records (no header/footer) ready to be concatenated with the other shards.
+    Binary writers always write complete documents.
+    :param task: (database_path, table, writer, first_id, last_id, part_path, complete, fetch_size)
+    :type task: tuple
+    :return: part path and number of records written
+    :rtype: tuple
+    """
+    database_path, table, writer, first_id, last_id, part_path, complete, fetch_size = task
+    records = _iter_shard(database_path, table, first_id, last_id, fetch_size)
+    record_count = 0
+    if writer.binary:
+        counter = [0]
+        with open(part_path, 'wb') as part_file:
+            for chunk in writer.iter_chunks(_counting(records, counter)):
+                part_file.write(chunk)
+        return part_path, counter[0]
+    with codecs.getwriter('utf-8')(open_serial_file(part_path, 'wb')) as part_file:
+        if complete:
+            part_file.write(writer.header)
+        for chunk in writer.iter_record_chunks(records):
+            part_file.write(chunk)
+            record_count += 1
+        if complete:
+            part_file.write(writer.footer)
+    return part_path, record_count
+
+
+class ParallelExporter(object):
+    """
+    Class responsible for exporting the records table with a pool of worker processes
+    """
+    fetch_size = 1000
+
+    @classmethod
+    def shard_ranges(cls, database_driver, table, shards):
+        """
+        Split the rowids of the records table into evenly sized, contiguous ranges
+        :param database_driver: connection to the db
+        :type database_driver: Connection
+        :param table: records table we want to split
+        :type table: str
+        :param shards: number of ranges we want
+        :type shards: int
+        :return: inclusive (first id, last id) ranges, in rowid order
+        :rtype: list
+        """
+        first_id, last_id = database_driver.execute("SELECT min(id), max(id) FROM {table}"
+                                                    .format(table=table)).fetchone()
+        if first_id is None:
+            return [(0, -1)]
+        step = max(1, -(-(last_id - first_id + 1) // shards))
+        return [(low, min(low + step - 1, last_id)) for low in range(first_id, last_id + 1, step)]
+
+    @classmethod
+    def export(cls, database_driver, database_path, table, serial_format, output_path, workers, manifest=False):
+        """
+        Export all the records to a serial file using a pool of worker processes, one shard per worker.
+        :param database_driver: connection to the db, only used to plan the shards
+        :type database_driver: Connection
+        :param database_path: path of the db file each worker opens its own connection to
+        :type database_path: str
+        :param table: records table we want to export
+        :type table: str
+        :param serial_format: serial format we want to export to, see SerialFormats
+        :type serial_format: dict
+        :param output_path: full path of the exported file
+        :type output_path: str
+        :param workers: number of worker processes
+        :type workers: int
+        :param manifest: keep each shard as a complete part file listed in a manifest, instead of
+                         concatenating them into output_path. Binary formats can only be exported this way.
+        :type manifest: bool
+        :return: number of records exported
+        :rtype: int
+        """
+        if workers < 1:
+            raise ValueError("Invalid number of workers provided. Please use a positive integer.")
+        writer = serial_format['writer']
+        if writer.binary and not manifest:
+            raise ValueError("{} exports can't be concatenated across workers. Please export them with a single "
+                             "worker, or as part files listed in a manifest.".format(writer.format_name))
+        ranges = cls.shard_ranges(database_driver, table, workers)
+        extension = '.' + serial_format['extension']
+        base_path = output_path[:-len(extension)] if output_path.endswith(extension) else output_path
+        tasks = [(database_path, table, writer, first_id, last_id,
+                  "{}.part{}".format(output_path, index) if not manifest else
+                  "{}.part{}{}".format(base_path, index, extension),
+                  manifest, cls.fetch_size)
+                 for index, (first_id, last_id) in enumerate(ranges)]
+
+        # multiprocessing is slow to import, and only parallel exports need it
+        from multiprocessing import Pool
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            parts = pool.map(_export_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        record_count = sum(count for part_path, count in parts)
+        if manifest:
+            cls.write_manifest(output_path + MANIFEST_SUFFIX, serial_format, parts, ranges)
+        else:
+            cls.concatenate(writer, parts, output_path)
+        writer.log_write_message(writer.format_name, output_path if not manifest else output_path + MANIFEST_SUFFIX,
+                                 record_count)
+        return record_count
+
+    @classmethod
+    def concatenate(cls, writer, parts, output_path):
+        """
+        Join bare record part files into a single complete document, compressed as its extension says, then
+        remove the parts
+        :param writer: serial writer the parts were written with
+        :type writer: SerialWriter
+        :param parts: (part path, record count) of each part, in order
+        :type parts: list
+        :param output_path: full path of the resulting document
+        :type output_path: str
+        :return: None
+        """
+        with open_serial_file(output_path, 'wb') as output_file:
+            output_file.write(writer.header.encode('utf-8'))
+            written = False
+            for part_path, record_count in parts:
+                if record_count:
+                    if written:
+                        output_file.write(writer.separator.encode('utf-8'))
+                    with open(part_path, 'rb') as part_file:
+                        shutil.copyfileobj(part_file, output_file)
+                    written = True
+                os.remove(part_path)
+            output_file.write(writer.footer.encode('utf-8'))
+
+    @classmethod
+    def write_manifest(cls, manifest_path, serial_format, parts, ranges):
+        """
+        Write a manifest listing each exported part file, with its record count and rowid range
+        :param manifest_path: full path of the manifest file
+        :type manifest_path: str
+        :param serial_format: serial format the parts were written in
+        :type serial_format: dict
+        :param parts: (part path, record count) of each part, in order
+        :type parts: list
+        :param ranges: (first id, last id) of each part, in order
+        :type ranges: list
+        :return: None
+        """
+        manifest = {"format": serial_format['extension'],
+                    "records": sum(count for part_path, count in parts),
+                    "parts": [{"path": os.path.basename(part_path), "records": count,
+                               "first_id": first_id, "last_id": last_id}
+                              for (part_path, count), (first_id, last_id) in zip(parts, ranges)]}
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
@@ -0,0 +1,191 @@
+"""
+Module used to group many single-record writes into shared transactions. Producers submit records to a
+GroupCommitWriter and get a RecordFuture back straight away, while a background thread collects the
+submitted writes and flushes them in a single transaction once max_batch writes are pending or the oldest
+one has waited max_delay seconds. This trades a few milliseconds of latency per write for one commit
+(and fsync) per batch instead of one per record.
+"""
+
+
+import time
+import threading
+from collections import Counter
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from auth import UniquenessIndex, WriteAuthRuleHandler, WriteAuthRules
+from conf import AppConfig
+from async_record_handler import RecordFuture
+from record_handler import DatabaseRecordWriter, RecordMatch
+
+_ADD = 'add'
+_UPDATE = 'update'
+_STOP = object()
+
+
+class GroupCommitWriter(object):
+    """
+    Background writer flushing queued adds/updates in group commits. Write authority rules are checked when
+    a batch is flushed, against the database and against the writes earlier in the same batch, so two queued
+    duplicates can't both get in.
+    """
+    def __init__(self, writer=DatabaseRecordWriter, max_batch=500, max_delay=0.01, auth_rule=None):
+        """
+        :param writer: record writer used to write the batches
+        :type writer: DatabaseRecordWriter
+        :param max_batch: number of pending writes which triggers a flush
+        :type max_batch: int
+        :param max_delay: max number of seconds a write waits for its batch to fill up
+        :type max_delay: float
+        :param auth_rule: authority rule writes are checked with, defaults to AppConfig.write_auth_rule at flush time
+        :type auth_rule: int
+        """
+        if max_batch < 1:
+            raise ValueError("Invalid batch size provided. Please use a positive integer.")
+        self.writer = writer
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.auth_rule = auth_rule
+        self._pending = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Flush everything submitted so far, then stop the background thread
+        :return: None
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._pending.put(_STOP)
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_record(self, db_record):
+        """
+        Queue a new record to be added in the next group commit
+        :param db_record: record we want to add
+        :type db_record: DatabaseRecord
+        :return: future resolving to True once written, or False if the write authority rule rejected it
+        :rtype: RecordFuture
+        """
+        return self._submit(_ADD, (db_record,))
+
+    def update_records_by_all_fields(self, query_record, updated_record, match=RecordMatch.SUBSTRING):
+        """
+        Queue an update of all records matching the query record, see DatabaseRecordWriter.update_records_by_all_fields
+        :return: future resolving to the number of updated records, or False if the write authority rule rejected it
+        :rtype: RecordFuture
+        """
+        return self._submit(_UPDATE, (query_record, updated_record, match))
+
+    def _submit(self, operation, args):
+        if self._thread is None:
+            raise RuntimeError("Group commit writer is not running. Please start it before submitting writes.")
+        future = RecordFuture()
+        self._pending.put((future, operation, args))
+        return future
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self._pending.get()]
+                if batch[0] is _STOP:
+                    break
+                deadline = time.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        write = self._pending.get(timeout=max(0, deadline - time.time()))
+                    except Empty:
+                        break
+                    if write is _STOP:
+                        stopping = True
+                        break
+                    batch.append(write)
+                self._flush(batch)
+        finally:
+            self.writer.release_connection()
+
+    def _flush(self, batch):
+        """
+        Apply a batch of writes in submission order inside a single transaction. Consecutive adds are
+        checked set-wise and inserted with executemany, updates are checked and applied one at a time.
+        The uniqueness index only learns about the batch once it's committed, so the keys written and replaced
+        earlier in the batch are tracked alongside it and every check sees them.
+        """
+        auth_rule = self.auth_rule if self.auth_rule is not None else AppConfig.write_auth_rule
+        connection = self.writer.connection()
+        cursor = connection.cursor()
+        uniqueness_index = self.writer.uniqueness_index()
+        results, added, removed = [], [], []
+        fields = WriteAuthRules.RULE_FIELDS[auth_rule]
+        pending = Counter()
+        try:
+            WriteAuthRuleHandler.create_candidates_table(cursor)
+            index = 0
+            while index < len(batch):
+                future, operation, args = batch[index]
+                if operation == _UPDATE:
+                    query_record, updated_record, match = args
+                    if WriteAuthRuleHandler.can_add_with_auth_rule(self.writer.records_table, cursor, auth_rule,
+                                                                   updated_record, uniqueness_index, pending):
+                        updated_rows = self.writer.matching_rows(cursor, query_record, match)
+                        results.append(self.writer.update_all_fields(cursor, query_record, updated_record, match))
+                        removed.extend(updated_rows)
+                        added.extend([updated_record] * len(updated_rows))
+                        if uniqueness_index is not None and fields:
+                            for row in updated_rows:
+                                pending[UniquenessIndex.row_key(fields, row)] -= 1
+                            pending[uniqueness_index.key(fields, updated_record)] += len(updated_rows)
+                    else:
+                        results.append(False)
+                    index += 1
+                    continue
+                run = [args[0]]
+                while index + len(run) < len(batch) and batch[index + len(run)][1] == _ADD:
+                    run.append(batch[index + len(run)][2][0])
+                accepted, rejected = WriteAuthRuleHandler.filter_records_with_auth_rule(self.writer.records_table,
+                                                                                      cursor, auth_rule, run,
+                                                                                      uniqueness_index, pending)
+                self.writer.insert_records(cursor, accepted)
+                added.extend(accepted)
+                if uniqueness_index is not None and fields:
+                    pending.update(uniqueness_index.key(fields, record) for record in accepted)
+                # accepted records keep their order, so walk both lists to match them back to their futures
+                position = 0
+                for record in run:
+                    written = position < len(accepted) and accepted[position] is record
+                    position += written
+                    results.append(written)
+                index += len(run)
+            connection.commit()
+        except Exception as error:
+            connection.rollback()
+            for future, operation, args in batch:
+                future.set_exception(error)
+            return
+        finally:
+            cursor.close()
+        self.writer.invalidate_query_cache()
+        if uniqueness_index is not None:
+            uniqueness_index.remove_rows(removed)
+            uniqueness_index.add_records(added)
+        for (future, operation, args), result in zip(batch, results):
+            future.set_result(result)
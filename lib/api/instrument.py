@@ -0,0 +1,313 @@
+"""
+Module used to profile where the time of an app run goes. When enabled, every public method of the record
+readers/writers, the write authority rule handler and the serial writers is wrapped with a timer, and every SQL
+statement run on a pooled connection is counted and timed through sqlite3's trace callback. Timings are grouped
+by phase (ie. config parsing, db setup, the command itself), so a slow run can be broken down at a glance.
+Nothing is wrapped until Instrumentation.enable is called, so there is no overhead when it's turned off.
+"""
+
+
+import re
+import sys
+import json
+import types
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from auth import WriteAuthRuleHandler
+from connection import ConnectionManager
+from record_handler import DatabaseRecordHandler, DatabaseRecordReader, DatabaseRecordWriter
+from serialize import SerialWriter
+
+# classes whose public classmethods are timed
+INSTRUMENTED_CLASSES = [DatabaseRecordHandler, DatabaseRecordReader, DatabaseRecordWriter, WriteAuthRuleHandler,
+                        SerialWriter]
+# SQL statements are grouped by their text, trimmed to this length
+SQL_TEXT_LENGTH = 120
+
+
+class TimerStats(object):
+    """
+    Call count, total and max time of a timed method/statement
+    """
+    __slots__ = ('calls', 'total', 'max')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self):
+        return {'calls': self.calls, 'total_ms': self.total * 1000.0, 'max_ms': self.max * 1000.0}
+
+
+class Phase(object):
+    """
+    Timings collected while a phase of the app run was active
+    """
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.timers = {}
+        self.sql = {}
+        self.counters = {}
+
+    def to_dict(self):
+        return {'seconds': self.seconds,
+                'timers': dict((name, stats.to_dict()) for name, stats in self.timers.items()),
+                'sql': dict((text, stats.to_dict()) for text, stats in self.sql.items()),
+                'counters': dict(self.counters)}
+
+
+class Instrumentation(object):
+    """
+    Global profiler of the record API. Enable it, run the work to profile inside phases, then report.
+    """
+    enabled         = False
+    phases          = OrderedDict()
+    current_phase   = None
+    originals       = []
+    lock            = threading.Lock()
+    # statement currently running on each thread, as (text, start time)
+    _statement      = threading.local()
+
+    @classmethod
+    def enable(cls):
+        """
+        Start collecting timings, wrapping every instrumented method and tracing SQL statements
+        :return: None
+        """
+        if cls.enabled:
+            return
+        for owner in INSTRUMENTED_CLASSES:
+            for attr, value in list(owner.__dict__.items()):
+                if attr.startswith('_') or not isinstance(value, classmethod):
+                    continue
+                cls.originals.append((owner, attr, value))
+                setattr(owner, attr, classmethod(cls._timed(attr, value.__func__)))
+        ConnectionManager.set_trace_callback(cls._trace)
+        cls.enabled = True
+        cls.start_phase('unphased')
+
+    @classmethod
+    def disable(cls):
+        """
+        Stop collecting timings, restoring the original methods. Collected timings are kept until reset.
+        :return: None
+        """
+        if not cls.enabled:
+            return
+        cls.end_phase()
+        ConnectionManager.set_trace_callback(None)
+        for owner, attr, value in reversed(cls.originals):
+            setattr(owner, attr, value)
+        del cls.originals[:]
+        cls.enabled = False
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.phases.clear()
+            cls.current_phase = None
+        if cls.enabled:
+            cls.start_phase('unphased')
+
+    @classmethod
+    def start_phase(cls, name):
+        """
+        End the current phase, and start collecting timings under a new (or previously used) phase name
+        :param name: name of the phase
+        :type name: str
+        :return: None
+        """
+        cls.end_phase()
+        with cls.lock:
+            phase = cls.phases.get(name)
+            if phase is None:
+                phase = cls.phases[name] = Phase(name)
+            cls.current_phase = (phase, default_timer())
+
+    @classmethod
+    def end_phase(cls):
+        cls._close_statement()
+        with cls.lock:
+            if cls.current_phase is not None:
+                phase, start = cls.current_phase
+                phase.seconds += default_timer() - start
+                cls.current_phase = None
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name):
+        """
+        Context manager collecting the timings of a block under a phase name, then going back to the
+        phase which was active before. Does nothing when instrumentation is disabled.
+        """
+        if not cls.enabled:
+            yield
+            return
+        previous = cls.current_phase[0].name if cls.current_phase is not None else 'unphased'
+        cls.start_phase(name)
+        try:
+            yield
+        finally:
+            cls.start_phase(previous)
+
+    @classmethod
+    def add_time(cls, name, seconds):
+        """
+        Add time measured outside of the instrumented methods to a phase, ie. imports done before enabling
+        :param name: name of the phase the time is added to
+        :type name: str
+        :param seconds: time taken
+        :type seconds: float
+        :return: None
+        """
+        with cls.lock:
+            phase = cls.phases.get(name)
+            if phase is None:
+                phase = cls.phases[name] = Phase(name)
+            phase.seconds += seconds
+
+    @classmethod
+    def count(cls, name, amount=1):
+        """
+        Increment a counter of the current phase
+        """
+        if not cls.enabled:
+            return
+        with cls.lock:
+            if cls.current_phase is not None:
+                counters = cls.current_phase[0].counters
+                counters[name] = counters.get(name, 0) + amount
+
+    @classmethod
+    def _record(cls, bucket, name, seconds):
+        with cls.lock:
+            if cls.current_phase is None:
+                return
+            stats = getattr(cls.current_phase[0], bucket).get(name)
+            if stats is None:
+                stats = getattr(cls.current_phase[0], bucket)[name] = TimerStats()
+            stats.add(seconds)
+
+    @classmethod
+    def _timed(cls, attr, function):
+        """
+        Wrap a classmethod's function with a timer. Generators are timed while they're iterated, as that's
+        where their queries actually run.
+        """
+        @functools.wraps(function)
+        def timed(owner, *args, **kwargs):
+            name = "{}.{}".format(owner.__name__, attr)
+            start = default_timer()
+            try:
+                result = function(owner, *args, **kwargs)
+            finally:
+                cls._close_statement()
+                cls._record('timers', name, default_timer() - start)
+            if isinstance(result, types.GeneratorType):
+                return cls._timed_iteration(name + " (iteration)", result)
+            return result
+        return timed
+
+    @classmethod
+    def _timed_iteration(cls, name, generator):
+        elapsed = 0.0
+        items = 0
+        try:
+            while True:
+                start = default_timer()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    elapsed += default_timer() - start
+                    break
+                elapsed += default_timer() - start
+                items += 1
+                yield item
+        finally:
+            cls._close_statement()
+            cls._record('timers', name, elapsed)
+            cls.count(name + " items", items)
+
+    @classmethod
+    def _trace(cls, statement):
+        """
+        sqlite3 trace callback. SQLite reports when each statement starts, so a statement's time runs until the next
+        statement starts or the instrumented method running it returns, which includes fetching its rows.
+        """
+        if statement.startswith('--'):
+            # statements run by triggers are reported as comments, their time belongs to the statement firing them
+            cls.count('sql trigger statements')
+            return
+        cls._close_statement()
+        cls._statement.current = (re.sub(r'\s+', ' ', statement).strip()[:SQL_TEXT_LENGTH], default_timer())
+
+    @classmethod
+    def _close_statement(cls):
+        current = getattr(cls._statement, 'current', None)
+        if current is not None:
+            cls._statement.current = None
+            cls._record('sql', current[0], default_timer() - current[1])
+
+    @classmethod
+    def report(cls):
+        """
+        :return: collected timings of each phase, with the totals of all phases
+        :rtype: dict
+        """
+        cls._close_statement()
+        with cls.lock:
+            phases = OrderedDict((name, phase.to_dict()) for name, phase in cls.phases.items())
+        return {'total_seconds': sum(phase['seconds'] for phase in phases.values()), 'phases': phases}
+
+    @classmethod
+    def write_json(cls, output_path, extra=None):
+        """
+        Write the report to a JSON file
+        :param output_path: full path of the JSON file
+        :type output_path: str
+        :param extra: additional top level entries of the report, ie. cache stats
+        :type extra: dict
+        :return: None
+        """
+        report = cls.report()
+        report.update(extra or {})
+        with open(output_path, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    @classmethod
+    def print_report(cls, stream=sys.stderr, top=10):
+        """
+        Print a per-phase breakdown of the report, with the slowest methods and SQL statements of each phase
+        :param stream: stream we want to print to
+        :type stream: file
+        :param top: max number of methods/statements listed per phase
+        :type top: int
+        :return: None
+        """
+        report = cls.report()
+        total = report['total_seconds'] or 1.0
+        stream.write("\n=== PROFILE === {:.2f} ms total\n".format(report['total_seconds'] * 1000.0))
+        for name, phase in report['phases'].items():
+            if name == 'unphased' and not phase['timers'] and not phase['sql']:
+                continue
+            stream.write("\n{:<40} {:>10.2f} ms {:>6.1f}%\n".format(name, phase['seconds'] * 1000.0,
+                                                                     100.0 * phase['seconds'] / total))
+            for title, entries in [("methods", phase['timers']), ("sql", phase['sql'])]:
+                for entry_name, stats in sorted(entries.items(), key=lambda item: -item[1]['total_ms'])[:top]:
+                    stream.write("  {:<5} {:<60} {:>7} calls {:>10.2f} ms {:>9.2f} max\n"
+                                 .format(title, entry_name[:60], stats['calls'], stats['total_ms'],
+                                         stats['max_ms']))
+            for counter, value in sorted(phase['counters'].items()):
+                stream.write("  {:<5} {:<60} {:>7}\n".format("count", counter[:60], value))
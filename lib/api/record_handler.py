@@ -1,13 +1,350 @@
-
 import os
+import json
+import base64
 import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from auth import WriteAuthRuleHandler, WriteAuthRules, UniquenessIndex
+from cache import QueryCache
 from conf import AppConfig, RECORDS_TABLE, DB_NAME
+from connection import ConnectionManager
+from search import FullTextSearch
+from lib.utils import iter_batches, phone_number_to_integer_stream
+
+# per-batch outcome of a bulk write (batch index, number of records written, number rejected by auth rule)
+BatchWriteResult = namedtuple('BatchWriteResult', ['batch', 'accepted', 'rejected'])
+# outcome of a single write, always truthy so it can still be used as a success flag
+WriteResult = namedtuple('WriteResult', ['rowcount'])
+# one page of records, and the keyset cursor of the next page (None on the last page)
+RecordPage = namedtuple('RecordPage', ['records', 'next_after'])
+# bulk mutation rule: the records matching query (see RecordMatch for match) get the non-empty fields of change
+# set, or are deleted when change is None. See DatabaseRecordWriter.apply_rules
+MutationRule = namedtuple('MutationRule', ['query', 'change', 'match'])
+
+RECORD_FIELDS = ('name', 'phone', 'address')
+PHONE_DIGITS = 10
+
+# schema migrations, applied in order by DatabaseRecordWriter.create_records_database. The entry at index N
+# upgrades the db from schema version N to N + 1, and the current version is kept in the user_version pragma.
+SCHEMA_MIGRATIONS = [
+    # 1: typed columns, rowid primary key and indexes, replacing the original untyped (name, phone, address) table
+    """
+    CREATE TABLE IF NOT EXISTS {table}(name, phone, address);
+    ALTER TABLE {table} RENAME TO {table}_v0;
+    CREATE TABLE {table}(id INTEGER PRIMARY KEY, name TEXT, phone INTEGER, address TEXT);
+    INSERT INTO {table}(name, phone, address) SELECT name, phone, address FROM {table}_v0 ORDER BY rowid;
+    DROP TABLE {table}_v0;
+    CREATE INDEX {table}_name_idx ON {table}(name);
+    CREATE INDEX {table}_phone_idx ON {table}(phone);
+    CREATE INDEX {table}_address_idx ON {table}(address);
+    """,
+    # 2: append-only change log filled by triggers, so every write path is tracked for delta exports (see lib.api.delta)
+    """
+    CREATE TABLE {table}_changelog(seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, record_id INTEGER NOT NULL,
+                                   name TEXT, phone INTEGER, address TEXT,
+                                   old_name TEXT, old_phone INTEGER, old_address TEXT);
+    CREATE TRIGGER {table}_changelog_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {table}_changelog(op, record_id, name, phone, address)
+            VALUES('insert', new.id, new.name, new.phone, new.address);
+    END;
+    CREATE TRIGGER {table}_changelog_update AFTER UPDATE ON {table} BEGIN
+        INSERT INTO {table}_changelog(op, record_id, name, phone, address, old_name, old_phone, old_address)
+            VALUES('update', new.id, new.name, new.phone, new.address, old.name, old.phone, old.address);
+    END;
+    CREATE TRIGGER {table}_changelog_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {table}_changelog(op, record_id, old_name, old_phone, old_address)
+            VALUES('delete', old.id, old.name, old.phone, old.address);
+    END;
+    """,
+]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+# per-connection scratch tables of DatabaseRecordWriter.apply_rules: the rules, every (record, rule) match, the
+# record each rule ends up changing, as a record is only changed by the first rule matching it, and the unique
+# values rule_values is asked about
+BULK_TABLES = """
+    CREATE TEMP TABLE IF NOT EXISTS bulk_rules(rule INTEGER PRIMARY KEY, shape INTEGER, op TEXT,
+                                               name TEXT, name_end TEXT, phone_low INTEGER, phone_high INTEGER,
+                                               phone_text TEXT, address TEXT, address_end TEXT,
+                                               new_name TEXT, new_phone INTEGER, new_address TEXT);
+    CREATE TEMP TABLE IF NOT EXISTS bulk_matches(id INTEGER, rule INTEGER);
+    CREATE TEMP TABLE IF NOT EXISTS bulk_targets(id INTEGER PRIMARY KEY, rule INTEGER, op TEXT,
+                                                 new_name TEXT, new_phone INTEGER, new_address TEXT);
+    CREATE TEMP TABLE IF NOT EXISTS bulk_keys(name TEXT, phone INTEGER, address TEXT);
+"""
+BULK_RULE_COLUMNS = ('name', 'name_end', 'phone_low', 'phone_high', 'phone_text', 'address', 'address_end')
+
+
+class RecordMatch(object):
+    """
+    How the fields of a query record are matched against the stored records. Only exact and prefix
+    matches can use the table indexes, substring matches need a full table scan.
+    """
+    SUBSTRING = 1
+    PREFIX    = 2
+    EXACT     = 3
+    # leading digits of the phone (ie. area code, or area code + exchange) as a range scan of the phone index,
+    # substring matches for the other fields
+    PHONE_PREFIX = 4
+
+    ALL_MATCHES = [SUBSTRING, PREFIX, EXACT, PHONE_PREFIX]
+    BY_NAME = {'substring': SUBSTRING, 'prefix': PREFIX, 'exact': EXACT, 'phone_prefix': PHONE_PREFIX}
+
+    @classmethod
+    def for_field(cls, field, match):
+        """
+        :return: how a single field is matched by a match type, one of SUBSTRING, PREFIX and EXACT
+        :rtype: int
+        """
+        if match == cls.PHONE_PREFIX:
+            return cls.PREFIX if field == 'phone' else cls.SUBSTRING
+        return match
+
+
+class RecordOrder(object):
+    """
+    Orders records can be returned in. Every order breaks ties by id, which keeps keyset pagination
+    stable, and each one is backed by an index.
+    """
+    ID      = 'id'
+    NAME    = 'name'
+    PHONE   = 'phone'
+    ADDRESS = 'address'
+
+    ALL_ORDERS = [ID, NAME, PHONE, ADDRESS]
+
+
+def build_page_clause(order_by=None, after=None, limit=None, offset=0):
+    """
+    Build the keyset/ordering/limit part of a record query, appended to the WHERE clause of build_record_filter.
+    Records after a keyset cursor are found with an index range instead of skipping over the previous pages,
+    so every page costs the same however deep it is, unlike offset.
+    :param order_by: field records are ordered by, see RecordOrder. Records are unordered if not provided.
+    :type order_by: str
+    :param after: keyset cursor of the last record of the previous page, (id,) when ordered by id,
+                  (field value, id) otherwise, see RecordPage.next_after
+    :type after: tuple
+    :param limit: max number of records
+    :type limit: int
+    :param offset: number of matching records to skip
+    :type offset: int
+    :return: extra WHERE condition, its parameters, and ORDER BY/LIMIT clause
+    :rtype: tuple
+    """
+    if order_by is None and after is not None:
+        order_by = RecordOrder.ID
+    if order_by is not None and order_by not in RecordOrder.ALL_ORDERS:
+        raise ValueError("Invalid record order provided. Supported orders: {}".format(RecordOrder.ALL_ORDERS))
+    if limit is not None and limit < 0 or offset < 0:
+        raise ValueError("Invalid limit/offset provided. Please use positive integers.")
+    condition, params = "", ()
+    if after is not None:
+        after = tuple(after) if isinstance(after, (tuple, list)) else (after,)
+        if order_by == RecordOrder.ID:
+            condition, params = " and id > ?", (after[-1],)
+        elif after[0] is None:
+            # NULLs sort first, so the rest of the NULLs come before every non NULL value
+            condition, params = " and (({field} IS NULL and id > ?) or {field} IS NOT NULL)".format(field=order_by), \
+                                (after[-1],)
+        else:
+            condition, params = " and ({field} > ? or ({field} = ? and id > ?))".format(field=order_by), \
+                                (after[0], after[0], after[-1])
+    tail = ""
+    if order_by is not None:
+        tail += " ORDER BY id" if order_by == RecordOrder.ID else " ORDER BY {}, id".format(order_by)
+    if limit is not None or offset:
+        tail += " LIMIT {:d}".format(limit if limit is not None else -1)
+    if offset:
+        tail += " OFFSET {:d}".format(offset)
+    return condition, params, tail
+
+
+def encode_page_cursor(after):
+    """
+    Encode a keyset cursor as an opaque token, ie. to print it for the next CLI call
+    :param after: keyset cursor, see RecordPage.next_after
+    :type after: tuple
+    :return: cursor token
+    :rtype: str
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(after)).encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(token):
+    """
+    Decode a cursor token made by encode_page_cursor
+    :param token: cursor token
+    :type token: str
+    :return: keyset cursor
+    :rtype: tuple
+    """
+    try:
+        after = json.loads(base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page cursor provided. Please use the cursor printed with the previous page.")
+    if not isinstance(after, list) or not 1 <= len(after) <= 2:
+        raise ValueError("Invalid page cursor provided. Please use the cursor printed with the previous page.")
+    return tuple(after)
+
+
+def build_record_filter(query_record, match=RecordMatch.SUBSTRING):
+    """
+    Query planner for record lookups. Builds the WHERE clause matching the fields provided in our query record,
+    picking an index-friendly comparison for each field when the match type allows it. Fields which aren't
+    provided are not filtered on.
+    :param query_record: record to use as query data
+    :type query_record: DatabaseRecord
+    :param match: how the query fields are matched, see RecordMatch
+    :type match: int
+    :return: WHERE clause and its parameters
+    :rtype: tuple
+    """
+    if match not in RecordMatch.ALL_MATCHES:
+        raise ValueError("Invalid match type provided. Please use one of RecordMatch.ALL_MATCHES.")
+    clauses, params = [], []
+    for field in RECORD_FIELDS:
+        value = getattr(query_record, field)
+        if value is None or value == "":
+            continue
+        field_match = RecordMatch.for_field(field, match)
+        if field == 'phone':
+            clause, args = _phone_filter(value, field_match)
+        elif field_match == RecordMatch.EXACT:
+            clause, args = "{} = ?".format(field), (value,)
+        elif field_match == RecordMatch.PREFIX:
+            clause, args = "{0} >= ? and {0} < ?".format(field), (value, _prefix_upper_bound(value))
+        else:
+            clause, args = "instr({}, ?)".format(field), (value,)
+        clauses.append(clause)
+        params.extend(args)
+    return " and ".join(clauses) or "1", tuple(params)
+
+
+def build_rule_join(query_record, match=RecordMatch.SUBSTRING):
+    """
+    Set-based counterpart of build_record_filter, matching the records table (r) against the query values stored in
+    a row of the bulk_rules table (u) rather than against literal values, so every rule of the same shape is matched
+    in a single join which can still use the table indexes.
+    :param query_record: record to use as query data
+    :type query_record: DatabaseRecord
+    :param match: how the query fields are matched, see RecordMatch
+    :type match: int
+    :return: join condition, empty if no field is provided, and the values of the bulk_rules query columns
+    :rtype: tuple
+    """
+    if match not in RecordMatch.ALL_MATCHES:
+        raise ValueError("Invalid match type provided. Please use one of RecordMatch.ALL_MATCHES.")
+    clauses, columns = [], {}
+    for field in RECORD_FIELDS:
+        value = getattr(query_record, field)
+        if value is None or value == "":
+            continue
+        field_match = RecordMatch.for_field(field, match)
+        if field == 'phone':
+            digits = str(value)
+            if digits.isdigit() and (field_match == RecordMatch.EXACT or len(digits) == PHONE_DIGITS):
+                columns['phone_low'] = columns['phone_high'] = int(digits)
+            elif digits.isdigit() and field_match == RecordMatch.PREFIX and len(digits) < PHONE_DIGITS:
+                columns['phone_low'], columns['phone_high'] = phone_prefix_range(digits)
+            else:
+                columns['phone_text'] = digits
+                clauses.append("instr(r.phone, u.phone_text)")
+                continue
+            clauses.append("r.phone BETWEEN u.phone_low AND u.phone_high")
+        elif field_match == RecordMatch.EXACT:
+            columns[field] = value
+            clauses.append("r.{0} = u.{0}".format(field))
+        elif field_match == RecordMatch.PREFIX:
+            columns[field], columns[field + '_end'] = value, _prefix_upper_bound(value)
+            clauses.append("r.{0} >= u.{0} and r.{0} < u.{0}_end".format(field))
+        else:
+            columns[field] = value
+            clauses.append("instr(r.{0}, u.{0})".format(field))
+    return " and ".join(clauses), columns
+
+
+def read_mutation_rules(input_path, match=RecordMatch.SUBSTRING):
+    """
+    Read bulk mutation rules from a CSV mapping file, one rule per row. The header names the columns: name, phone
+    and address hold the query fields, new_name, new_phone and new_address the values they're changed to, and the
+    optional match (exact, prefix, substring) and op (update, delete) columns override the default match and the
+    update op of a row.
+    :param input_path: path of the CSV mapping file
+    :type input_path: str
+    :param match: how query fields are matched when a row has no match, see RecordMatch
+    :type match: int
+    :return: rules in file order
+    :rtype: list
+    """
+    import csv
+    phone = lambda value: phone_number_to_integer_stream(value) if value else None
+    rules = []
+    with open(input_path, 'r') as csvfile:
+        for line, row in enumerate(csv.DictReader(csvfile), 2):
+            op = (row.get("op") or "update").strip().lower()
+            if op not in ("update", "delete"):
+                raise ValueError("Invalid op on line {} of {}: {!r}. Please use update or delete."
+                                 .format(line, input_path, op))
+            row_match = (row.get("match") or "").strip().lower()
+            if row_match and row_match not in RecordMatch.BY_NAME:
+                raise ValueError("Invalid match on line {} of {}: {!r}. Supported matches: {}"
+                                 .format(line, input_path, row_match, sorted(RecordMatch.BY_NAME)))
+            query = DatabaseRecord(row.get("name") or None, phone(row.get("phone")), row.get("address") or None)
+            change = None
+            if op == "update":
+                change = DatabaseRecord(row.get("new_name") or None, phone(row.get("new_phone")),
+                                        row.get("new_address") or None)
+            rules.append(MutationRule(query, change, RecordMatch.BY_NAME[row_match] if row_match else match))
+    return rules
+
+
+def _phone_filter(phone, match):
+    """
+    Phones are stored as 10 digit integers, so a complete number can always be looked up exactly and
+    a leading part of a number maps to a range of the phone index.
+    """
+    digits = str(phone)
+    if not digits.isdigit():
+        return "instr(phone, ?)", (digits,)
+    if match == RecordMatch.EXACT or len(digits) == PHONE_DIGITS:
+        return "phone = ?", (int(digits),)
+    if match == RecordMatch.PREFIX and len(digits) < PHONE_DIGITS:
+        return "phone BETWEEN ? AND ?", phone_prefix_range(digits)
+    return "instr(phone, ?)", (digits,)
+
+
+def phone_prefix_range(prefix):
+    """
+    Range of the stored phones starting with a prefix, ie. 647 => (6470000000, 6479999999)
+    :param prefix: leading digits of a phone
+    :type prefix: object
+    :return: lowest and highest phone starting with the prefix
+    :rtype: tuple
+    """
+    digits = str(prefix)
+    if not digits.isdigit() or len(digits) > PHONE_DIGITS:
+        raise ValueError("Invalid phone prefix provided: {!r}. Please use up to {} digits."
+                         .format(prefix, PHONE_DIGITS))
+    return int(digits.ljust(PHONE_DIGITS, '0')), int(digits.ljust(PHONE_DIGITS, '9'))
+
+
+def _prefix_upper_bound(prefix):
+    """
+    Smallest string greater than every string starting with prefix, used to turn a prefix into an index range
+    """
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode('utf-8')
+    return prefix[:-1] + u"%c" % (ord(prefix[-1]) + 1)
 
 
 class DatabaseRecord(object):
     """
     Simple class to hold our record data
     """
+    # records are created by the million when streaming, so skip the per instance __dict__
+    __slots__ = ('name', 'phone', 'address')
+
     def __str__(self):
         return "{} {} {}".format(self.name, self.phone, self.address)
 
@@ -17,66 +354,437 @@ class DatabaseRecord(object):
         self.address = address
 
 
-class DatabaseRecordReader(object):
+class DatabaseRecordHandler(object):
+    """
+    Base class for the record readers/writers, giving access to the records database
+    """
+    database_path       = os.path.join(AppConfig.data_directory, DB_NAME)
+    records_table       = RECORDS_TABLE
+    query_caches        = {}
+    query_caches_lock   = threading.Lock()
+
+    @classmethod
+    def connection(cls):
+        """
+        Get the calling thread's connection to the records database, opened on first use. See
+        ConnectionManager for how connections are pooled and configured.
+        :return: connection to the database
+        :rtype: Connection
+        """
+        return ConnectionManager.for_path(cls.database_path).connection()
+
+    @classmethod
+    def release_connection(cls):
+        """
+        Return the calling thread's connection to the pool, for threads done with the database
+        :return: None
+        """
+        ConnectionManager.for_path(cls.database_path).release()
+
+    @classmethod
+    def query_cache(cls):
+        """
+        Get the query result cache of the records table, shared by its readers and writers. The cache is
+        (re)created from the AppConfig query cache settings, and disabled when query_cache_size is 0.
+        :return: query result cache, or None if disabled
+        :rtype: QueryCache
+        """
+        if not AppConfig.query_cache_size:
+            return None
+        key = (cls.database_path, cls.records_table)
+        with cls.query_caches_lock:
+            cache = cls.query_caches.get(key)
+            if cache is None or (cache.max_entries, cache.ttl) != (AppConfig.query_cache_size,
+                                                                   AppConfig.query_cache_ttl):
+                cache = cls.query_caches[key] = QueryCache(AppConfig.query_cache_size, AppConfig.query_cache_ttl)
+            return cache
+
+    @classmethod
+    def invalidate_query_cache(cls):
+        """
+        Drop the cached query results of the records table. Writers call this after every commit.
+        :return: None
+        """
+        cache = cls.query_caches.get((cls.database_path, cls.records_table))
+        if cache is not None:
+            cache.invalidate()
+
+
+class DatabaseRecordReader(DatabaseRecordHandler):
     """
     Class responsible for all read operations in database
     """
-    database_path   = os.path.join(AppConfig.data_directory, DB_NAME)
-    database_driver = sqlite3.connect(database_path)
-    records_table   = RECORDS_TABLE
+    fetch_size      = 1000
 
     @classmethod
-    def get_all_records(cls):
+    def get_all_records(cls, limit=None, after=None, order_by=None, offset=0):
         """
-        Fetch all the records currently stored in the database
+        Fetch all the records currently stored in the database, see iter_all_records
         :return: all records
         :rtype: list
         """
-        cursor = cls.database_driver.cursor()
-        cursor.execute("SELECT * FROM {table}".format(table=cls.records_table))
-        results = cursor.fetchall()
-        cursor.close()
-        return results
+        return list(cls.iter_all_records(limit, after, order_by, offset))
+
+    @classmethod
+    def iter_all_records(cls, limit=None, after=None, order_by=None, offset=0):
+        """
+        Lazily fetch all the records currently stored in the database, fetch_size rows at a time,
+        so callers can stream through the table without loading it into memory
+        :param limit: max number of records
+        :type limit: int
+        :param after: keyset cursor to start after, see build_page_clause
+        :type after: tuple
+        :param order_by: field records are ordered by, see RecordOrder
+        :type order_by: str
+        :param offset: number of records to skip, prefer after for deep pages
+        :type offset: int
+        :return: generator of all records
+        :rtype: generator
+        """
+        return cls._iter_query("1", (), limit, after, order_by, offset)
 
     @classmethod
-    def get_records(cls, db_record):
+    def get_records(cls, db_record, match=RecordMatch.SUBSTRING, limit=None, after=None, order_by=None, offset=0):
         """
-        Fetch all the records in database based on the query data we provide as a record
+        Fetch all the records in database based on the query data we provide as a record. Results are
+        served from the query cache when the same query was run since the last write, see query_cache.
         :param db_record: record to use as query data for db
         :type db_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :param limit: max number of records
+        :type limit: int
+        :param after: keyset cursor to start after, see build_page_clause
+        :type after: tuple
+        :param order_by: field records are ordered by, see RecordOrder
+        :type order_by: str
+        :param offset: number of records to skip, prefer after for deep pages
+        :type offset: int
         :return: records matching query criteria
         :rtype: list
         """
-        cursor = cls.database_driver.cursor()
-        cursor.execute("SELECT * FROM {table} WHERE instr(name, ?) and instr(phone, ?) and instr(address, ?)"
-                       .format(table=cls.records_table),
-                       ("" if not db_record.name else db_record.name,
-                        "" if not db_record.phone else db_record.phone,
-                        "" if not db_record.address else db_record.address))
-        results = cursor.fetchall()
-        cursor.close()
-        return results
+        cache = cls.query_cache()
+        if cache is None:
+            return list(cls.iter_records(db_record, match, limit, after, order_by, offset))
+        # the SQL clauses are the normalized form of the query, equal clauses always return equal records
+        key = build_record_filter(db_record, match) + build_page_clause(order_by, after, limit, offset)
+        generation = cache.generation
+        found, records = cache.get(key)
+        if not found:
+            records = list(cls.iter_records(db_record, match, limit, after, order_by, offset))
+            cache.put(key, records, generation)
+        return list(records)
 
+    @classmethod
+    def iter_records(cls, db_record, match=RecordMatch.SUBSTRING, limit=None, after=None, order_by=None, offset=0):
+        """
+        Lazily fetch the records in database based on the query data we provide as a record, fetch_size rows at a time
+        :param db_record: record to use as query data for db
+        :type db_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :param limit: max number of records
+        :type limit: int
+        :param after: keyset cursor to start after, see build_page_clause
+        :type after: tuple
+        :param order_by: field records are ordered by, see RecordOrder
+        :type order_by: str
+        :param offset: number of records to skip, prefer after for deep pages
+        :type offset: int
+        :return: generator of records matching query criteria
+        :rtype: generator
+        """
+        where, params = build_record_filter(db_record, match)
+        return cls._iter_query(where, params, limit, after, order_by, offset)
 
-class DatabaseRecordWriter(object):
+    @classmethod
+    def get_page(cls, db_record=None, match=RecordMatch.SUBSTRING, limit=100, after=None, order_by=RecordOrder.ID):
+        """
+        Fetch one page of the records matching our query data, along with the cursor of the next page
+        :param db_record: record to use as query data for db, all records if not provided
+        :type db_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :param limit: number of records per page
+        :type limit: int
+        :param after: cursor of the page, next_after of the previous page, None for the first page
+        :type after: tuple
+        :param order_by: field records are ordered by, see RecordOrder
+        :type order_by: str
+        :return: records of the page, and cursor of the next one
+        :rtype: RecordPage
+        """
+        if limit < 1:
+            raise ValueError("Invalid page size provided. Please use a positive integer.")
+        where, params = build_record_filter(db_record or DatabaseRecord(), match)
+        condition, page_params, tail = build_page_clause(order_by, after, limit + 1)
+        cursor = cls.connection().cursor()
+        try:
+            cursor.execute("SELECT name, phone, address, id FROM {table} WHERE {where}{condition}{tail}"
+                           .format(table=cls.records_table, where=where, condition=condition, tail=tail),
+                           params + page_params)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        next_after = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_after = (last[3],) if order_by == RecordOrder.ID else (last[RECORD_FIELDS.index(order_by)], last[3])
+        return RecordPage([row[:3] for row in rows[:limit]], next_after)
+
+    @classmethod
+    def _iter_query(cls, where, params, limit, after, order_by, offset):
+        condition, page_params, tail = build_page_clause(order_by, after, limit, offset)
+        return cls._iter_cursor("SELECT name, phone, address FROM {table} WHERE {where}{condition}{tail}"
+                                .format(table=cls.records_table, where=where, condition=condition, tail=tail),
+                                params + page_params)
+
+    @classmethod
+    def _iter_cursor(cls, query, params):
+        cursor = cls.connection().cursor()
+        try:
+            cursor.execute(query, params)
+            results = cursor.fetchmany(cls.fetch_size)
+            while results:
+                for result in results:
+                    yield result
+                results = cursor.fetchmany(cls.fetch_size)
+        finally:
+            cursor.close()
+
+    @classmethod
+    def count_phone_prefixes(cls, digits, within=None):
+        """
+        Count the records per phone prefix of a given length (3 digits for area codes, 6 for area code + exchange),
+        in prefix order. Only the phone index is read: each prefix is found by seeking to the first phone after the
+        previous prefix, and its records counted with a range scan of the index, so no table row is read and no
+        GROUP BY sort is needed.
+        :param digits: number of leading digits of the prefixes
+        :type digits: int
+        :param within: only count the phones starting with this shorter prefix, ie. an area code for exchanges
+        :type within: object
+        :return: (prefix, record count) pairs, prefixes as integers
+        :rtype: list
+        """
+        if not 0 < digits < PHONE_DIGITS:
+            raise ValueError("Invalid prefix length provided. Please use 1 to {} digits.".format(PHONE_DIGITS - 1))
+        low, high = phone_prefix_range(within) if within not in (None, "") else (0, 10 ** PHONE_DIGITS - 1)
+        step = 10 ** (PHONE_DIGITS - digits)
+        seek = "SELECT phone FROM {table} WHERE phone BETWEEN ? AND ? ORDER BY phone LIMIT 1" \
+            .format(table=cls.records_table)
+        count = "SELECT count(*) FROM {table} WHERE phone BETWEEN ? AND ?".format(table=cls.records_table)
+        counts = []
+        cursor = cls.connection().cursor()
+        try:
+            first = cursor.execute(seek, (low, high)).fetchone()
+            while first is not None:
+                prefix = first[0] // step
+                prefix_high = min(high, (prefix + 1) * step - 1)
+                counts.append((prefix, cursor.execute(count, (first[0], prefix_high)).fetchone()[0]))
+                first = cursor.execute(seek, (prefix_high + 1, high)).fetchone()
+        finally:
+            cursor.close()
+        return counts
+
+    @classmethod
+    def count_area_codes(cls):
+        """
+        :return: (area code, record count) pairs, see count_phone_prefixes
+        :rtype: list
+        """
+        return cls.count_phone_prefixes(3)
+
+    @classmethod
+    def count_exchanges(cls, area_code=None):
+        """
+        :param area_code: only count the exchanges of this area code
+        :type area_code: object
+        :return: (area code + exchange, record count) pairs, ie. (647555, 12), see count_phone_prefixes
+        :rtype: list
+        """
+        return cls.count_phone_prefixes(6, area_code)
+
+    @classmethod
+    def search_records(cls, text, limit=20, fuzzy=False):
+        """
+        Full text search of all record fields, best matches first. Needs the full text search
+        index, which DatabaseRecordWriter.create_records_database sets up when SQLite supports it.
+        :param text: text we want to search for
+        :type text: str
+        :param limit: max number of results
+        :type limit: int
+        :param fuzzy: whether slightly misspelled text should still match, see FullTextSearch.search
+        :type fuzzy: bool
+        :return: matching records, best match first
+        :rtype: list
+        """
+        return FullTextSearch.search(cls.connection(), cls.records_table, text, limit, fuzzy)
+
+
+class DatabaseRecordWriter(DatabaseRecordHandler):
     """
     Class responsible for all write operations in database
     """
-    database_path   = os.path.join(AppConfig.data_directory, DB_NAME)
-    database_driver = sqlite3.connect(database_path)
-    records_table   = RECORDS_TABLE
+    batch_size          = 1000
+    uniqueness_indexes  = {}
+    # database paths each thread has an open transaction() on
+    transactions        = threading.local()
+
+    @classmethod
+    def in_transaction(cls):
+        return cls.database_path in getattr(cls.transactions, 'paths', ())
+
+    @classmethod
+    def commit(cls, connection):
+        """
+        Commit the writes made through our connection, unless the calling thread groups them in a transaction(),
+        which commits them all at once when it ends
+        :param connection: connection the writes were made through
+        :type connection: Connection
+        :return: None
+        """
+        if not cls.in_transaction():
+            connection.commit()
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """
+        Context manager grouping every write the calling thread makes in the block into a single transaction,
+        committed when the block ends, or rolled back if it raises. Nested blocks join the outer transaction.
+        The uniqueness index, if enabled, is reloaded after a rollback, as it was updated write by write.
+        The transaction is started explicitly, with the sqlite3 module's implicit transactions turned off for the
+        block, as Python 2 commits the open transaction before any statement it doesn't know, like SAVEPOINT.
+        """
+        if cls.in_transaction():
+            yield cls.connection()
+            return
+        paths = cls.transactions.__dict__.setdefault('paths', set())
+        connection = cls.connection()
+        cls.create_bulk_tables(connection)
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        connection.execute("BEGIN")
+        paths.add(cls.database_path)
+        try:
+            yield connection
+            paths.discard(cls.database_path)
+            connection.commit()
+        except BaseException:
+            paths.discard(cls.database_path)
+            connection.rollback()
+            cls.reload_uniqueness_index()
+            raise
+        finally:
+            connection.isolation_level = isolation_level
+            cls.invalidate_query_cache()
+
+    @classmethod
+    @contextmanager
+    def savepoint(cls):
+        """
+        Context manager rolling back every write the calling thread makes in the block if it raises, without
+        ending the transaction() it runs in, so a failed step of a transaction leaves nothing behind. Outside of
+        a transaction(), the block runs in a transaction of its own.
+        """
+        if not cls.in_transaction():
+            with cls.transaction() as connection:
+                yield connection
+            return
+        connection = cls.connection()
+        connection.execute("SAVEPOINT step")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK TO step")
+            connection.execute("RELEASE step")
+            cls.reload_uniqueness_index()
+            cls.invalidate_query_cache()
+            raise
+        connection.execute("RELEASE step")
+
+    @classmethod
+    def reload_uniqueness_index(cls):
+        """
+        Reload the uniqueness index, if enabled, after writes it was told about were rolled back
+        :return: None
+        """
+        index = cls.uniqueness_index()
+        if index is not None:
+            cls.enable_uniqueness_index(index.verify)
+
+    @classmethod
+    def enable_uniqueness_index(cls, verify=False):
+        """
+        Load an in-memory uniqueness index of the records table, which the writer keeps up to date on every
+        add/update/delete and which answers write authority rule checks instead of the db. Only valid while this
+        process is the only writer of the db.
+        :param verify: whether every rule check should also be run against the db, raising on any mismatch
+        :type verify: bool
+        :return: loaded index
+        :rtype: UniquenessIndex
+        """
+        cursor = cls.connection().cursor()
+        try:
+            index = UniquenessIndex.load(cls.records_table, cursor, verify)
+        finally:
+            cursor.close()
+        cls.uniqueness_indexes[(cls.database_path, cls.records_table)] = index
+        return index
+
+    @classmethod
+    def disable_uniqueness_index(cls):
+        cls.uniqueness_indexes.pop((cls.database_path, cls.records_table), None)
+
+    @classmethod
+    def uniqueness_index(cls):
+        """
+        Get the uniqueness index of the records table, if it's been enabled
+        :return: uniqueness index, or None
+        :rtype: UniquenessIndex
+        """
+        return cls.uniqueness_indexes.get((cls.database_path, cls.records_table))
+
+    @classmethod
+    def matching_rows(cls, cursor, query_record, match=RecordMatch.SUBSTRING):
+        """
+        Fetch the rows a delete/update with the same query is about to change, so the uniqueness index
+        can be updated once it's committed. Skips the query if no index is enabled.
+        :return: (name, phone, address) rows matching the query
+        :rtype: list
+        """
+        if cls.uniqueness_index() is None:
+            return []
+        where, params = build_record_filter(query_record, match)
+        cursor.execute("SELECT name, phone, address FROM {table} WHERE {where}"
+                       .format(table=cls.records_table, where=where), params)
+        return cursor.fetchall()
 
     @classmethod
     def create_records_database(cls):
         """
-        Create our default tables for the application
+        Create our default tables for the application, or migrate existing ones to the
+        current schema version by running any SCHEMA_MIGRATIONS the db hasn't had yet
         :return: setup success
         :rtype: bool
         """
-        cursor = cls.database_driver.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS {table}(name, phone, address)".format(table=cls.records_table))
-        cls.database_driver.commit()
+        connection = cls.connection()
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA user_version")
+        current_version = cursor.fetchone()[0]
         cursor.close()
+        for version, migration in enumerate(SCHEMA_MIGRATIONS[current_version:], current_version + 1):
+            try:
+                connection.executescript("BEGIN; {migration} PRAGMA user_version = {version}; COMMIT;"
+                                         .format(migration=migration.format(table=cls.records_table),
+                                                 version=version))
+            except sqlite3.Error:
+                connection.rollback()
+                raise
+        # probing for FTS5 support creates a table, so skip it once the index exists
+        if not FullTextSearch.has_index(connection, cls.records_table) and FullTextSearch.is_supported(connection):
+            FullTextSearch.create_index(connection, cls.records_table)
+        cls.invalidate_query_cache()
         return True
 
     @classmethod
@@ -85,34 +793,94 @@ class DatabaseRecordWriter(object):
         Add a new record to the database
         :param db_record: record we want to add
         :type db_record: DatabaseRecord
-        :return: write success
-        :rtype: bool
+        :return: number of added records
+        :rtype: WriteResult
         """
-        cursor = cls.database_driver.cursor()
-        cursor.execute("INSERT INTO {table} VALUES(?, ?, ?)"
+        connection = cls.connection()
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO {table}(name, phone, address) VALUES(?, ?, ?)"
                        .format(table=cls.records_table), (db_record.name, db_record.phone, db_record.address))
-        cls.database_driver.commit()
+        rowcount = cursor.rowcount
+        cls.commit(connection)
         cursor.close()
-        return True
+        cls.invalidate_query_cache()
+        if cls.uniqueness_index() is not None:
+            cls.uniqueness_index().add_records([db_record])
+        return WriteResult(rowcount)
+
+    @classmethod
+    def add_records(cls, db_records, batch_size=None, auth_rule=None):
+        """
+        Bulk add records to the database. Records are consumed lazily from the iterable we provide and
+        written with executemany, committing once per batch rather than once per record.
+        :param db_records: records we want to add
+        :type db_records: iterable
+        :param batch_size: number of records written per transaction (defaults to cls.batch_size)
+        :type batch_size: int
+        :param auth_rule: authority rule each batch is filtered with, all records are written if not provided
+        :type auth_rule: int
+        :return: accepted/rejected counts for each written batch
+        :rtype: list
+        """
+        results = []
+        index = cls.uniqueness_index()
+        connection = cls.connection()
+        cursor = connection.cursor()
+        try:
+            for batch in iter_batches(db_records, batch_size or cls.batch_size):
+                accepted, rejected = batch, []
+                if auth_rule is not None:
+                    accepted, rejected = WriteAuthRuleHandler.filter_records_with_auth_rule(cls.records_table, cursor,
+                                                                                          auth_rule, batch, index)
+                cls.insert_records(cursor, accepted)
+                cls.commit(connection)
+                cls.invalidate_query_cache()
+                if index is not None:
+                    index.add_records(accepted)
+                results.append(BatchWriteResult(len(results), len(accepted), len(rejected)))
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        return results
 
     @classmethod
-    def delete_record(cls, query_record):
+    def insert_records(cls, cursor, db_records):
+        """
+        Insert records with executemany, without committing, for callers managing their own transaction
+        :param cursor: cursor of the connection running the transaction
+        :type cursor: Cursor
+        :param db_records: records we want to insert
+        :type db_records: list
+        :return: None
+        """
+        cursor.executemany("INSERT INTO {table}(name, phone, address) VALUES(?, ?, ?)".format(table=cls.records_table),
+                           [(record.name, record.phone, record.address) for record in db_records])
+
+    @classmethod
+    def delete_record(cls, query_record, match=RecordMatch.SUBSTRING):
         """
         Delete records from the database based on our query data
         :param query_record: record we want to use as query data
         :type query_record: DatabaseRecord
-        :return: delete successful
-        :rtype: bool
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :return: number of deleted records
+        :rtype: WriteResult
         """
-        cursor = cls.database_driver.cursor()
-        cursor.execute("DELETE FROM {table} WHERE instr(name, ?) and instr(phone, ?) and instr(address, ?)"
-                       .format(table=cls.records_table),
-                       ("" if not query_record.name else query_record.name,
-                        "" if not query_record.phone else query_record.phone,
-                        "" if not query_record.address else query_record.address))
-        cls.database_driver.commit()
+        where, params = build_record_filter(query_record, match)
+        connection = cls.connection()
+        cursor = connection.cursor()
+        deleted = cls.matching_rows(cursor, query_record, match)
+        cursor.execute("DELETE FROM {table} WHERE {where}".format(table=cls.records_table, where=where), params)
+        rowcount = cursor.rowcount
+        cls.commit(connection)
         cursor.close()
-        return True
+        cls.invalidate_query_cache()
+        if deleted:
+            cls.uniqueness_index().remove_rows(deleted)
+        return WriteResult(rowcount)
 
     @classmethod
     def update_records(cls, field, query_record, updated_record):
@@ -123,16 +891,29 @@ class DatabaseRecordWriter(object):
         :type query_record: DatabaseRecord
         :param updated_record: updated record we want to set query results data to
         :type updated_record: DatabaseRecord
-        :return: update successful
-        :rtype: bool
+        :return: number of updated records
+        :rtype: WriteResult
         """
-        cursor = cls.database_driver.cursor()
-        cursor.execute("UPDATE {table} SET {field} = ? WHERE instr({field}, ?)".
-                       format(table=cls.records_table, field=field),
-                       (getattr(updated_record, field), getattr(query_record, field)))
-        cls.database_driver.commit()
+        if getattr(query_record, field) is None:
+            return WriteResult(0)
+        field_query = DatabaseRecord(**{field: getattr(query_record, field)})
+        where, params = build_record_filter(field_query)
+        connection = cls.connection()
+        cursor = connection.cursor()
+        updated_rows = cls.matching_rows(cursor, field_query)
+        cursor.execute("UPDATE {table} SET {field} = ? WHERE {where}".
+                       format(table=cls.records_table, field=field, where=where),
+                       (getattr(updated_record, field),) + params)
+        rowcount = cursor.rowcount
+        cls.commit(connection)
         cursor.close()
-        return True
+        cls.invalidate_query_cache()
+        if updated_rows:
+            column = RECORD_FIELDS.index(field)
+            cls.uniqueness_index().remove_rows(updated_rows)
+            cls.uniqueness_index().add_rows([row[:column] + (getattr(updated_record, field),) + row[column + 1:]
+                                             for row in updated_rows])
+        return WriteResult(rowcount)
 
     @classmethod
     def update_record_names(cls, query_record, updated_record):
@@ -147,24 +928,293 @@ class DatabaseRecordWriter(object):
         return cls.update_records('address', query_record, updated_record)
 
     @classmethod
-    def update_records_by_all_fields(cls, query_record, updated_record):
+    def update_records_by_all_fields(cls, query_record, updated_record, match=RecordMatch.SUBSTRING):
         """
         Update all records matching query criteria (any fields), and set equal to the updated record data
         :param query_record: record we want to use as query data
         :type query_record: DatabaseRecord
         :param updated_record: record we want to use to set query results data equal to
         :type updated_record: DatabaseRecord
-        :return: update successful
-        :rtype: bool
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :return: number of updated records
+        :rtype: WriteResult
         """
-        cursor = cls.database_driver.cursor()
-        cursor.execute("UPDATE {table} SET name = ?, phone = ?, address = ? "
-                       "WHERE instr(name, ?) and instr(phone, ?) and instr(address, ?)"
-                       .format(table=cls.records_table),
-                       (updated_record.name, updated_record.phone, updated_record.address,
-                        "" if not query_record.name else query_record.name,
-                        "" if not query_record.phone else query_record.phone,
-                        "" if not query_record.address else query_record.address))
-        cls.database_driver.commit()
+        connection = cls.connection()
+        cursor = connection.cursor()
+        updated_rows = cls.matching_rows(cursor, query_record, match)
+        rowcount = cls.update_all_fields(cursor, query_record, updated_record, match)
+        cls.commit(connection)
         cursor.close()
-        return True
+        cls.invalidate_query_cache()
+        if updated_rows:
+            cls.uniqueness_index().remove_rows(updated_rows)
+            cls.uniqueness_index().add_records([updated_record] * len(updated_rows))
+        return WriteResult(rowcount)
+
+    @classmethod
+    def create_bulk_tables(cls, connection):
+        """
+        Create the temp tables of apply_rules on a connection, if it doesn't have them yet. Python < 3.6 commits
+        the open transaction before any CREATE statement, so transaction() creates them before it starts.
+        :param connection: connection the tables are created on
+        :type connection: Connection
+        :return: None
+        """
+        if connection.execute("SELECT count(*) FROM sqlite_temp_master WHERE name = 'bulk_keys'").fetchone()[0]:
+            return
+        connection.executescript(BULK_TABLES)
+
+    @classmethod
+    def apply_rules(cls, rules, dry_run=False, auth_rule=None):
+        """
+        Update/delete the records matching a list of rules in a single transaction. The rules are loaded into a temp
+        table, matched against the records with one join per rule shape (the fields and match type of its query,
+        see build_rule_join), and applied with a single set-based UPDATE and DELETE. A record matching several
+        rules is only changed by the first one. With dry_run, the records each rule would change are counted
+        without writing anything.
+        :param rules: rules to apply, see MutationRule
+        :type rules: iterable
+        :param dry_run: whether to only count the records the rules would change
+        :type dry_run: bool
+        :param auth_rule: authority rule the updated records must satisfy, see reject_colliding_rules. Updates
+                          aren't checked if not provided.
+        :type auth_rule: int
+        :return: number of records each rule changed (or would change), in the order of the rules, None for the
+                 rules rejected by auth_rule
+        :rtype: list
+        """
+        shapes, rows = cls.rule_rows(rules)
+        if not rows:
+            return []
+
+        index = cls.uniqueness_index()
+        connection = cls.connection()
+        cls.create_bulk_tables(connection)
+        cursor = connection.cursor()
+        try:
+            cls.load_rule_targets(cursor, shapes, rows)
+            rejected = cls.reject_colliding_rules(cursor, auth_rule) if auth_rule is not None else set()
+            counts = [None if number in rejected else 0 for number in range(len(rows))]
+            for number, count in cursor.execute("SELECT rule, count(*) FROM temp.bulk_targets GROUP BY rule"):
+                counts[number] = count
+            if dry_run or not any(counts):
+                cls.commit(connection)
+                return counts
+
+            changed_rows = "SELECT r.name, r.phone, r.address FROM {table} r JOIN temp.bulk_targets t ON t.id = r.id" \
+                .format(table=cls.records_table)
+            old_rows = cursor.execute(changed_rows).fetchall() if index is not None else []
+            cursor.execute("DELETE FROM {table} WHERE id IN (SELECT id FROM temp.bulk_targets WHERE op = 'delete')"
+                           .format(table=cls.records_table))
+            cursor.execute("UPDATE {table} SET {assignments} WHERE id IN "
+                           "(SELECT id FROM temp.bulk_targets WHERE op = 'update')"
+                           .format(table=cls.records_table,
+                                   assignments=", ".join("{0} = coalesce((SELECT new_{0} FROM temp.bulk_targets t "
+                                                         "WHERE t.id = {1}.id), {0})".format(field, cls.records_table)
+                                                         for field in RECORD_FIELDS)))
+            new_rows = cursor.execute(changed_rows).fetchall() if index is not None else []
+            cls.commit(connection)
+        except sqlite3.Error:
+            if not cls.in_transaction():
+                connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        cls.invalidate_query_cache()
+        if index is not None:
+            index.remove_rows(old_rows)
+            index.add_rows(new_rows)
+        return counts
+
+    @staticmethod
+    def rule_rows(rules):
+        """
+        Check bulk rules, and turn them into temp.bulk_rules rows, see apply_rules
+        :param rules: rules to apply, see MutationRule
+        :type rules: iterable
+        :return: number of each rule shape (the join condition of its query), and the row of each rule
+        :rtype: tuple
+        """
+        shapes, rows = {}, []
+        for number, rule in enumerate(rules):
+            condition, columns = build_rule_join(rule.query, rule.match)
+            if not condition:
+                raise ValueError("Rule {} has no query fields. Please provide at least one field to match records "
+                                 "on.".format(number + 1))
+            change = rule.change
+            if change is not None and not any([change.name, change.phone, change.address]):
+                raise ValueError("Rule {} doesn't change any field. Please provide the new field values, or use "
+                                 "a delete rule.".format(number + 1))
+            rows.append((number, shapes.setdefault(condition, len(shapes)), "delete" if change is None else "update")
+                        + tuple(columns.get(column) for column in BULK_RULE_COLUMNS)
+                        + ((None, None, None) if change is None else (change.name, change.phone, change.address)))
+        return shapes, rows
+
+    @classmethod
+    def load_rule_targets(cls, cursor, shapes, rows):
+        """
+        Load rules into the temp tables of apply_rules, and match them against the records into temp.bulk_targets
+        :param cursor: cursor of a connection with the temp tables, see create_bulk_tables
+        :type cursor: Cursor
+        :param shapes: rule shapes, see rule_rows
+        :type shapes: dict
+        :param rows: temp.bulk_rules rows, see rule_rows
+        :type rows: list
+        :return: None
+        """
+        for table in ['bulk_rules', 'bulk_matches', 'bulk_targets']:
+            cursor.execute("DELETE FROM temp.{}".format(table))
+        cursor.executemany("INSERT INTO temp.bulk_rules(rule, shape, op, {columns}, new_name, new_phone, "
+                           "new_address) VALUES({params})"
+                           .format(columns=", ".join(BULK_RULE_COLUMNS),
+                                   params=", ".join("?" * (len(BULK_RULE_COLUMNS) + 6))), rows)
+        for condition, shape in shapes.items():
+            cursor.execute("INSERT INTO temp.bulk_matches(id, rule) SELECT r.id, u.rule FROM temp.bulk_rules u "
+                           "JOIN {table} r ON {condition} WHERE u.shape = ?"
+                           .format(table=cls.records_table, condition=condition), (shape,))
+        cursor.execute("INSERT INTO temp.bulk_targets(id, rule, op, new_name, new_phone, new_address) "
+                       "SELECT m.id, m.rule, u.op, u.new_name, u.new_phone, u.new_address "
+                       "FROM (SELECT id, min(rule) AS rule FROM temp.bulk_matches GROUP BY id) m "
+                       "JOIN temp.bulk_rules u ON u.rule = m.rule")
+
+    @classmethod
+    def final_values(cls, fields):
+        """
+        Query of the values of some fields each record will have once the rules of temp.bulk_targets are applied,
+        deleted records left out. rule is the number of the rule changing one of these fields of the record, NULL
+        for the records keeping their values.
+        :param fields: fields we want the values of
+        :type fields: tuple
+        :return: SQL query
+        :rtype: str
+        """
+        return "SELECT {values}, CASE WHEN {changed} THEN t.rule END AS rule FROM {table} r " \
+               "LEFT JOIN temp.bulk_targets t ON t.id = r.id WHERE t.op IS NULL OR t.op = 'update'" \
+            .format(values=", ".join("coalesce(t.new_{0}, r.{0}) AS {0}".format(field) for field in fields),
+                    changed=" OR ".join("t.new_{} IS NOT NULL".format(field) for field in fields),
+                    table=cls.records_table)
+
+    @staticmethod
+    def colliding_rules(sharing):
+        """
+        Pick the rules to reject among the records sharing values an authority rule needs to be unique. When a value
+        is only shared by the targets of several rules, the first of them keeps it if it sets it on a single
+        record, any other rule setting a shared value is rejected.
+        :param sharing: number of the rule changing each record sharing a value (None for the records keeping
+                        their values), keyed on the value
+        :type sharing: dict
+        :return: numbers of the rules to reject
+        :rtype: set
+        """
+        colliding = set()
+        for numbers in sharing.values():
+            if len(numbers) < 2:
+                continue
+            changed = [number for number in numbers if number is not None]
+            first = min(changed) if changed and None not in numbers and changed.count(min(changed)) == 1 else None
+            colliding.update(number for number in changed if number != first)
+        return colliding
+
+    @classmethod
+    def reject_colliding_rules(cls, cursor, auth_rule):
+        """
+        Drop the targets of the update rules which would leave two records with the same values for the fields an
+        authority rule needs to be unique from temp.bulk_targets, see apply_rules. Values are counted on the table
+        as it will be once the rules are applied (see final_values), and the rules to reject picked by
+        colliding_rules. Records of rejected rules keep their current values, which can collide with other rules
+        in turn, so rules are rejected until none collide.
+        :param cursor: cursor of the connection running apply_rules
+        :type cursor: Cursor
+        :param auth_rule: authority rule the updated records must satisfy
+        :type auth_rule: int
+        :return: numbers of the rejected rules
+        :rtype: set
+        """
+        fields = WriteAuthRules.RULE_FIELDS[auth_rule]
+        if not fields:
+            return set()
+        final = cls.final_values(fields)
+        # NULL never equals anything, so records missing a unique field never collide
+        duplicates = "SELECT f.rule, {keys} FROM ({final}) f JOIN (SELECT {fields} FROM ({final}) GROUP BY {fields} " \
+                     "HAVING count(*) > 1) d ON {join}" \
+            .format(keys=", ".join("f." + field for field in fields), final=final, fields=", ".join(fields),
+                    join=" AND ".join("f.{0} = d.{0}".format(field) for field in fields))
+        rejected = set()
+        while True:
+            sharing = {}
+            for row in cursor.execute(duplicates):
+                sharing.setdefault(row[1:], []).append(row[0])
+            colliding = cls.colliding_rules(sharing)
+            if not colliding:
+                return rejected
+            cursor.executemany("DELETE FROM temp.bulk_targets WHERE rule = ?", [(number,) for number in colliding])
+            rejected.update(colliding)
+
+    @classmethod
+    def rule_values(cls, rules, auth_rule, values=None):
+        """
+        Values of the fields an authority rule needs to be unique, as the records will have them once bulk rules are
+        applied, without writing anything. Used to check rules across several databases, see
+        ShardedRecordWriter.check_rules.
+        :param rules: rules to apply, see MutationRule
+        :type rules: list
+        :param auth_rule: authority rule the updated records must satisfy
+        :type auth_rule: int
+        :param values: values we want the records of, the values the rules set if not provided
+        :type values: set
+        :return: (number of the rule changing the values of the record, or None, values) of each record
+        :rtype: list
+        """
+        fields = WriteAuthRules.RULE_FIELDS[auth_rule]
+        shapes, rows = cls.rule_rows(rules)
+        if not fields or not rows or values is not None and not values:
+            return []
+        connection = cls.connection()
+        cls.create_bulk_tables(connection)
+        cursor = connection.cursor()
+        try:
+            cls.load_rule_targets(cursor, shapes, rows)
+            final = cls.final_values(fields)
+            if values is None:
+                # NULL never equals anything, so records missing a unique field never collide
+                query = "SELECT rule, {fields} FROM ({final}) WHERE rule IS NOT NULL AND {not_null}" \
+                    .format(fields=", ".join(fields), final=final,
+                            not_null=" AND ".join("{} IS NOT NULL".format(field) for field in fields))
+            else:
+                cursor.execute("DELETE FROM temp.bulk_keys")
+                cursor.executemany("INSERT INTO temp.bulk_keys({fields}) VALUES({params})"
+                                   .format(fields=", ".join(fields), params=", ".join("?" * len(fields))), values)
+                query = "SELECT f.rule, {keys} FROM ({final}) f JOIN temp.bulk_keys k ON {join}" \
+                    .format(keys=", ".join("f." + field for field in fields), final=final,
+                            join=" AND ".join("f.{0} = k.{0}".format(field) for field in fields))
+            results = [(row[0], tuple(row[1:])) for row in cursor.execute(query)]
+            cls.commit(connection)
+        except sqlite3.Error:
+            if not cls.in_transaction():
+                connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        return results
+
+    @classmethod
+    def update_all_fields(cls, cursor, query_record, updated_record, match=RecordMatch.SUBSTRING):
+        """
+        Same as update_records_by_all_fields, without committing, for callers managing their own transaction
+        :param cursor: cursor of the connection running the transaction
+        :type cursor: Cursor
+        :param query_record: record we want to use as query data
+        :type query_record: DatabaseRecord
+        :param updated_record: record we want to use to set query results data equal to
+        :type updated_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :return: number of updated records
+        :rtype: int
+        """
+        where, params = build_record_filter(query_record, match)
+        cursor.execute("UPDATE {table} SET name = ?, phone = ?, address = ? WHERE {where}"
+                       .format(table=cls.records_table, where=where),
+                       (updated_record.name, updated_record.phone, updated_record.address) + params)
+        return cursor.rowcount
@@ -0,0 +1,210 @@
+"""
+Module used for full text searching of the records. Records are indexed in an SQLite FTS5 shadow table using
+the trigram tokenizer, so substring searches on any field are answered from the index instead of scanning the
+records table. The shadow table is kept in sync with the records table by triggers, so every add/update/delete
+done through DatabaseRecordWriter is reflected in search results without any extra work from the writer.
+"""
+
+
+import math
+import sqlite3
+
+# trigram tokenizer can't match anything shorter than this
+MIN_SEARCH_LENGTH = 3
+
+
+class FullTextSearch(object):
+    """
+    Full text search engine built on an FTS5 trigram index of the records table. Optional, as not every
+    SQLite build ships FTS5, use is_supported to check before creating the index.
+    """
+    fts_suffix          = '_fts'
+    fuzzy_threshold     = 0.75
+    fuzzy_candidates    = 10
+    # share of a spelling's trigrams a record needs to be a fuzzy candidate
+    fuzzy_min_overlap   = 0.5
+    fuzzy_short_length  = 5
+
+    @classmethod
+    def fts_table(cls, table):
+        return table + cls.fts_suffix
+
+    @classmethod
+    def is_supported(cls, db_driver):
+        """
+        Check whether the SQLite library used by our driver can create FTS5 trigram tables
+        :param db_driver: connection to the db
+        :type db_driver: Connection
+        :return: FTS5 trigram support
+        :rtype: bool
+        """
+        try:
+            db_driver.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(content, tokenize='trigram')")
+            db_driver.execute("DROP TABLE temp.fts_probe")
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    @classmethod
+    def has_index(cls, db_driver, table):
+        return db_driver.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' and name = ?",
+                                 (cls.fts_table(table),)).fetchone() is not None
+
+    @classmethod
+    def create_index(cls, db_driver, table):
+        """
+        Create the FTS5 shadow table for our records table along with the triggers keeping it in sync,
+        then index all the existing records. Does nothing if the index already exists.
+        :param db_driver: connection to the db
+        :type db_driver: Connection
+        :param table: records table we want to index
+        :type table: str
+        :return: whether a new index was created
+        :rtype: bool
+        """
+        if cls.has_index(db_driver, table):
+            return False
+        db_driver.executescript("""
+            BEGIN;
+            CREATE VIRTUAL TABLE {fts}
+                USING fts5(name, phone, address, content='{table}', content_rowid='id', tokenize='trigram');
+            CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, name, phone, address) VALUES(new.id, new.name, new.phone, new.address);
+            END;
+            CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, name, phone, address)
+                    VALUES('delete', old.id, old.name, old.phone, old.address);
+            END;
+            CREATE TRIGGER {fts}_update AFTER UPDATE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, name, phone, address)
+                    VALUES('delete', old.id, old.name, old.phone, old.address);
+                INSERT INTO {fts}(rowid, name, phone, address) VALUES(new.id, new.name, new.phone, new.address);
+            END;
+            INSERT INTO {fts}({fts}) VALUES('rebuild');
+            COMMIT;
+            """.format(fts=cls.fts_table(table), table=table))
+        return True
+
+    @classmethod
+    def drop_index(cls, db_driver, table):
+        """
+        Remove the FTS5 shadow table and its triggers
+        :param db_driver: connection to the db
+        :type db_driver: Connection
+        :param table: records table the index was built for
+        :type table: str
+        :return: None
+        """
+        db_driver.executescript("""
+            DROP TRIGGER IF EXISTS {fts}_insert;
+            DROP TRIGGER IF EXISTS {fts}_delete;
+            DROP TRIGGER IF EXISTS {fts}_update;
+            DROP TABLE IF EXISTS {fts};
+            """.format(fts=cls.fts_table(table)))
+
+    @classmethod
+    def search(cls, db_driver, table, text, limit=20, fuzzy=False):
+        """
+        Search all the record fields for the text we provide, best matches first. Exact searches return
+        records containing the text in any field, ranked by bm25. Fuzzy searches return the records sharing
+        the most trigrams with the text or one of its variants (see variants), re-ranked by similarity, so
+        slightly misspelled text still finds its record.
+        :param db_driver: connection to the db
+        :type db_driver: Connection
+        :param table: records table we want to search
+        :type table: str
+        :param text: text we want to search for
+        :type text: str
+        :param limit: max number of results
+        :type limit: int
+        :param fuzzy: whether we want typo-tolerant matching
+        :type fuzzy: bool
+        :return: matching records
+        :rtype: list
+        """
+        if not cls.has_index(db_driver, table):
+            raise RuntimeError("Full text search index does not exist. Please create it with FullTextSearch."
+                               "create_index, or use a SQLite build with FTS5 support.")
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        text = text.strip()
+        if len(text) < MIN_SEARCH_LENGTH:
+            # too short for the trigram index, fall back to scanning the records table
+            return db_driver.execute("SELECT name, phone, address FROM {table} WHERE instr(name, ?) or "
+                                     "instr(phone, ?) or instr(address, ?) LIMIT ?".format(table=table),
+                                     (text, text, text, limit)).fetchall()
+        if not fuzzy:
+            return db_driver.execute("SELECT name, phone, address FROM {fts} WHERE {fts} MATCH ? ORDER BY rank "
+                                     "LIMIT ?".format(fts=cls.fts_table(table)), (cls._quote(text), limit)).fetchall()
+
+        variants = cls.variants(text)
+        variant_trigrams = [cls.trigrams(variant) for variant in variants]
+        variant_trigrams = [(variant, trigrams) for variant, trigrams in zip(variants, variant_trigrams) if trigrams]
+        pool = sorted(set().union(*[trigrams for variant, trigrams in variant_trigrams]))
+        # candidates share enough trigrams with at least one variant, most shared trigrams first
+        min_shared = min(max(1, int(math.ceil(len(trigrams) * cls.fuzzy_min_overlap)))
+                         for variant, trigrams in variant_trigrams)
+        candidates = db_driver.execute(
+            "SELECT records.name, records.phone, records.address FROM (SELECT rowid AS id, count(*) AS shared "
+            "FROM ({matches}) GROUP BY rowid HAVING shared >= ? ORDER BY shared DESC, rowid LIMIT ?) AS candidates "
+            "JOIN {table} AS records ON records.id = candidates.id ORDER BY candidates.shared DESC, candidates.id"
+            .format(table=table, matches=" UNION ALL ".join("SELECT rowid FROM {fts} WHERE {fts} MATCH ?"
+                                                            .format(fts=cls.fts_table(table)) for _ in pool)),
+            [cls._quote(trigram) for trigram in pool] + [min_shared, limit * cls.fuzzy_candidates]).fetchall()
+        scored = [(max(cls.similarity(variant, trigrams, record) for variant, trigrams in variant_trigrams),
+                   index, record) for index, record in enumerate(candidates)]
+        scored = [item for item in scored if item[0] >= cls.fuzzy_threshold]
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [record for score, index, record in scored[:limit]]
+
+    @classmethod
+    def variants(cls, text):
+        """
+        Spellings of the search text tried by fuzzy searches. Short words have too few trigrams for a typo to
+        leave any in common with the right spelling, so each word shorter than fuzzy_short_length is also tried
+        with each of its characters dropped and each adjacent pair swapped, one word at a time.
+        :param text: search text
+        :type text: str
+        :return: the text first, then its variants
+        :rtype: list
+        """
+        variants = [text]
+        words = text.split(u" ")
+        for position, word in enumerate(words):
+            if len(word) >= cls.fuzzy_short_length:
+                continue
+            spellings = [word[:index] + word[index + 1:] for index in range(len(word))] + \
+                        [word[:index] + word[index + 1] + word[index] + word[index + 2:]
+                         for index in range(len(word) - 1)]
+            for spelling in spellings:
+                variant = u" ".join(words[:position] + [spelling] + words[position + 1:]).strip()
+                if spelling and variant not in variants:
+                    variants.append(variant)
+        return variants
+
+    @classmethod
+    def trigrams(cls, text):
+        text = text.lower()
+        return set(text[index:index + MIN_SEARCH_LENGTH] for index in range(len(text) - MIN_SEARCH_LENGTH + 1))
+
+    @classmethod
+    def similarity(cls, text, trigrams, record):
+        """
+        Score how closely a candidate record matches our search text. Each field scores the share of the text's
+        trigrams it contains, or the string similarity between the text and the field's closest word-aligned
+        window, whichever is higher, so both substrings and misspelled words of a longer field score well.
+        """
+        from difflib import SequenceMatcher
+        text = text.lower()
+        best = 0.0
+        for field in record:
+            field = u"{}".format(field).lower()
+            windows = [field] + [field[index:index + len(text)] for index in range(len(field))
+                                 if index == 0 or field[index - 1] == u" "]
+            best = max(best, len(trigrams & cls.trigrams(field)) / float(len(trigrams)),
+                       max(SequenceMatcher(None, text, window).ratio() for window in windows))
+        return best
+
+    @staticmethod
+    def _quote(text):
+        return u'"{}"'.format(text.replace('"', '""'))
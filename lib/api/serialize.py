@@ -5,112 +5,804 @@ use in other applications/for different purposes (ie. json, csv, html, etc.)
 """
 
 
+# csv, yaml, gzip and the optional pyarrow/zstandard are only imported by the writers/readers using them, so loading
+# this module stays cheap for the CLI runs which never export or import anything
 from abc import ABCMeta, abstractmethod
-import csv
+import codecs
+import io
 import json
-import yaml
+import mmap
+import struct
 import sys
+from array import array
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
-from lib.utils import integer_stream_to_phone_number
+from lib.utils import integer_streams_to_phone_numbers, phone_number_to_integer_stream, iter_batches, \
+    INT64_TYPECODE, PHONE_DIGITS
+
+# layout of the snapshot format header: magic, version, reserved, record count, then the offset of each section
+SNAPSHOT_MAGIC   = b"PHONEBK\0"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER  = struct.Struct("<8sHHI8Q")
+# stored in place of NULL phones
+SNAPSHOT_NULL_PHONE = -1
+
+# the python 2 csv module only handles byte strings, so fields are encoded to/decoded from UTF-8 around it
+CSV_BYTES = sys.version_info[0] < 3
+
+# stream compressions of the text formats, selected by the last extension of the file (ie. records.csv.gz)
+GZIP_COMPRESSION = 'gz'
+ZSTD_COMPRESSION = 'zst'
+COMPRESSIONS     = [GZIP_COMPRESSION, ZSTD_COMPRESSION]
+GZIP_LEVEL       = 6
 
 
 class SerialWriter(object):
     """
     Abstract base class for other writers to inherit from. All writers should have
-    the same API interface.
+    the same API interface. Writers consume their input data as an iterator and emit
+    each record as soon as it's serialized, so they never hold the full data set in memory.
     """
     __metaclass__ = ABCMeta
 
-    @staticmethod
+    format_name = None
+    header      = ""
+    separator   = ""
+    footer      = ""
+    # records read ahead from the input so their phones can be formatted in a single batch
+    batch_size  = 1000
+    # binary documents can't be split into shards and concatenated, see ParallelExporter
+    binary      = False
+    # documents that are just their records, one after the other, can have records appended to them in place
+    appendable  = False
+
+    @classmethod
     @abstractmethod
-    def write(input_data, output_path):
+    def serialize_record(cls, record):
         """
-        Abstract method for writing serial data to serial format, based on serial writer format
-        :param input_data: data from a datasource we want to write out in serial format
-        :type input_data: dict
-        :param output_path: output path of the exported file written out in serial format
-        :type output_path: str
-        :return: None
+        Abstract method for serializing a single record to the writer's serial format
+        :param record: (name, phone, address) record from a datasource, phone already formatted for display
+        :type record: tuple
+        :return: serialized record
+        :rtype: str
         """
         pass
 
     @classmethod
-    def log_write_message(cls, writer_type, output_path, input_data):
+    def iter_record_chunks(cls, input_data):
+        """
+        Lazily serialize each record of our input data, records after the first are prefixed with the separator.
+        Records are read batch_size at a time, formatting the phones of each batch in one go.
+        :param input_data: iterable of records from a datasource
+        :type input_data: iterable
+        :return: generator of serialized records
+        :rtype: generator
         """
-        Log message to print serial writer info, input data and output path to the console based
-        on different writer formats.
+        separator = ""
+        for batch in iter_batches(input_data, cls.batch_size):
+            phones = integer_streams_to_phone_numbers([record[1] for record in batch])
+            for record, phone in zip(batch, phones):
+                yield separator + cls.serialize_record((record[0], phone, record[2]))
+                separator = cls.separator
+
+    @classmethod
+    def iter_chunks(cls, input_data):
+        """
+        Lazily serialize our input data to a complete document in the writer's format, chunk by chunk
+        :param input_data: iterable of records from a datasource
+        :type input_data: iterable
+        :return: generator of document chunks
+        :rtype: generator
+        """
+        yield cls.header
+        for chunk in cls.iter_record_chunks(input_data):
+            yield chunk
+        yield cls.footer
+
+    @classmethod
+    def write(cls, input_data, output_path):
+        """
+        Write our input data to a serial file, streaming records from the input to the file one at a time
+        :param input_data: iterable of records from a datasource we want to write out in serial format
+        :type input_data: iterable
+        :param output_path: output path of the exported file written out in serial format, compressed if its
+                            extension is one of COMPRESSIONS
+        :type output_path: str
+        :return: number of records written
+        :rtype: int
+        """
+        record_count = 0
+        with codecs.getwriter('utf-8')(open_serial_file(output_path, 'wb')) as output_file:
+            output_file.write(cls.header)
+            for chunk in cls.iter_record_chunks(input_data):
+                output_file.write(chunk)
+                record_count += 1
+            output_file.write(cls.footer)
+        cls.log_write_message(cls.format_name, output_path, record_count)
+        return record_count
+
+    @classmethod
+    def log_write_message(cls, writer_type, output_path, record_count):
+        """
+        Log message to print a summary of what a serial writer wrote to the console
         :param writer_type: shortname/extension for serial writer format
         :type writer_type: str
         :param output_path: output path of exported serial file
         :type output_path: str
-        :param input_data: data from a datasource being written out to serial file
-        :type input_data: dict
+        :param record_count: number of records written out to serial file
+        :type record_count: int
         :return: None
         """
-        sys.stdout.write("Writing {} to {}. Data: {}".format(writer_type, output_path, input_data))
+        sys.stdout.write("Wrote {} {} records to {}\n".format(record_count, writer_type, output_path))
+
+
+def record_to_dict(record):
+    return {"name": record[0], "phone": record[1], "address": record[2]}
 
 
 # list of different serial writers implementing their format-specific functionality
 
 class JSONWriter(SerialWriter):
-    @staticmethod
-    def write(input_data, output_path):
-        JSONWriter.log_write_message("JSON", output_path, input_data)
-        output_data = {}
-        with open(output_path, 'w') as json_file:
-            for result in input_data:
-                # hash our fields since there might be duplicate keys and JSON doesn't allow that
-                hash_id = hash(result[0] + str(result[1]) + result[2])
-                output_data[hash_id] = {"name": result[0],
-                                        "phone": integer_stream_to_phone_number(str(result[1])),
-                                        "address": result[2]}
-            json.dump(output_data, json_file)
+    """
+    Writes a JSON array with one record object per line
+    """
+    format_name = "JSON"
+    header      = "[\n"
+    separator   = ",\n"
+    footer      = "\n]\n"
+
+    @classmethod
+    def serialize_record(cls, record):
+        return json.dumps(record_to_dict(record), sort_keys=True)
+
+
+class NDJSONWriter(SerialWriter):
+    """
+    Writes newline delimited JSON, one record object per line
+    """
+    format_name = "NDJSON"
+    appendable  = True
+
+    @classmethod
+    def serialize_record(cls, record):
+        return json.dumps(record_to_dict(record), sort_keys=True) + "\n"
 
 
 class CSVWriter(SerialWriter):
-    @staticmethod
-    def write(input_data, output_path):
-        CSVWriter.log_write_message("CSV", output_path, input_data)
-        columns = ["Name", "Phone", "Address"]
-        with open(output_path, "w") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=columns)
-            writer.writeheader()
-            for result in input_data:
-                writer.writerow({"Name": result[0],
-                                 "Phone": integer_stream_to_phone_number(str(result[1])),
-                                 "Address": result[2]})
+    format_name = "CSV"
+    header      = "Name,Phone,Address\r\n"
+    appendable  = True
+
+    @classmethod
+    def serialize_record(cls, record):
+        import csv
+        row = StringIO()
+        if CSV_BYTES:
+            csv.writer(row).writerow([field.encode('utf-8') if isinstance(field, type(u"")) else field
+                                      for field in record])
+            return row.getvalue().decode('utf-8')
+        csv.writer(row).writerow(record)
+        return row.getvalue()
 
 
 class YAMLWriter(SerialWriter):
-    @staticmethod
-    def write(input_data, output_path):
-        YAMLWriter.log_write_message("YAML", output_path, input_data)
-        output_data = {}
-        with open(output_path, 'w') as json_file:
-            for result in input_data:
-                # hash our fields since there might be duplicate keys and YAML doesn't allow that
-                hash_id = hash(result[0] + str(result[1]) + result[2])
-                output_data[hash_id] = {"name": str(result[0]),
-                                        "phone": integer_stream_to_phone_number(str(result[1])),
-                                        "address": str(result[2])}
-            yaml.dump(output_data, json_file)
+    """
+    Writes one YAML document per record
+    """
+    format_name = "YAML"
+
+    @classmethod
+    def serialize_record(cls, record):
+        import yaml
+        return yaml.safe_dump(record_to_dict(record), explicit_start=True, default_flow_style=False,
+                              allow_unicode=True, encoding=None)
 
 
 class HTMLWriter(SerialWriter):
+    format_name = "HTML"
+    header      = "<html>"
+    footer      = "</html>"
+
+    @classmethod
+    def serialize_record(cls, record):
+        return u"<div><h5>Name: {}</h5><h5>Phone: {}</h5><h5>Address: {}</h5><br></div>"\
+            .format(*record)
+
+
+class SnapshotWriter(SerialWriter):
+    """
+    Writes a versioned binary snapshot meant to be memory mapped by SnapshotReader. After the header come
+    the phone column (little endian int64), the offsets into the name and address blobs (int64, one more than
+    the number of records), the record numbers sorted by phone (uint32), then the UTF-8 name and address blobs.
+    Every section is 8 byte aligned except the blobs. NULL names/addresses are written as empty strings.
+    """
+    format_name = "Snapshot"
+    binary      = True
+
+    @classmethod
+    def serialize_record(cls, record):
+        raise NotImplementedError("Snapshots are written column by column, see SnapshotWriter.iter_chunks")
+
+    @classmethod
+    def iter_chunks(cls, input_data):
+        """
+        Serialize our input data to a complete snapshot. The columns are collected in compact arrays first, as
+        the header and the sorted phone index need every record.
+        :param input_data: iterable of records from a datasource
+        :type input_data: iterable
+        :return: generator of document chunks
+        :rtype: generator
+        """
+        phones = []
+        columns = [(bytearray(), [0]), (bytearray(), [0])]
+        for record in input_data:
+            phones.append(SNAPSHOT_NULL_PHONE if record[1] is None else int(record[1]))
+            for (blob, offsets), value in zip(columns, (record[0], record[2])):
+                if value:
+                    blob.extend(value.encode('utf-8') if not isinstance(value, bytes) else value)
+                offsets.append(len(blob))
+        count = len(phones)
+        index = sorted(range(count), key=phones.__getitem__)
+        (names, name_offsets), (addresses, address_offsets) = columns
+
+        sections = [_pack('q', phones), _pack('q', name_offsets), _pack('q', address_offsets), _pack('I', index)]
+        phones_offset = SNAPSHOT_HEADER.size
+        name_offsets_offset = phones_offset + len(sections[0])
+        address_offsets_offset = name_offsets_offset + len(sections[1])
+        index_offset = address_offsets_offset + len(sections[2])
+        names_offset = index_offset + len(sections[3])
+        addresses_offset = names_offset + len(names)
+        yield SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, 0, count, phones_offset, name_offsets_offset,
+                                   names_offset, address_offsets_offset, addresses_offset, index_offset,
+                                   addresses_offset + len(addresses))
+        for section in sections + [bytes(names), bytes(addresses)]:
+            yield section
+
+    @classmethod
+    def write(cls, input_data, output_path):
+        """
+        Write our input data to a snapshot file, see SerialWriter.write
+        :return: number of records written
+        :rtype: int
+        """
+        with open(output_path, 'wb') as output_file:
+            chunks = cls.iter_chunks(input_data)
+            header = next(chunks)
+            output_file.write(header)
+            for chunk in chunks:
+                output_file.write(chunk)
+        record_count = SNAPSHOT_HEADER.unpack(header)[4]
+        cls.log_write_message(cls.format_name, output_path, record_count)
+        return record_count
+
+
+def _pack(code, values):
+    """
+    Pack integers as a little endian section of the snapshot format
+    """
+    if code == 'q' and INT64_TYPECODE != 'd' or code == 'I':
+        packed = array(INT64_TYPECODE if code == 'q' else 'I', values)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        return packed.tostring() if hasattr(packed, 'tostring') else packed.tobytes()
+    return struct.pack("<{}{}".format(len(values), code), *values)
+
+
+class ArrowWriter(SerialWriter):
+    """
+    Writes an Arrow IPC file, the records stored column by column in record batches of batch_size records.
+    Phones are kept as int64 instead of being formatted for display, and NULL fields stay nulls. Needs pyarrow.
+    """
+    format_name = "Arrow"
+    binary      = True
+    batch_size  = 65536
+
+    @classmethod
+    def serialize_record(cls, record):
+        raise NotImplementedError("Arrow files are written in record batches, see ArrowWriter.iter_chunks")
+
+    @classmethod
+    def schema(cls):
+        import pyarrow
+        return pyarrow.schema([('name', pyarrow.string()), ('phone', pyarrow.int64()),
+                               ('address', pyarrow.string())])
+
+    @classmethod
+    def batch_writer(cls, sink, schema):
+        import pyarrow
+        return pyarrow.RecordBatchFileWriter(sink, schema)
+
+    @classmethod
+    def write_batch(cls, batch_writer, batch):
+        batch_writer.write_batch(batch)
+
+    @classmethod
+    def iter_record_batches(cls, input_data):
+        """
+        Lazily split our input data into columnar record batches
+        :param input_data: iterable of records from a datasource
+        :type input_data: iterable
+        :return: generator of pyarrow RecordBatch
+        :rtype: generator
+        """
+        import pyarrow
+        schema = cls.schema()
+        for batch in iter_batches(input_data, cls.batch_size):
+            names, phones, addresses = zip(*batch)
+            phones = [None if phone is None else int(phone) for phone in phones]
+            yield pyarrow.RecordBatch.from_arrays([pyarrow.array(column, type=field.type) for column, field
+                                                   in zip([names, phones, addresses], schema)], schema.names)
+
+    @classmethod
+    def write_batches(cls, input_data, sink):
+        """
+        Write our input data to a sink batch by batch, the file footer is written once the input is exhausted
+        :param input_data: iterable of records from a datasource
+        :type input_data: iterable
+        :param sink: file object or path the batches are written to
+        :type sink: file
+        :return: generator of the number of records in each batch, once it's written
+        :rtype: generator
+        """
+        batch_writer = cls.batch_writer(sink, cls.schema())
+        try:
+            for batch in cls.iter_record_batches(input_data):
+                cls.write_batch(batch_writer, batch)
+                yield batch.num_rows
+        finally:
+            batch_writer.close()
+
+    @classmethod
+    def iter_chunks(cls, input_data):
+        """
+        Lazily serialize our input data to a complete document, yielding what was written after each batch
+        :param input_data: iterable of records from a datasource
+        :type input_data: iterable
+        :return: generator of document chunks
+        :rtype: generator
+        """
+        sink = _ChunkSink()
+        for _ in cls.write_batches(input_data, sink):
+            for chunk in sink.drain():
+                yield chunk
+        for chunk in sink.drain():
+            yield chunk
+
+    @classmethod
+    def write(cls, input_data, output_path):
+        """
+        Write our input data to a columnar file, see SerialWriter.write
+        :return: number of records written
+        :rtype: int
+        """
+        record_count = sum(cls.write_batches(input_data, output_path))
+        cls.log_write_message(cls.format_name, output_path, record_count)
+        return record_count
+
+
+class ParquetWriter(ArrowWriter):
+    """
+    Writes a Parquet file, one row group per record batch, see ArrowWriter. Needs pyarrow.
+    """
+    format_name = "Parquet"
+
+    @classmethod
+    def batch_writer(cls, sink, schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(sink, schema)
+
+    @classmethod
+    def write_batch(cls, batch_writer, batch):
+        import pyarrow
+        batch_writer.write_table(pyarrow.Table.from_batches([batch]))
+
+
+class _ChunkSink(object):
+    """
+    Write-only file object keeping what pyarrow writes to it until it's drained, so columnar documents can be
+    streamed chunk by chunk
+    """
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def is_installed(module_name):
+    """
+    Check whether an optional module is installed, without importing it
+    :param module_name: name of the top level module, None for no module
+    :type module_name: str
+    :return: True if the module can be imported
+    :rtype: bool
+    """
+    if module_name is None:
+        return True
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        from pkgutil import find_loader as find_spec
+    return find_spec(module_name) is not None
+
+
+def compression_of(path):
+    """
+    Stream compression selected by the extension of a path
+    :param path: file path, or serial format extension
+    :type path: str
+    :return: one of COMPRESSIONS, or None for uncompressed files
+    :rtype: str
+    """
+    extension = path.rsplit('.', 1)[-1]
+    return extension if extension in COMPRESSIONS else None
+
+
+def compressor(compression):
+    """
+    :param compression: one of COMPRESSIONS
+    :type compression: str
+    :return: compression object with compress(data) and flush() methods, the output is a complete gzip member or
+             zstd frame. The gzip header has no file name or timestamp, so equal input compresses to equal bytes.
+    :rtype: object
+    """
+    if compression == GZIP_COMPRESSION:
+        import zlib
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    import zstandard
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def iter_compressed(chunks, compression):
+    """
+    Lazily compress a stream of byte chunks, see compressor
+    :param chunks: iterable of bytes
+    :type chunks: iterable
+    :param compression: one of COMPRESSIONS
+    :type compression: str
+    :return: generator of compressed chunks
+    :rtype: generator
+    """
+    compressing = compressor(compression)
+    for chunk in chunks:
+        compressed = compressing.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressing.flush()
+
+
+class CompressedFile(object):
+    """
+    Binary file object compressing everything written to it, or decompressing everything read from it. Appending
+    adds a new gzip member or zstd frame, and reading goes through all of them.
+    """
+    def __init__(self, path, compression, mode='rb'):
+        """
+        :param path: path of the compressed file
+        :type path: str
+        :param compression: one of COMPRESSIONS
+        :type compression: str
+        :param mode: 'rb', 'wb' or 'ab'
+        :type mode: str
+        """
+        self.raw_file = open(path, mode)
+        self.compressor = None
+        self.stream = None
+        if 'r' not in mode:
+            self.compressor = compressor(compression)
+        elif compression == GZIP_COMPRESSION:
+            import gzip
+            self.stream = io.BufferedReader(gzip.GzipFile(fileobj=self.raw_file, mode='rb'))
+        else:
+            import zstandard
+            self.stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(self.raw_file,
+                                                                                       read_across_frames=True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def readline(self, size=-1):
+        return self.stream.readline(size)
+
+    def write(self, data):
+        self.raw_file.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.raw_file.closed:
+            return
+        try:
+            if self.compressor is not None:
+                self.raw_file.write(self.compressor.flush())
+            else:
+                self.stream.close()
+        finally:
+            self.raw_file.close()
+
+
+def open_serial_file(path, mode='rb'):
+    """
+    Open a serial file in binary mode, transparently compressed/decompressed when its extension is one of
+    COMPRESSIONS
+    :param path: path of the serial file
+    :type path: str
+    :param mode: 'rb', 'wb' or 'ab'
+    :type mode: str
+    :return: file object
+    :rtype: file
+    """
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, mode)
+    return CompressedFile(path, compression, mode)
+
+
+class SerialReader(object):
+    """
+    Abstract base class for readers parsing files written by the serial writers above
+    back into record data, so exported files can be imported again.
+    """
+    __metaclass__ = ABCMeta
+
+    @staticmethod
+    @abstractmethod
+    def read(input_path):
+        """
+        Abstract method for reading serial data back from a serial file, based on serial reader format
+        :param input_path: path of the serial file we want to read
+        :type input_path: str
+        :return: generator of (name, phone, address) tuples, phone as integer stream
+        :rtype: generator
+        """
+        pass
+
+
+# list of different serial readers implementing their format-specific functionality
+
+def dict_to_record(result):
+    return result["name"], phone_number_to_integer_stream(result["phone"]), result["address"]
+
+
+class JSONReader(SerialReader):
+    @staticmethod
+    def read(input_path):
+        with open_serial_file(input_path) as json_file:
+            if json_file.readline().strip() == JSONWriter.header.strip():
+                # written by JSONWriter, one record per line, so stream them
+                for line in json_file:
+                    line = line.strip().rstrip(',')
+                    if line and line != JSONWriter.footer.strip():
+                        yield dict_to_record(json.loads(line))
+                return
+        # reopened rather than rewound, compressed streams can't seek back
+        with open_serial_file(input_path) as json_file:
+            input_data = json.load(json_file)
+        # older exports were written as a single object keyed by record hash
+        for result in (input_data.values() if isinstance(input_data, dict) else input_data):
+            yield dict_to_record(result)
+
+
+class NDJSONReader(SerialReader):
+    @staticmethod
+    def read(input_path):
+        with open_serial_file(input_path) as json_file:
+            for line in json_file:
+                if line.strip():
+                    yield dict_to_record(json.loads(line))
+
+
+class CSVReader(SerialReader):
+    @staticmethod
+    def read(input_path):
+        import csv
+        with open_serial_file(input_path) as csvfile:
+            for result in csv.DictReader(csvfile):
+                if CSV_BYTES:
+                    result = dict((key, value.decode('utf-8')) for key, value in result.items())
+                yield result["Name"], phone_number_to_integer_stream(result["Phone"]), result["Address"]
+
+
+class YAMLReader(SerialReader):
+    @staticmethod
+    def read(input_path):
+        import yaml
+        with open_serial_file(input_path) as yaml_file:
+            for document in yaml.safe_load_all(yaml_file):
+                if document is None:
+                    continue
+                # older exports were written as a single document keyed by record hash
+                for result in ([document] if "name" in document else document.values()):
+                    yield dict_to_record(result)
+
+
+class SnapshotReader(SerialReader):
+    """
+    Memory maps a snapshot written by SnapshotWriter. Nothing is deserialized up front, each record is decoded
+    straight from the mapped pages when accessed, so opening a snapshot is instant whatever its size, and every
+    process mapping the same file shares one copy of it in the page cache. Phone lookups are binary searches of
+    the sorted phone index.
+    """
+    def __init__(self, input_path):
+        """
+        :param input_path: path of the snapshot file
+        :type input_path: str
+        """
+        with open(input_path, 'rb') as snapshot_file:
+            if len(snapshot_file.read(SNAPSHOT_HEADER.size)) < SNAPSHOT_HEADER.size:
+                raise ValueError("Provided file is not a phonebook snapshot: {}".format(input_path))
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, _, self.count, self._phones, self._name_offsets, self._names, self._address_offsets, \
+            self._addresses, self._index, size = SNAPSHOT_HEADER.unpack_from(self._map, 0)
+        if magic != SNAPSHOT_MAGIC or size != len(self._map):
+            self.close()
+            raise ValueError("Provided file is not a phonebook snapshot: {}".format(input_path))
+        if version != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError("Unsupported snapshot version {}, please re-export it with this version of the app."
+                             .format(version))
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._map.close()
+
+    def phone(self, row):
+        phone = struct.unpack_from("<q", self._map, self._phones + 8 * row)[0]
+        return None if phone == SNAPSHOT_NULL_PHONE else phone
+
+    def _text(self, offsets, blob, row):
+        start, stop = struct.unpack_from("<2q", self._map, offsets + 8 * row)
+        return self._map[blob + start:blob + stop].decode('utf-8')
+
+    def record(self, row):
+        """
+        :return: (name, phone, address) record stored at a row
+        :rtype: tuple
+        """
+        return (self._text(self._name_offsets, self._names, row), self.phone(row),
+                self._text(self._address_offsets, self._addresses, row))
+
+    def _lower_bound(self, phone):
+        """
+        Position in the sorted phone index of the first record whose phone is not less than phone
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.phone_at(middle) < phone:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def row_at(self, position):
+        return struct.unpack_from("<I", self._map, self._index + 4 * position)[0]
+
+    def phone_at(self, position):
+        return struct.unpack_from("<q", self._map, self._phones + 8 * self.row_at(position))[0]
+
+    def find_phone_range(self, lower, upper):
+        """
+        Fetch the records whose phone is between lower and upper (inclusive), with two binary searches
+        :param lower: smallest phone
+        :type lower: int
+        :param upper: largest phone
+        :type upper: int
+        :return: matching records, in phone order
+        :rtype: list
+        """
+        return [self.record(self.row_at(position))
+                for position in range(self._lower_bound(lower), self._lower_bound(upper + 1))]
+
+    def find_phone(self, phone):
+        """
+        Fetch the records of a complete phone number, see find_phone_range
+        :param phone: phone number, in any format phone_number_to_integer_stream accepts
+        :type phone: int
+        :return: matching records
+        :rtype: list
+        """
+        phone = phone_number_to_integer_stream(phone)
+        return self.find_phone_range(phone, phone)
+
+    def find_phone_prefix(self, prefix):
+        """
+        Fetch the records whose phone starts with the digits we provide, ie. an area code
+        :param prefix: leading digits of the phone
+        :type prefix: str
+        :return: matching records, in phone order
+        :rtype: list
+        """
+        digits = str(prefix)
+        if not digits.isdigit() or len(digits) > PHONE_DIGITS:
+            raise ValueError("Invalid phone prefix provided. Please use up to {} digits.".format(PHONE_DIGITS))
+        return self.find_phone_range(int(digits.ljust(PHONE_DIGITS, '0')), int(digits.ljust(PHONE_DIGITS, '9')))
+
+    def iter_records(self):
+        for row in range(self.count):
+            yield self.record(row)
+
     @staticmethod
-    def write(input_data, output_path):
-        HTMLWriter.log_write_message("HTML", output_path, input_data)
-        body = ""
-        for result in input_data:
-            body += "<div>"
-            body += "<h5>Name: {}</h5>".format(str(result[0]))
-            body += "<h5>Phone: {}</h5>".format(integer_stream_to_phone_number(str(result[1])))
-            body += "<h5>Address: {}</h5>".format(str(result[2]))
-            body += "<br>"
-            body += "</div>"
-        html_code = "<html>{body}</html>".format(body=body)
-        with open(output_path, 'w') as html_file:
-            html_file.write(html_code)
+    def read(input_path):
+        with SnapshotReader(input_path) as snapshot:
+            for record in snapshot.iter_records():
+                yield record
+
+
+class ArrowReader(SerialReader):
+    """
+    Reads an Arrow IPC file written by ArrowWriter, batch by batch, through a memory map
+    """
+    @staticmethod
+    def read(input_path):
+        import pyarrow
+        source = pyarrow.memory_map(input_path)
+        try:
+            arrow_file = pyarrow.ipc.open_file(source)
+            for index in range(arrow_file.num_record_batches):
+                for record in columns_to_records(arrow_file.get_batch(index)):
+                    yield record
+        finally:
+            source.close()
+
+
+class ParquetReader(SerialReader):
+    """
+    Reads a Parquet file written by ParquetWriter, row group by row group
+    """
+    @staticmethod
+    def read(input_path):
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(input_path)
+        for index in range(parquet_file.num_row_groups):
+            for record in columns_to_records(parquet_file.read_row_group(index)):
+                yield record
+
+
+def columns_to_records(columns):
+    """
+    :param columns: pyarrow RecordBatch or Table with name, phone, address columns
+    :type columns: RecordBatch
+    :return: (name, phone, address) records
+    :rtype: list
+    """
+    return list(zip(*[columns.column(index).to_pylist() for index in range(3)]))
 
 
 class SerialFormats(object):
@@ -119,11 +811,31 @@ class SerialFormats(object):
     change the serial format used in the AppConfig, as the writer and extension
     type are keys in the attributes.
     """
-    CSV =  {'extension': 'csv',  'writer': CSVWriter}
-    JSON = {'extension': 'json', 'writer': JSONWriter}
-    YAML = {'extension': 'yaml', 'writer': YAMLWriter}
-    HTML = {'extension': 'html', 'writer': HTMLWriter}
+    CSV =    {'extension': 'csv',    'writer': CSVWriter,    'reader': CSVReader}
+    JSON =   {'extension': 'json',   'writer': JSONWriter,   'reader': JSONReader}
+    NDJSON = {'extension': 'ndjson', 'writer': NDJSONWriter, 'reader': NDJSONReader}
+    YAML =   {'extension': 'yaml',   'writer': YAMLWriter,   'reader': YAMLReader}
+    HTML =   {'extension': 'html',   'writer': HTMLWriter,   'reader': None}
+    SNAPSHOT = {'extension': 'pbsnap', 'writer': SnapshotWriter, 'reader': SnapshotReader}
+    # columnar formats, only supported when pyarrow is installed
+    ARROW =   {'extension': 'arrow',   'writer': ArrowWriter,   'reader': ArrowReader,   'requires': 'pyarrow'}
+    PARQUET = {'extension': 'parquet', 'writer': ParquetWriter, 'reader': ParquetReader, 'requires': 'pyarrow'}
+    # text formats compressed while they're written, see compression_of. zstd needs zstandard installed
+    CSV_GZ =    {'extension': 'csv.gz',    'writer': CSVWriter,    'reader': CSVReader}
+    JSON_GZ =   {'extension': 'json.gz',   'writer': JSONWriter,   'reader': JSONReader}
+    NDJSON_GZ = {'extension': 'ndjson.gz', 'writer': NDJSONWriter, 'reader': NDJSONReader}
+    YAML_GZ =   {'extension': 'yaml.gz',   'writer': YAMLWriter,   'reader': YAMLReader}
+    HTML_GZ =   {'extension': 'html.gz',   'writer': HTMLWriter,   'reader': None}
+    CSV_ZST =    {'extension': 'csv.zst',    'writer': CSVWriter,    'reader': CSVReader,    'requires': 'zstandard'}
+    JSON_ZST =   {'extension': 'json.zst',   'writer': JSONWriter,   'reader': JSONReader,   'requires': 'zstandard'}
+    NDJSON_ZST = {'extension': 'ndjson.zst', 'writer': NDJSONWriter, 'reader': NDJSONReader, 'requires': 'zstandard'}
+    YAML_ZST =   {'extension': 'yaml.zst',   'writer': YAMLWriter,   'reader': YAMLReader,   'requires': 'zstandard'}
+    HTML_ZST =   {'extension': 'html.zst',   'writer': HTMLWriter,   'reader': None,         'requires': 'zstandard'}
 
     # list of all the currently supported formats for easily checking
-    # if an input for serial change is valid/supported
-    ALL_FORMATS = [CSV, JSON, YAML, HTML]
+    # if an input for serial change is valid/supported. Formats needing a module that isn't installed are left out
+    ALL_FORMATS = [_format for _format in [CSV, JSON, NDJSON, YAML, HTML, SNAPSHOT, ARROW, PARQUET,
+                                           CSV_GZ, JSON_GZ, NDJSON_GZ, YAML_GZ, HTML_GZ,
+                                           CSV_ZST, JSON_ZST, NDJSON_ZST, YAML_ZST, HTML_ZST]
+                   if is_installed(_format.get('requires'))]
+
@@ -0,0 +1,382 @@
+"""
+Module used to serve the record API over HTTP, for frontends which used to wrap the CLI in shell scripts. Requests
+and responses are JSON, except exports, which are streamed in any of the SerialFormats as they're serialized.
+Connections are kept alive between requests (HTTP/1.1), and handled by a fixed pool of worker threads. Readers run
+concurrently, each worker checking a connection out of the WAL mode pool of ConnectionManager for the duration of a
+request, while writes are serialized so the write authority rule is checked and applied atomically.
+
+    GET    /records?name=&phone=&address=&match=&limit=&page=&order=   one page of matching records
+    GET    /search?text=&fuzzy=&limit=                                full text search
+    GET    /export?format=csv                                         stream all records in a serial format
+    GET    /prefix_counts?digits=3&within=                            records per area code (3) or exchange (6)
+    POST   /records   {"name": ..., "phone": ..., "address": ...}     add a record
+    PATCH  /records   {"query": {...}, "set": {...}, "match": ...}    update the records matching query
+    DELETE /records   {"query": {...}, "match": ...}                  delete the records matching query
+PATCH and DELETE only count the records they would change when the body has "dry_run": true.
+"""
+
+
+import sys
+import json
+import socket
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from urlparse import urlparse, parse_qs
+    from Queue import Queue
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+    from queue import Queue
+
+from auth import WriteAuthRuleHandler
+from conf import AppConfig
+from record_handler import DatabaseRecordReader, DatabaseRecordWriter, DatabaseRecord, RecordMatch, RecordOrder, \
+    MutationRule, encode_page_cursor, decode_page_cursor
+from serialize import SerialFormats, compression_of, iter_compressed, record_to_dict
+from lib.utils import phone_number_to_integer_stream
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = 8
+DEFAULT_PAGE_SIZE = 100
+# seconds an idle keep-alive connection holds on to its worker
+KEEP_ALIVE_TIMEOUT = 5.0
+# exports are sent in chunks of at least this many bytes, rather than one tiny chunk per record
+EXPORT_CHUNK_SIZE = 64 * 1024
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'json': 'application/json', 'ndjson': 'application/x-ndjson',
+                 'yaml': 'application/x-yaml; charset=utf-8', 'html': 'text/html; charset=utf-8',
+                 'pbsnap': 'application/octet-stream', 'arrow': 'application/vnd.apache.arrow.file',
+                 'parquet': 'application/vnd.apache.parquet', 'gz': 'application/gzip', 'zst': 'application/zstd'}
+
+# tells worker threads to exit
+_STOP = object()
+
+
+class HTTPError(Exception):
+    """
+    Error sent back to the client with its status code
+    """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def request_record(fields):
+    """
+    Build a record from the name/phone/address fields of a request body or query string
+    :param fields: fields of the request
+    :type fields: dict
+    :return: record with the provided fields
+    :rtype: DatabaseRecord
+    """
+    if not isinstance(fields, dict):
+        raise HTTPError(400, "Records should be JSON objects with name, phone and address fields.")
+    phone = fields.get("phone")
+    if phone is not None and phone != "":
+        phone = phone_number_to_integer_stream(u"{}".format(phone))
+    return DatabaseRecord(fields.get("name") or None, phone or None, fields.get("address") or None)
+
+
+def request_match(name):
+    if name not in RecordMatch.BY_NAME:
+        raise HTTPError(400, "Invalid match provided: {!r}. Supported matches: {}"
+                        .format(name, sorted(RecordMatch.BY_NAME)))
+    return RecordMatch.BY_NAME[name]
+
+
+def can_write(db_record):
+    """
+    :return: whether the current write authority rule allows writing the record
+    :rtype: bool
+    """
+    cursor = DatabaseRecordWriter.connection().cursor()
+    try:
+        return WriteAuthRuleHandler.can_add_with_auth_rule(DatabaseRecordWriter.records_table, cursor,
+                                                           AppConfig.write_auth_rule, db_record,
+                                                           DatabaseRecordWriter.uniqueness_index())
+    finally:
+        cursor.close()
+
+
+def update_records(query_record, updated_record, match=RecordMatch.SUBSTRING, dry_run=False):
+    """
+    Set the provided fields of the updated record on the records matching our query record, see
+    DatabaseRecordWriter.apply_rules
+    :return: number of updated records, or None if the write authority rule doesn't allow the update
+    :rtype: int
+    """
+    return DatabaseRecordWriter.apply_rules([MutationRule(query_record, updated_record, match)], dry_run,
+                                            AppConfig.write_auth_rule)[0]
+
+
+class RecordRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the record API requests, see the module docstring for the routes
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "PhonebookHTTP/1.0"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # responses are buffered and sent in one go when the request is done, instead of a write per header
+    wbufsize = -1
+    # SQLite only has a single writer anyway, this keeps the auth rule check and the write it allows together
+    write_lock = threading.Lock()
+
+    routes = {'/records': {'GET': 'query_records', 'POST': 'add_record', 'PATCH': 'update_records',
+                           'DELETE': 'delete_records'},
+              '/search':  {'GET': 'search_records'},
+              '/export':  {'GET': 'export_records'},
+              '/prefix_counts': {'GET': 'prefix_counts'}}
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PATCH(self):
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # small responses on kept alive connections would otherwise wait on delayed ACKs of the previous ones
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle_one_request(self):
+        # hand the db connection back between requests, so idle keep-alive connections don't hold on to one
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            DatabaseRecordReader.release_connection()
+            DatabaseRecordWriter.release_connection()
+
+    def log_request(self, code='-', size='-'):
+        if getattr(self.server, 'log_requests', False):
+            BaseHTTPRequestHandler.log_request(self, code, size)
+
+    def dispatch(self):
+        self.streaming = False
+        url = urlparse(self.path)
+        self.params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        try:
+            methods = self.routes.get(url.path)
+            if methods is None:
+                raise HTTPError(404, "No such route: {}".format(url.path))
+            if self.command not in methods:
+                raise HTTPError(405, "{} only supports {}.".format(url.path, ", ".join(sorted(methods))))
+            result = getattr(self, methods[self.command])()
+            if result is not None:
+                self.send_json(*result)
+        except Exception as error:
+            if self.streaming:
+                # too late for an error response, cutting the stream short tells the client it's incomplete
+                self.log_error("%s %s failed while streaming: %r", self.command, self.path, error)
+                self.close_connection = True
+            elif isinstance(error, HTTPError):
+                self.send_json(error.status, {"error": str(error)})
+            elif isinstance(error, ValueError):
+                self.send_json(400, {"error": str(error).strip()})
+            else:
+                self.log_error("%s %s failed: %r", self.command, self.path, error)
+                self.send_json(500, {"error": "Internal server error."})
+
+    def read_body(self):
+        """
+        :return: JSON body of the request, an empty object if it has none
+        :rtype: dict
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400, "Request body should be a JSON object.")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "Request body should be a JSON object.")
+        return body
+
+    def int_param(self, name, default=None):
+        value = self.params.get(name)
+        if value is None or value == "":
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPError(400, "Invalid {} provided: {!r}. Please use an integer.".format(name, value))
+
+    def send_json(self, status, body):
+        data = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def query_records(self):
+        order = self.params.get("order") or RecordOrder.ID
+        if order not in RecordOrder.ALL_ORDERS:
+            raise HTTPError(400, "Invalid order provided: {!r}. Supported orders: {}"
+                            .format(order, RecordOrder.ALL_ORDERS))
+        page = self.params.get("page")
+        result_page = DatabaseRecordReader.get_page(request_record(self.params),
+                                                    request_match(self.params.get("match", "substring")),
+                                                    self.int_param("limit", DEFAULT_PAGE_SIZE),
+                                                    decode_page_cursor(page) if page else None, order)
+        body = {"records": [record_to_dict(record) for record in result_page.records]}
+        if result_page.next_after is not None:
+            body["next_page"] = encode_page_cursor(result_page.next_after)
+        return 200, body
+
+    def search_records(self):
+        records = DatabaseRecordReader.search_records(self.params.get("text", ""), self.int_param("limit", 20),
+                                                      self.params.get("fuzzy", "").lower() in ("1", "true", "yes"))
+        return 200, {"records": [record_to_dict(record) for record in records]}
+
+    def prefix_counts(self):
+        counts = DatabaseRecordReader.count_phone_prefixes(self.int_param("digits", 3), self.params.get("within"))
+        return 200, {"counts": [{"prefix": prefix, "records": count} for prefix, count in counts]}
+
+    def add_record(self):
+        record = request_record(self.read_body())
+        if not all([record.name, record.phone, record.address]):
+            raise HTTPError(400, "New records need a name, phone and address.")
+        with self.write_lock:
+            if not can_write(record):
+                raise HTTPError(409, "According to the current write authority rule, this record can't be added.")
+            DatabaseRecordWriter.add_record(record)
+        return 201, {"added": record_to_dict((record.name, record.phone, record.address))}
+
+    def update_records(self):
+        body = self.read_body()
+        query_record, updated_record = request_record(body.get("query", {})), request_record(body.get("set", {}))
+        if not any([updated_record.name, updated_record.phone, updated_record.address]):
+            raise HTTPError(400, "Please provide the fields to update in \"set\".")
+        with self.write_lock:
+            updated = update_records(query_record, updated_record, request_match(body.get("match", "substring")),
+                                     bool(body.get("dry_run")))
+        if updated is None:
+            raise HTTPError(409, "According to the current write authority rule, these records can't be updated.")
+        return 200, {"updated": updated, "dry_run": bool(body.get("dry_run"))}
+
+    def delete_records(self):
+        body = self.read_body()
+        query_record = request_record(body.get("query", {}))
+        if not any([query_record.name, query_record.phone, query_record.address]):
+            raise HTTPError(400, "Please provide the fields of the records to delete in \"query\".")
+        match = request_match(body.get("match", "substring"))
+        if body.get("dry_run"):
+            return 200, {"deleted": DatabaseRecordWriter.apply_rules([MutationRule(query_record, None, match)],
+                                                                     dry_run=True)[0], "dry_run": True}
+        with self.write_lock:
+            result = DatabaseRecordWriter.delete_record(query_record, match)
+        return 200, {"deleted": result.rowcount, "dry_run": False}
+
+    def export_records(self):
+        """
+        Stream every record in the requested serial format (the configured one by default) with chunked transfer
+        encoding, so the export is never held in memory and the client gets the first records right away.
+        Compressed formats (ie. csv.gz) are compressed as they're streamed.
+        """
+        extension = self.params.get("format") or AppConfig.serial_format['extension']
+        serial_format = next((_format for _format in SerialFormats.ALL_FORMATS
+                              if _format['extension'] == extension), None)
+        if serial_format is None:
+            raise HTTPError(400, "Invalid format provided: {!r}. Supported formats: {}"
+                            .format(extension, [_format['extension'] for _format in SerialFormats.ALL_FORMATS]))
+        writer = serial_format['writer']
+        self.send_response(200)
+        compression = compression_of(extension)
+        self.send_header("Content-Type", CONTENT_TYPES.get(compression or extension, 'application/octet-stream'))
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.streaming = True
+        pending, size = [], 0
+        chunks = (chunk if writer.binary else chunk.encode('utf-8')
+                  for chunk in writer.iter_chunks(DatabaseRecordReader.iter_all_records()))
+        for chunk in (iter_compressed(chunks, compression) if compression else chunks):
+            pending.append(chunk)
+            size += len(pending[-1])
+            if size >= EXPORT_CHUNK_SIZE:
+                self.write_chunk(b"".join(pending))
+                pending, size = [], 0
+        if size:
+            self.write_chunk(b"".join(pending))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        self.wfile.write("{:x}\r\n".format(len(data)).encode('ascii') + data + b"\r\n")
+
+
+class RecordServer(HTTPServer):
+    """
+    HTTP server handing each accepted connection to a fixed pool of worker threads. A keep-alive connection keeps
+    its worker until it's closed or stays idle for KEEP_ALIVE_TIMEOUT, so use at least as many workers as
+    concurrent clients. Connections accepted while every worker is busy wait in the queue.
+    """
+    allow_reuse_address = True
+    request_queue_size  = 128
+    log_requests        = False
+
+    def __init__(self, server_address, handler_class=RecordRequestHandler, workers=DEFAULT_WORKERS):
+        if workers < 1:
+            raise ValueError("Invalid number of server workers provided. Please use a positive integer.")
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.connections = Queue()
+        self.workers = [threading.Thread(target=self._work, name="record-server-{}".format(index))
+                        for index in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self.connections.get()
+            if item is _STOP:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for _ in self.workers:
+            self.connections.put(_STOP)
+        for worker in self.workers:
+            worker.join()
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS, log_requests=False):
+    """
+    Serve the record API until interrupted
+    :param host: interface we listen on, only the local machine by default
+    :type host: str
+    :param port: port we listen on
+    :type port: int
+    :param workers: number of worker threads handling connections
+    :type workers: int
+    :param log_requests: whether every request is logged to stderr, errors always are
+    :type log_requests: bool
+    :return: None
+    """
+    server = RecordServer((host, port), workers=workers)
+    server.log_requests = log_requests
+    sys.stdout.write("Serving records on http://{}:{} with {} workers, press Ctrl+C to stop.\n"
+                     .format(server.server_address[0], server.server_address[1], workers))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
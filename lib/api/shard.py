@@ -0,0 +1,694 @@
+"""
+Module used to store records across several SQLite database files (shards) instead of the single phonebook file,
+so very large phonebooks aren't limited by the size of one file, and writes to different shards don't wait on
+each other's write lock. Records are hash partitioned by phone: a record always lives in the shard of its phone.
+
+Every shard is accessed through its own subclass of DatabaseRecordReader/DatabaseRecordWriter, so each one keeps
+its own connection pool, query cache and uniqueness index. ShardedRecordReader and ShardedRecordWriter have the
+same methods as the single file reader/writer: writes go to the shard of the record's phone, and queries fan out
+across the shards on a pool of worker threads, their results merged back in the requested order. Use
+record_handlers to get the reader/writer of the configured storage. The shard count and the file name layout of
+the shards are set in config.ini (see AppConfig.change_shard_settings), and rebalance_shards moves the records when
+the shard count changes.
+
+Write authority rules on the phone (phone unique, all fields unique) are checked in the shard of the record only,
+as every record with the same phone is in that shard. Rules on the name or address are checked in every shard.
+Writes spanning several shards (bulk adds, rules changing phones) are committed shard by shard, not atomically.
+"""
+
+
+import os
+import zlib
+import atexit
+import heapq
+import threading
+from itertools import chain, islice
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+from async_record_handler import RecordExecutor
+from auth import WriteAuthRules, WriteAuthRuleHandler
+from conf import AppConfig
+from connection import ConnectionManager
+from record_handler import DatabaseRecordReader, DatabaseRecordWriter, DatabaseRecord, RecordMatch, RecordOrder, \
+    RecordPage, WriteResult, BatchWriteResult, RECORD_FIELDS
+from lib.utils import iter_batches
+
+# reader/writer classes of each shard file, see shard_handlers
+_shard_handlers = {}
+_shard_handlers_lock = threading.Lock()
+
+
+def shard_of_phone(phone, shard_count):
+    """
+    Index of the shard a phone is stored in. Phones are hashed with crc32, which is stable across processes and
+    Python versions (unlike hash), and spreads the consecutive phones of an exchange evenly across the shards.
+    :param phone: phone as an integer stream
+    :type phone: int
+    :param shard_count: number of shards
+    :type shard_count: int
+    :return: index of the shard
+    :rtype: int
+    """
+    if shard_count == 1 or phone is None:
+        return 0
+    return (zlib.crc32(str(phone).encode('ascii')) & 0xffffffff) % shard_count
+
+
+def shard_paths(shard_count=None, shard_layout=None):
+    """
+    Database files of the shards, next to the phonebook file. A single shard is the phonebook file itself.
+    :param shard_count: number of shards, AppConfig.shard_count if not provided
+    :type shard_count: int
+    :param shard_layout: file name of each shard, AppConfig.shard_layout if not provided
+    :type shard_layout: str
+    :return: path of each shard, in shard order
+    :rtype: list
+    """
+    shard_count = AppConfig.shard_count if shard_count is None else int(shard_count)
+    if shard_count == 1:
+        return [DatabaseRecordWriter.database_path]
+    shard_layout = shard_layout or AppConfig.shard_layout
+    return [os.path.join(os.path.dirname(DatabaseRecordWriter.database_path),
+                         shard_layout.format(shard=index, count=shard_count))
+            for index in range(shard_count)]
+
+
+def shard_handlers(database_path):
+    """
+    Get the reader and writer classes of a shard: subclasses of DatabaseRecordReader/DatabaseRecordWriter using the
+    shard's database file, created on first use
+    :param database_path: path of the shard's database file
+    :type database_path: str
+    :return: reader and writer class of the shard
+    :rtype: tuple
+    """
+    with _shard_handlers_lock:
+        if database_path not in _shard_handlers:
+            name = os.path.basename(database_path)
+            _shard_handlers[database_path] = (
+                type('ShardReader_{}'.format(name), (DatabaseRecordReader,), {'database_path': database_path}),
+                type('ShardWriter_{}'.format(name), (DatabaseRecordWriter,), {'database_path': database_path}))
+        return _shard_handlers[database_path]
+
+
+def record_handlers():
+    """
+    Get the reader and writer of the configured storage: DatabaseRecordReader/DatabaseRecordWriter with a single
+    shard, ShardedRecordReader/ShardedRecordWriter otherwise
+    :return: reader and writer class
+    :rtype: tuple
+    """
+    if AppConfig.shard_count == 1:
+        return DatabaseRecordReader, DatabaseRecordWriter
+    return ShardedRecordReader, ShardedRecordWriter
+
+
+def merge_shard_results(results, order_by=None, limit=None):
+    """
+    Merge the records each shard returned for the same query. Records ordered by a field are merged in that order,
+    other records are returned shard by shard, as ids are only unique within a shard.
+    :param results: records of each shard, each in the requested order
+    :type results: list
+    :param order_by: field the records are ordered by, see RecordOrder
+    :type order_by: str
+    :param limit: max number of records
+    :type limit: int
+    :return: generator of merged records
+    :rtype: generator
+    """
+    if order_by in (None, RecordOrder.ID):
+        merged = chain(*results)
+    else:
+        column = RECORD_FIELDS.index(order_by)
+        # shard and position in the shard break ties, so equal values keep the order their shard returned them in
+        merged = (row for _, _, _, row in heapq.merge(*[_keyed_rows(rows, column, shard)
+                                                       for shard, rows in enumerate(results)]))
+    return islice(merged, limit)
+
+
+def _keyed_rows(rows, column, shard):
+    for position, row in enumerate(rows):
+        yield row[column], shard, position, row
+
+
+def _can_add(writer, auth_rule, db_record):
+    cursor = writer.connection().cursor()
+    try:
+        return WriteAuthRuleHandler.can_add_with_auth_rule(writer.records_table, cursor, auth_rule, db_record,
+                                                           writer.uniqueness_index())
+    finally:
+        cursor.close()
+
+
+def _accepted_records(writer, auth_rule, db_records):
+    cursor = writer.connection().cursor()
+    try:
+        accepted, _ = WriteAuthRuleHandler.filter_records_with_auth_rule(writer.records_table, cursor, auth_rule,
+                                                                         db_records, writer.uniqueness_index())
+    finally:
+        cursor.close()
+    return set(id(record) for record in accepted)
+
+
+def _count_records(handler):
+    cursor = handler.connection().cursor()
+    try:
+        return cursor.execute("SELECT count(*) FROM {table}".format(table=handler.records_table)).fetchone()[0]
+    finally:
+        cursor.close()
+
+
+class ShardedRecordHandler(object):
+    """
+    Base class for the sharded readers/writers, giving access to the shards of the configured storage and
+    running work on every shard at once
+    """
+    # threads each query fans out on. Workers return their shard connections after every task, so they never hold
+    # more than one connection per shard while other threads wait on the pool.
+    workers         = 8
+    executor        = None
+    executor_lock   = threading.Lock()
+    # shards of each (shard count, shard layout, phonebook file) configuration
+    shards_by_config = {}
+
+    @classmethod
+    def shards(cls):
+        """
+        :return: reader and writer class of each shard, in shard order
+        :rtype: list
+        """
+        key = (AppConfig.shard_count, AppConfig.shard_layout, DatabaseRecordWriter.database_path)
+        shards = ShardedRecordHandler.shards_by_config.get(key)
+        if shards is None:
+            shards = ShardedRecordHandler.shards_by_config[key] = [shard_handlers(path) for path in shard_paths()]
+        return shards
+
+    @classmethod
+    def readers(cls):
+        return [reader for reader, _ in cls.shards()]
+
+    @classmethod
+    def writers(cls):
+        return [writer for _, writer in cls.shards()]
+
+    @classmethod
+    def shard_for_phone(cls, phone):
+        """
+        :return: reader and writer class of the shard a phone is stored in
+        :rtype: tuple
+        """
+        shards = cls.shards()
+        return shards[shard_of_phone(phone, len(shards))]
+
+    @classmethod
+    def fan_out(cls, function, handlers, arguments=None):
+        """
+        Run function(handler) (or function(handler, argument) with the matching argument) for every shard handler
+        at once on the executor, and wait for all of them
+        :param function: function we want to run on every shard
+        :type function: function
+        :param handlers: reader or writer class of each shard we want to run it on
+        :type handlers: list
+        :param arguments: optional argument of each handler
+        :type arguments: list
+        :return: result of each function call, in handler order
+        :rtype: list
+        """
+        calls = [(handler,) if arguments is None else (handler, argument)
+                 for handler, argument in zip(handlers, arguments or handlers)]
+        if len(calls) == 1:
+            return [function(*calls[0])]
+        executor = cls._executor()
+        futures = [executor.submit(cls._run, function, call) for call in calls]
+        return [future.result() for future in futures]
+
+    @classmethod
+    def _run(cls, function, call):
+        try:
+            return function(*call)
+        finally:
+            call[0].release_connection()
+
+    @classmethod
+    def _executor(cls):
+        with ShardedRecordHandler.executor_lock:
+            if ShardedRecordHandler.executor is None:
+                ShardedRecordHandler.executor = RecordExecutor(cls.workers, ShardedRecordHandler)
+                # workers return their connections on exit, which daemon threads killed at shutdown can't do
+                atexit.register(ShardedRecordHandler.executor.shutdown)
+            return ShardedRecordHandler.executor
+
+    @classmethod
+    def release_connection(cls):
+        """
+        Return the calling thread's connection of every shard to its pool
+        :return: None
+        """
+        for reader, _ in cls.shards():
+            reader.release_connection()
+
+    @classmethod
+    def invalidate_query_cache(cls):
+        for reader, _ in cls.shards():
+            reader.invalidate_query_cache()
+
+
+class ShardedRecordReader(ShardedRecordHandler):
+    """
+    Class responsible for all read operations across the shards. Page cursors and offsets are not supported, as
+    record ids are only unique within a shard.
+    """
+    @classmethod
+    def get_all_records(cls, limit=None, after=None, order_by=None, offset=0):
+        """
+        Fetch all the records of every shard at once, see get_records
+        :return: all records
+        :rtype: list
+        """
+        return cls.get_records(DatabaseRecord(), RecordMatch.SUBSTRING, limit, after, order_by, offset)
+
+    @classmethod
+    def iter_all_records(cls, limit=None, after=None, order_by=None, offset=0):
+        """
+        Lazily fetch all the records of every shard, see iter_records
+        :return: generator of all records
+        :rtype: generator
+        """
+        return cls.iter_records(DatabaseRecord(), RecordMatch.SUBSTRING, limit, after, order_by, offset)
+
+    @classmethod
+    def get_records(cls, db_record, match=RecordMatch.SUBSTRING, limit=None, after=None, order_by=None, offset=0):
+        """
+        Fetch the records matching our query data in every shard at once, and merge them. Each shard returns at most
+        limit records, which are merged in order_by order before the limit is applied.
+        :param db_record: record to use as query data for db
+        :type db_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :param limit: max number of records
+        :type limit: int
+        :param order_by: field records are ordered by, see RecordOrder
+        :type order_by: str
+        :return: records matching query criteria
+        :rtype: list
+        """
+        cls._check_paging(after, offset)
+        results = cls.fan_out(lambda reader: reader.get_records(db_record, match, limit, order_by=order_by),
+                              cls._query_readers(db_record, match))
+        return list(merge_shard_results(results, order_by, limit))
+
+    @classmethod
+    def iter_records(cls, db_record, match=RecordMatch.SUBSTRING, limit=None, after=None, order_by=None, offset=0):
+        """
+        Lazily fetch the records matching our query data, streaming every shard from the calling thread, so no
+        shard's results are ever held in memory
+        :return: generator of records matching query criteria
+        :rtype: generator
+        """
+        cls._check_paging(after, offset)
+        return merge_shard_results([reader.iter_records(db_record, match, limit, order_by=order_by)
+                                    for reader in cls._query_readers(db_record, match)], order_by, limit)
+
+    @classmethod
+    def get_page(cls, db_record=None, match=RecordMatch.SUBSTRING, limit=100, after=None, order_by=RecordOrder.ID):
+        """
+        Fetch the first page of the records matching our query data. There is no cursor to the next page, as
+        record ids are only unique within a shard.
+        :return: records of the first page, and None as the next page cursor
+        :rtype: RecordPage
+        """
+        if limit < 1:
+            raise ValueError("Invalid page size provided. Please use a positive integer.")
+        cls._check_paging(after)
+        return RecordPage(cls.get_records(db_record or DatabaseRecord(), match, limit, order_by=order_by), None)
+
+    @classmethod
+    def count_phone_prefixes(cls, digits, within=None):
+        """
+        Count the records per phone prefix in every shard at once, see DatabaseRecordReader.count_phone_prefixes
+        :return: (prefix, record count) pairs, in prefix order
+        :rtype: list
+        """
+        totals = {}
+        for counts in cls.fan_out(lambda reader: reader.count_phone_prefixes(digits, within), cls.readers()):
+            for prefix, count in counts:
+                totals[prefix] = totals.get(prefix, 0) + count
+        return sorted(totals.items())
+
+    @classmethod
+    def count_area_codes(cls):
+        return cls.count_phone_prefixes(3)
+
+    @classmethod
+    def count_exchanges(cls, area_code=None):
+        return cls.count_phone_prefixes(6, area_code)
+
+    @classmethod
+    def search_records(cls, text, limit=20, fuzzy=False):
+        """
+        Full text search every shard at once. Search ranks aren't comparable across shards, so the best matches of
+        each shard are interleaved: the best match of every shard first, then their second best, and so on.
+        :return: matching records, best matches first
+        :rtype: list
+        """
+        results = cls.fan_out(lambda reader: reader.search_records(text, limit, fuzzy), cls.readers())
+        return [row for rank in zip_longest(*results) for row in rank if row is not None][:limit]
+
+    @classmethod
+    def _query_readers(cls, db_record, match):
+        # an exact phone can only be in one shard
+        if db_record.phone not in (None, "") and RecordMatch.for_field('phone', match) == RecordMatch.EXACT:
+            return [cls.shard_for_phone(db_record.phone)[0]]
+        return cls.readers()
+
+    @staticmethod
+    def _check_paging(after=None, offset=0):
+        if after is not None or offset:
+            raise ValueError("Page cursors and offsets are not supported with sharded storage, as record ids are only "
+                             "unique within a shard. Please use a limit and order instead.")
+
+
+class ShardedRecordWriter(ShardedRecordHandler):
+    """
+    Class responsible for all write operations across the shards
+    """
+    # held while checking and writing records under a rule spanning every shard, see can_add
+    write_lock      = threading.Lock()
+    shard_locks     = {}
+
+    @classmethod
+    def create_records_database(cls):
+        """
+        Create or migrate the tables of every shard, see DatabaseRecordWriter.create_records_database
+        :return: setup success
+        :rtype: bool
+        """
+        return all(writer.create_records_database() for writer in cls.writers())
+
+    @classmethod
+    def enable_uniqueness_index(cls, verify=False):
+        """
+        Load the uniqueness index of every shard, see DatabaseRecordWriter.enable_uniqueness_index
+        :return: loaded index of each shard
+        :rtype: list
+        """
+        return [writer.enable_uniqueness_index(verify) for writer in cls.writers()]
+
+    @classmethod
+    def disable_uniqueness_index(cls):
+        for writer in cls.writers():
+            writer.disable_uniqueness_index()
+
+    @staticmethod
+    def is_cross_shard(auth_rule):
+        """
+        :return: whether an authority rule has to be checked in every shard, as it doesn't involve the phone
+        :rtype: bool
+        """
+        fields = WriteAuthRules.RULE_FIELDS[auth_rule]
+        return bool(fields) and 'phone' not in fields
+
+    @classmethod
+    def rule_lock(cls, auth_rule, phone):
+        """
+        Lock held while a record is checked against an authority rule and written, so two threads of this process
+        can't both pass the check with clashing records: a lock per shard for rules on the phone, a single lock
+        for rules spanning every shard
+        :rtype: Lock
+        """
+        if cls.is_cross_shard(auth_rule):
+            return cls.write_lock
+        with cls.write_lock:
+            return cls.shard_locks.setdefault(cls.shard_for_phone(phone)[1].database_path, threading.Lock())
+
+    @classmethod
+    def can_add(cls, db_record, auth_rule=None):
+        """
+        Check a record against an authority rule, in the shard of its phone for rules on the phone, in every shard
+        otherwise
+        :param db_record: record we want to write
+        :type db_record: DatabaseRecord
+        :param auth_rule: authority rule we want to check against, AppConfig.write_auth_rule if not provided
+        :type auth_rule: int
+        :return: whether the rule allows writing the record
+        :rtype: bool
+        """
+        auth_rule = AppConfig.write_auth_rule if auth_rule is None else auth_rule
+        writers = cls.writers() if cls.is_cross_shard(auth_rule) else [cls.shard_for_phone(db_record.phone)[1]]
+        return all(cls.fan_out(lambda writer: _can_add(writer, auth_rule, db_record), writers))
+
+    @classmethod
+    def add_record(cls, db_record, auth_rule=None):
+        """
+        Add a record to the shard of its phone. With an authority rule, the record is checked and written under
+        rule_lock, and only written if the rule allows it.
+        :param db_record: record we want to add
+        :type db_record: DatabaseRecord
+        :param auth_rule: authority rule the record is checked against, written unchecked if not provided
+        :type auth_rule: int
+        :return: number of added records
+        :rtype: WriteResult
+        """
+        writer = cls.shard_for_phone(db_record.phone)[1]
+        if auth_rule is None:
+            return writer.add_record(db_record)
+        with cls.rule_lock(auth_rule, db_record.phone):
+            if not cls.can_add(db_record, auth_rule):
+                return WriteResult(0)
+            return writer.add_record(db_record)
+
+    @classmethod
+    def add_records(cls, db_records, batch_size=None, auth_rule=None):
+        """
+        Bulk add records, each batch split by shard and written to every shard at once. Rules on the phone are
+        checked by each shard on its part of the batch. For rules spanning every shard, the whole batch is checked
+        in every shard under write_lock, and only the records every shard accepts are written.
+        :param db_records: records we want to add
+        :type db_records: iterable
+        :param batch_size: number of records per batch (defaults to DatabaseRecordWriter.batch_size)
+        :type batch_size: int
+        :param auth_rule: authority rule each batch is filtered with, all records are written if not provided
+        :type auth_rule: int
+        :return: accepted/rejected counts for each written batch
+        :rtype: list
+        """
+        writers = cls.writers()
+        cross_shard = auth_rule is not None and cls.is_cross_shard(auth_rule)
+        results = []
+        for batch in iter_batches(db_records, batch_size or DatabaseRecordWriter.batch_size):
+            if cross_shard:
+                with cls.write_lock:
+                    verdicts = cls.fan_out(lambda writer: _accepted_records(writer, auth_rule, batch), writers)
+                    accepted = [record for record in batch if all(id(record) in verdict for verdict in verdicts)]
+                    written = cls.add_routed(writers, accepted, None)
+            else:
+                written = cls.add_routed(writers, batch, auth_rule)
+            results.append(BatchWriteResult(len(results), written, len(batch) - written))
+        return results
+
+    @classmethod
+    def add_routed(cls, writers, db_records, auth_rule=None):
+        """
+        Add records to the shard of their phone, writing to every shard at once
+        :param writers: writer class of each shard
+        :type writers: list
+        :param db_records: records we want to add
+        :type db_records: list
+        :param auth_rule: authority rule each shard filters its records with, all records are written if not provided
+        :type auth_rule: int
+        :return: number of records written
+        :rtype: int
+        """
+        routed = [[] for _ in writers]
+        for record in db_records:
+            routed[shard_of_phone(record.phone, len(writers))].append(record)
+        shards = [(writer, records) for writer, records in zip(writers, routed) if records]
+        results = cls.fan_out(lambda writer, records: writer.add_records(records, len(records), auth_rule),
+                              [writer for writer, _ in shards], [records for _, records in shards])
+        return sum(result.accepted for batches in results for result in batches)
+
+    @classmethod
+    def delete_record(cls, query_record, match=RecordMatch.SUBSTRING):
+        """
+        Delete the records matching our query data in every shard at once
+        :return: number of deleted records
+        :rtype: WriteResult
+        """
+        results = cls.fan_out(lambda writer: writer.delete_record(query_record, match),
+                              cls._query_writers(query_record, match))
+        return WriteResult(sum(result.rowcount for result in results))
+
+    @classmethod
+    def apply_rules(cls, rules, dry_run=False, auth_rule=None):
+        """
+        Apply bulk update/delete rules in every shard at once, see DatabaseRecordWriter.apply_rules. Records whose
+        phone was changed are then moved to the shard of their new phone.
+        :param rules: rules in priority order
+        :type rules: list
+        :param dry_run: whether to only count the records each rule would change
+        :type dry_run: bool
+        :param auth_rule: authority rule the updated records must satisfy, see check_rules
+        :type auth_rule: int
+        :return: number of records each rule changed (or would change), None for the rules rejected by auth_rule
+        :rtype: list
+        """
+        if not rules:
+            return []
+        if auth_rule is None:
+            return cls._apply_allowed_rules(rules, [True] * len(rules), dry_run)
+        with cls.write_lock:
+            return cls._apply_allowed_rules(rules, cls.check_rules(rules, auth_rule), dry_run)
+
+    @classmethod
+    def check_rules(cls, rules, auth_rule):
+        """
+        Check bulk update rules against an authority rule across every shard, before any shard writes them, the
+        way DatabaseRecordWriter.reject_colliding_rules does in a single database. Every shard reports the unique
+        values the rules set on its records, then every record of every shard which will hold one of these values
+        once the rules are applied, without writing anything. The rules to reject are picked from the records of
+        all the shards at once (see DatabaseRecordWriter.colliding_rules). Records of rejected rules keep their
+        current values, which can collide with other rules in turn, so rules are checked until none collide.
+        :param rules: rules in priority order
+        :type rules: list
+        :param auth_rule: authority rule the updated records must satisfy
+        :type auth_rule: int
+        :return: whether each rule is allowed
+        :rtype: list
+        """
+        allowed = [True] * len(rules)
+        while any(allowed):
+            numbers = [number for number, ok in enumerate(allowed) if ok]
+            kept = [rules[number] for number in numbers]
+            values = set(value for shard_values in cls.fan_out(lambda writer: writer.rule_values(kept, auth_rule),
+                                                               cls.writers())
+                         for _, value in shard_values)
+            sharing = {}
+            for shard_values in cls.fan_out(lambda writer: writer.rule_values(kept, auth_rule, values),
+                                            cls.writers()):
+                for number, value in shard_values:
+                    sharing.setdefault(value, []).append(number)
+            colliding = DatabaseRecordWriter.colliding_rules(sharing)
+            if not colliding:
+                break
+            for number in colliding:
+                allowed[numbers[number]] = False
+        return allowed
+
+    @classmethod
+    def _apply_allowed_rules(cls, rules, allowed, dry_run):
+        """
+        Apply the allowed rules in every shard, unchecked, see apply_rules
+        :return: number of records each rule changed (or would change), None for the rules which aren't allowed
+        :rtype: list
+        """
+        kept = [rule for rule, ok in zip(rules, allowed) if ok]
+        counts = cls.fan_out(lambda writer: writer.apply_rules(kept, dry_run), cls.writers()) if kept else []
+        if not dry_run:
+            cls.move_phones(set(rule.change.phone for rule in kept
+                                if rule.change is not None and rule.change.phone not in (None, "")))
+        kept_counts = iter([sum(shard_counts) for shard_counts in zip(*counts)])
+        return [next(kept_counts) if ok else None for ok in allowed]
+
+    @classmethod
+    def move_phones(cls, phones):
+        """
+        Move the records with the phones we provide which aren't in the shard of their phone, ie. after an update
+        changed their phone. Records are added to their new shard before being deleted from the old one, so an
+        interrupted move leaves a duplicate rather than losing a record.
+        :param phones: phones of the records which may be in the wrong shard
+        :type phones: iterable
+        :return: number of moved records
+        :rtype: int
+        """
+        writers = cls.writers()
+        moved = 0
+        for index, writer in enumerate(writers):
+            misplaced = [phone for phone in phones if shard_of_phone(phone, len(writers)) != index]
+            for batch in iter_batches(misplaced, 500):
+                cursor = writer.connection().cursor()
+                try:
+                    rows = cursor.execute("SELECT name, phone, address FROM {table} WHERE phone IN ({phones})"
+                                          .format(table=writer.records_table, phones=", ".join("?" * len(batch))),
+                                          batch).fetchall()
+                finally:
+                    cursor.close()
+                cls.add_routed(writers, [DatabaseRecord(*row) for row in rows])
+                for phone in batch:
+                    moved += writer.delete_record(DatabaseRecord(phone=phone), RecordMatch.EXACT).rowcount
+        return moved
+
+    @classmethod
+    def _query_writers(cls, query_record, match):
+        if query_record.phone not in (None, "") and RecordMatch.for_field('phone', match) == RecordMatch.EXACT:
+            return [cls.shard_for_phone(query_record.phone)[1]]
+        return cls.writers()
+
+
+def remove_database_files(database_path):
+    """
+    Close the pooled connections of a database file, and delete it along with its WAL files
+    :param database_path: path of the database file
+    :type database_path: str
+    :return: None
+    """
+    reader, writer = shard_handlers(database_path)
+    writer.disable_uniqueness_index()
+    reader.invalidate_query_cache()
+    ConnectionManager.close_for_path(database_path)
+    for path in [database_path + suffix for suffix in ["", "-wal", "-shm"]]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def rebalance_shards(shard_count, batch_size=10000, save=True):
+    """
+    Change the number of shards records are split across, copying every record to its shard under the new count.
+    The new shards are written next to the current ones (the shard layout should include {count} for their files
+    to differ), and only replace them once every record was copied and counted, so an interrupted rebalance leaves
+    the current shards in use and untouched. Other processes shouldn't write to the phonebook while it runs.
+    :param shard_count: new number of shards, 1 to go back to the single phonebook file
+    :type shard_count: int
+    :param batch_size: number of records copied per transaction
+    :type batch_size: int
+    :param save: whether we want to write the new shard count to config.ini
+    :type save: bool
+    :return: number of records copied
+    :rtype: int
+    """
+    if int(shard_count) < 1:
+        raise ValueError("Invalid shard count provided. Please use a positive integer.")
+    old_paths, new_paths = shard_paths(), shard_paths(shard_count)
+    if old_paths == new_paths:
+        return 0
+    if set(old_paths) & set(new_paths):
+        raise ValueError("The new shards would overwrite the current ones. Please use a shard layout including "
+                         "{count}, ie. phonebook_{shard}_of_{count}.")
+    new_writers = [shard_handlers(path)[1] for path in new_paths]
+    for writer in new_writers:
+        writer.create_records_database()
+        if _count_records(writer):
+            raise ValueError("Shard {} already holds records, please move or delete it before rebalancing."
+                             .format(writer.database_path))
+
+    copied = 0
+    try:
+        for path in old_paths:
+            records = shard_handlers(path)[0].iter_all_records(order_by=RecordOrder.ID)
+            for batch in iter_batches(records, batch_size):
+                ShardedRecordWriter.add_routed(new_writers, [DatabaseRecord(*row) for row in batch])
+                copied += len(batch)
+        stored = sum(_count_records(writer) for writer in new_writers)
+        if stored != copied:
+            raise RuntimeError("Rebalance copied {} records but the new shards hold {}. The current shards were left "
+                               "in use.".format(copied, stored))
+    except BaseException:
+        for path in new_paths:
+            remove_database_files(path)
+        raise
+    AppConfig.change_shard_settings(shard_count=shard_count, quiet=True, save=save)
+    for path in old_paths:
+        remove_database_files(path)
+    return copied
@@ -0,0 +1,273 @@
+"""
+Module used to serve record lookups from memory. A RecordSnapshot loads the whole records table once into a
+compact columnar form: phones in one int64 array, names and addresses each in one UTF-8 blob indexed by an
+offsets array. Millions of records then take a few flat buffers instead of millions of tuples, strings and
+ints, and substring lookups run as a single C level find over a blob instead of a Python loop over rows.
+Snapshots answer queries with the same semantics as DatabaseRecordReader.get_records, but never see writes made
+after they were loaded, reload them to refresh.
+"""
+
+
+import sys
+from array import array
+from bisect import bisect_right
+from numbers import Integral
+
+from record_handler import DatabaseRecordReader, RecordMatch, RecordOrder, RECORD_FIELDS, PHONE_DIGITS
+from lib.utils import INT64_TYPECODE, load_numpy
+
+
+def _utf8(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u"")):
+        value = type(u"")(value)
+    return value.encode('utf-8')
+
+
+class TextColumn(object):
+    """
+    Column of strings stored in one UTF-8 blob, the string of row N being blob[offsets[N]:offsets[N + 1]]
+    """
+    __slots__ = ('blob', 'offsets', 'nulls')
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.offsets = array(INT64_TYPECODE, [0])
+        self.nulls = set()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, value):
+        if value is None:
+            self.nulls.add(len(self))
+        else:
+            self.blob.extend(_utf8(value))
+        self.offsets.append(len(self.blob))
+
+    def freeze(self):
+        """
+        Trade the growable blob for an immutable one once loading is done
+        """
+        self.blob = bytes(self.blob)
+
+    def value(self, row):
+        if row in self.nulls:
+            return None
+        return self.blob[int(self.offsets[row]):int(self.offsets[row + 1])].decode('utf-8')
+
+    def find(self, value, match):
+        """
+        Rows whose string matches the value, found by searching the whole blob at once and mapping each hit back
+        to its row. Hits spanning two rows are skipped, and the search resumes at the next row after each hit,
+        so every row is reported once.
+        :param value: string the rows are matched against
+        :type value: str
+        :param match: how the value is matched, see RecordMatch
+        :type match: int
+        :return: matching rows, in row order
+        :rtype: list
+        """
+        needle = _utf8(value)
+        blob, offsets = self.blob, self.offsets
+        rows = []
+        position = blob.find(needle)
+        while position != -1:
+            row = bisect_right(offsets, position) - 1
+            start, stop = int(offsets[row]), int(offsets[row + 1])
+            end = position + len(needle)
+            if end <= stop and (match == RecordMatch.SUBSTRING or
+                                position == start and (match == RecordMatch.PREFIX or end == stop)):
+                rows.append(row)
+            position = blob.find(needle, stop)
+        return rows
+
+    def matches(self, row, value, match):
+        """
+        :return: whether the string of a single row matches the value, see find
+        :rtype: bool
+        """
+        if row in self.nulls:
+            return False
+        text, needle = self.blob[int(self.offsets[row]):int(self.offsets[row + 1])], _utf8(value)
+        if match == RecordMatch.EXACT:
+            return text == needle
+        if match == RecordMatch.PREFIX:
+            return text.startswith(needle)
+        return needle in text
+
+    def memory_usage(self):
+        return sys.getsizeof(self.blob) + sys.getsizeof(self.offsets) + sys.getsizeof(self.nulls)
+
+
+class PhoneColumn(object):
+    """
+    Column of phones stored in one int64 array. NULL and non numeric phones (left over from the untyped
+    schema) are kept aside in exceptions, with a 0 placeholder in the array.
+    """
+    __slots__ = ('phones', 'exceptions', '_text')
+
+    def __init__(self):
+        self.phones = array(INT64_TYPECODE)
+        self.exceptions = {}
+        self._text = None
+
+    def __len__(self):
+        return len(self.phones)
+
+    def append(self, value):
+        if isinstance(value, Integral):
+            self.phones.append(value)
+        else:
+            self.exceptions[len(self.phones)] = value
+            self.phones.append(0)
+
+    def freeze(self):
+        pass
+
+    def value(self, row):
+        if row in self.exceptions:
+            return self.exceptions[row]
+        return int(self.phones[row])
+
+    def text(self):
+        """
+        Phones in the text form SQLite matches substrings against, built on the first substring lookup
+        :rtype: TextColumn
+        """
+        if self._text is None:
+            text = TextColumn()
+            for row in range(len(self)):
+                text.append(self.value(row))
+            text.freeze()
+            self._text = text
+        return self._text
+
+    def find(self, value, match):
+        """
+        Rows whose phone matches the value. Mirrors the phone filter of build_record_filter: complete numbers are
+        compared exactly, leading digits as a range of numbers, anything else as a substring of the phone's text.
+        :param value: phone, or part of a phone, the rows are matched against
+        :type value: int
+        :param match: how the value is matched, see RecordMatch
+        :type match: int
+        :return: matching rows, in row order
+        :rtype: list
+        """
+        digits = str(value)
+        if digits.isdigit():
+            if match == RecordMatch.EXACT or len(digits) == PHONE_DIGITS:
+                return self._between(int(digits), int(digits))
+            if match == RecordMatch.PREFIX and len(digits) < PHONE_DIGITS:
+                return self._between(int(digits.ljust(PHONE_DIGITS, '0')), int(digits.ljust(PHONE_DIGITS, '9')))
+        return self.text().find(digits, RecordMatch.SUBSTRING)
+
+    def matches(self, row, value, match):
+        """
+        :return: whether the phone of a single row matches the value, see find
+        :rtype: bool
+        """
+        digits = str(value)
+        if digits.isdigit():
+            if match == RecordMatch.EXACT or len(digits) == PHONE_DIGITS:
+                return row not in self.exceptions and self.phones[row] == int(digits)
+            if match == RecordMatch.PREFIX and len(digits) < PHONE_DIGITS:
+                return row not in self.exceptions and \
+                    int(digits.ljust(PHONE_DIGITS, '0')) <= self.phones[row] <= int(digits.ljust(PHONE_DIGITS, '9'))
+        return self.text().matches(row, digits, RecordMatch.SUBSTRING)
+
+    def _between(self, lower, upper):
+        # numpy is optional, only used to vectorize the comparisons when installed
+        numpy = load_numpy()
+        if numpy is not None:
+            view = numpy.frombuffer(self.phones, dtype=numpy.float64 if INT64_TYPECODE == 'd' else numpy.int64)
+            rows = numpy.flatnonzero((view >= lower) & (view <= upper)).tolist()
+        else:
+            rows = [row for row, phone in enumerate(self.phones) if lower <= phone <= upper]
+        if self.exceptions:
+            rows = [row for row in rows if row not in self.exceptions]
+        return rows
+
+    def memory_usage(self):
+        return sys.getsizeof(self.phones) + sys.getsizeof(self.exceptions) + \
+            (self._text.memory_usage() if self._text is not None else 0)
+
+
+class RecordSnapshot(object):
+    """
+    Read only, in memory copy of the records, one column per record field, rows in id order
+    """
+    def __init__(self):
+        # one column per RECORD_FIELDS entry
+        self.columns = (TextColumn(), PhoneColumn(), TextColumn())
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build a snapshot from (name, phone, address) records
+        :param records: records to load
+        :type records: iterable
+        :return: snapshot of the records
+        :rtype: RecordSnapshot
+        """
+        snapshot = cls()
+        names, phones, addresses = snapshot.columns
+        for name, phone, address in records:
+            names.append(name)
+            phones.append(phone)
+            addresses.append(address)
+        for column in snapshot.columns:
+            column.freeze()
+        return snapshot
+
+    @classmethod
+    def load(cls, reader=DatabaseRecordReader):
+        """
+        Build a snapshot of all the records currently stored in the database, streamed in id order
+        :param reader: record reader of the database to load
+        :type reader: DatabaseRecordReader
+        :return: snapshot of the records
+        :rtype: RecordSnapshot
+        """
+        return cls.from_records(reader.iter_all_records(order_by=RecordOrder.ID))
+
+    def record(self, row):
+        """
+        :return: (name, phone, address) record stored at a row
+        :rtype: tuple
+        """
+        return tuple(column.value(row) for column in self.columns)
+
+    def get_records(self, db_record, match=RecordMatch.SUBSTRING):
+        """
+        Fetch the records matching the query data we provide as a record, see DatabaseRecordReader.get_records.
+        The first queried field is looked up with a scan of its whole column, the other fields are only checked
+        on the rows it matched.
+        :param db_record: record to use as query data
+        :type db_record: DatabaseRecord
+        :param match: how the query fields are matched, see RecordMatch
+        :type match: int
+        :return: records matching query criteria
+        :rtype: list
+        """
+        if match not in RecordMatch.ALL_MATCHES:
+            raise ValueError("Invalid match type provided. Please use one of RecordMatch.ALL_MATCHES.")
+        filters = [(column, getattr(db_record, field), RecordMatch.for_field(field, match))
+                   for field, column in zip(RECORD_FIELDS, self.columns) if getattr(db_record, field) not in (None, "")]
+        if not filters:
+            return [self.record(row) for row in range(len(self))]
+        rows = filters[0][0].find(filters[0][1], filters[0][2])
+        for column, value, field_match in filters[1:]:
+            rows = [row for row in rows if column.matches(row, value, field_match)]
+        return [self.record(row) for row in rows]
+
+    def memory_usage(self):
+        """
+        :return: number of bytes taken by the snapshot's columns
+        :rtype: int
+        """
+        return sys.getsizeof(self) + sum(column.memory_usage() for column in self.columns)
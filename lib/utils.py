@@ -1,16 +1,84 @@
+import re
+import sys
+from array import array
+from itertools import islice
+
+PHONE_DIGITS = 10
+# separators people put in phone numbers, removed with a single translate call
+PHONE_SEPARATORS = u"()-. \t/+"
+_UNICODE_SEPARATORS = dict((ord(char), None) for char in PHONE_SEPARATORS)
+_BYTES_SEPARATORS = PHONE_SEPARATORS.encode('ascii')
+# trailing extension, ie. "x12", "ext. 12", "#12"
+_EXTENSION = re.compile(r'\s*(?:ext\.?|x|#)\s*\d+\s*$', re.IGNORECASE)
+_FIRST_PHONE = 10 ** (PHONE_DIGITS - 1)
+# NumPy module once load_numpy has tried importing it, None if it isn't installed
+_numpy = []
+
+
+def _int64_typecode():
+    """
+    Typecode of a 64 bit integer array. 'q' only exists from python 3.3, 'l' is 64 bit on most 64 bit
+    platforms, and doubles hold every 10 digit phone exactly where neither is available.
+    """
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return 'd'
+
+
+# typecode of the arrays phone columns are stored in
+INT64_TYPECODE = _int64_typecode()
+
+
+def load_numpy():
+    """
+    Import NumPy on first use. It's optional, only used to vectorize the batch phone functions, and slow to import,
+    so only the runs that actually vectorize pay for it.
+    :return: numpy module, or None if it isn't installed
+    :rtype: module
+    """
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+
+def _strip_separators(phone_number):
+    if isinstance(phone_number, bytes):
+        return phone_number.translate(None, _BYTES_SEPARATORS)
+    if not isinstance(phone_number, type(u"")):
+        return str(phone_number).translate(None, _BYTES_SEPARATORS)
+    return phone_number.translate(_UNICODE_SEPARATORS)
+
 
 def phone_number_to_integer_stream(phone_number):
     """
-    Convert a phone number in string format with various alphabetic characters into a
-    multi digit integer (ie. (647) 444-1552 => 6474441552 )
+    Convert a phone number in string format with various separator characters into a
+    multi digit integer (ie. (647) 444-1552 => 6474441552, +1 647.444.1552 x12 => 6474441552).
+    Country code 1 and any extension are dropped. Partial numbers (ie. query fragments) are kept as is.
     :param phone_number: phone number we want to convert to a integer
     :type phone_number: object
     :return: phone number as integer stream
     :rtype: int
     """
-    phone_number = str(phone_number)
-    number = phone_number.replace('(', "").replace(')', "").replace('-', "").replace(" ", "")
-    return int("".join(number.split(" ")))
+    number = _strip_separators(phone_number)
+    if not number.isdigit():
+        number = _strip_separators(_EXTENSION.sub("", u"{}".format(phone_number)))
+        if not number.isdigit():
+            raise ValueError("\nInvalid phone number provided: {!r}. Please use digits, with optional (, ), -, ., "
+                             "spaces, +1 and extension.".format(phone_number))
+    if len(number) > PHONE_DIGITS:
+        if len(number) != PHONE_DIGITS + 1 or number[0] != '1':
+            raise ValueError("\nInvalid phone number provided: {!r}. Only 10 digit numbers, with optional +1 "
+                             "country code, are supported.".format(phone_number))
+        number = number[1:]
+    return int(number)
 
 
 def integer_stream_to_phone_number(phone_number):
@@ -23,9 +91,68 @@ def integer_stream_to_phone_number(phone_number):
     :rtype: str
     """
     phone_number = str(phone_number)
-    if len(phone_number) != 10:
+    if len(phone_number) != PHONE_DIGITS:
         raise ValueError("\nInvalid phone number provided. Please use a 10 digit integer stream.")
-    area_code = phone_number[:3]
-    middle = phone_number[3:6]
-    tail = phone_number[-4:]
-    return "({area}) {middle}-{tail}".format(area=area_code, middle=middle, tail=tail)
+    return "(" + phone_number[:3] + ") " + phone_number[3:6] + "-" + phone_number[6:]
+
+
+def phone_numbers_to_integer_streams(phone_numbers):
+    """
+    Batch version of phone_number_to_integer_stream
+    :param phone_numbers: phone numbers we want to convert
+    :type phone_numbers: iterable
+    :return: phone numbers as integer streams
+    :rtype: list
+    """
+    convert = phone_number_to_integer_stream
+    return [convert(phone_number) for phone_number in phone_numbers]
+
+
+def integer_streams_to_phone_numbers(phone_numbers, use_numpy=None):
+    """
+    Batch version of integer_stream_to_phone_number, converting and validating the whole batch at once
+    before formatting. With NumPy, the conversion and validation of integer input are vectorized.
+    :param phone_numbers: integer streams we want to convert
+    :type phone_numbers: list
+    :param use_numpy: whether to use NumPy, by default only for NumPy arrays and when it's installed
+    :type use_numpy: bool
+    :return: phone numbers in readable string format
+    :rtype: list
+    """
+    if use_numpy is None:
+        # the input can only be a NumPy array if something already imported NumPy
+        numpy = sys.modules.get('numpy')
+        use_numpy = numpy is not None and isinstance(phone_numbers, numpy.ndarray)
+    if use_numpy:
+        numpy = load_numpy()
+        if numpy is None:
+            raise RuntimeError("NumPy is not installed. Please install it, or leave use_numpy unset.")
+        phones = numpy.asarray(phone_numbers, dtype=numpy.int64)
+        if len(phones) and (phones.min() < _FIRST_PHONE or phones.max() >= _FIRST_PHONE * 10):
+            raise ValueError("\nInvalid phone number provided. Please use a 10 digit integer stream.")
+        digits = phones.astype(str).tolist()
+    else:
+        digits = [str(phone) for phone in phone_numbers]
+        if digits and set(map(len, digits)) != {PHONE_DIGITS}:
+            raise ValueError("\nInvalid phone number provided. Please use a 10 digit integer stream.")
+    return ["(" + number[:3] + ") " + number[3:6] + "-" + number[6:] for number in digits]
+
+
+def iter_batches(iterable, batch_size):
+    """
+    Split an iterable into lists of at most batch_size items, consuming it lazily
+    so we never hold more than one batch in memory at a time.
+    :param iterable: items we want to split into batches
+    :type iterable: iterable
+    :param batch_size: max number of items per batch
+    :type batch_size: int
+    :return: generator of batches
+    :rtype: generator
+    """
+    if batch_size < 1:
+        raise ValueError("\nInvalid batch size provided. Please use a positive integer.")
+    iterator = iter(iterable)
+    batch = list(islice(iterator, batch_size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, batch_size))
@@ -0,0 +1,95 @@
+import os
+import threading
+import unittest
+
+from lib.api.async_record_handler import AsyncDatabaseRecordReader, AsyncDatabaseRecordWriter
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class BlockingReader(DatabaseRecordReader):
+    """
+    Reader which holds every query until released, counting how many actually ran
+    """
+    release = threading.Event()
+    calls = []
+
+    @classmethod
+    def get_records(cls, db_record, match=None):
+        cls.calls.append(db_record.name)
+        cls.release.wait()
+        return [(db_record.name, 6475550400, "4 Blocking Road")]
+
+
+class CoalescingReader(AsyncDatabaseRecordReader):
+    reader = BlockingReader
+    executor = None
+    in_flight = {}
+
+
+class SmallBufferReader(AsyncDatabaseRecordReader):
+    workers = 2
+    buffer_size = 1
+    executor = None
+    in_flight = {}
+
+
+class TestAsyncRecordHandler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        AsyncDatabaseRecordReader.shutdown()
+        AsyncDatabaseRecordWriter.shutdown()
+        CoalescingReader.shutdown()
+
+    def test_async_add_and_get_records(self):
+        record = DatabaseRecord("Async Writer", 6475550401, "5 Future Road")
+        self.assertTrue(AsyncDatabaseRecordWriter.add_record(record).result(timeout=10))
+        results = AsyncDatabaseRecordReader.get_records(DatabaseRecord("Async Writer")).result(timeout=10)
+        self.assertEqual(results, DatabaseRecordReader.get_records(DatabaseRecord("Async Writer")))
+        self.assertTrue(results)
+
+    def test_async_stream_records(self):
+        self.assertEqual(list(AsyncDatabaseRecordReader.iter_all_records()), DatabaseRecordReader.get_all_records())
+        stream = AsyncDatabaseRecordReader.iter_records(DatabaseRecord(phone="647"))
+        self.assertEqual(list(stream), DatabaseRecordReader.get_records(DatabaseRecord(phone="647")))
+        self.assertEqual(list(stream), [])
+
+    def test_abandoned_streams_release_workers(self):
+        self.assertGreater(len(DatabaseRecordReader.get_all_records()), 2)
+        for _ in range(SmallBufferReader.workers + 1):
+            stream = SmallBufferReader.iter_all_records()
+            next(stream)
+            # dropped mid-stream without being closed
+            del stream
+        with SmallBufferReader.iter_all_records() as stream:
+            next(stream)
+        self.assertEqual(list(stream), [])
+        futures = [SmallBufferReader.get_records(DatabaseRecord(u"Abandoned {}".format(index)))
+                   for index in range(SmallBufferReader.workers * 2)]
+        try:
+            self.assertEqual([future.result(timeout=10) for future in futures], [[]] * len(futures))
+        finally:
+            # returns the workers' connections to the pool the other readers share
+            SmallBufferReader.shutdown()
+
+    def test_async_errors_raised_on_result(self):
+        future = AsyncDatabaseRecordReader.get_records(DatabaseRecord("Error"), match=-1)
+        with self.assertRaises(ValueError):
+            future.result(timeout=10)
+
+    def test_async_coalesce_identical_queries(self):
+        futures = [CoalescingReader.get_records(DatabaseRecord("Coalesced")) for _ in range(10)]
+        other = CoalescingReader.get_records(DatabaseRecord("Other"))
+        BlockingReader.release.set()
+        results = [future.result(timeout=10) for future in futures]
+        self.assertEqual(other.result(timeout=10)[0][0], "Other")
+        self.assertEqual(sorted(BlockingReader.calls), ["Coalesced", "Other"])
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(CoalescingReader.in_flight, {})
@@ -0,0 +1,62 @@
+import os
+import time
+import unittest
+
+from lib.api.cache import QueryCache
+from lib.api.conf import AppConfig
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestQueryCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = QueryCache(2)
+        for key in ['a', 'b']:
+            cache.put(key, key.upper(), cache.generation)
+        self.assertEqual(cache.get('a'), (True, 'A'))
+        cache.put('c', 'C', cache.generation)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 'A'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['entries']), (2, 1, 1, 2))
+
+    def test_ttl_expiry(self):
+        cache = QueryCache(2, ttl=0.01)
+        cache.put('a', 'A', cache.generation)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_stale_put_rejected(self):
+        cache = QueryCache(2)
+        generation = cache.generation
+        cache.invalidate()
+        self.assertFalse(cache.put('a', 'A', generation))
+        self.assertEqual(cache.get('a'), (False, None))
+
+    def test_reader_cache_invalidated_by_writes(self):
+        DatabaseRecordWriter.create_records_database()
+        prev_size = AppConfig.query_cache_size
+        AppConfig.query_cache_size = 16
+        try:
+            query = DatabaseRecord("Cache Test")
+            first = DatabaseRecordReader.get_records(query, RecordMatch.PREFIX)
+            stats = DatabaseRecordReader.query_cache().stats()
+            self.assertEqual(DatabaseRecordReader.get_records(query, RecordMatch.PREFIX), first)
+            self.assertEqual(DatabaseRecordReader.query_cache().stats()['hits'], stats['hits'] + 1)
+            self.assertTrue(DatabaseRecordWriter.add_record(DatabaseRecord("Cache Test", 6445220001, "1 Cache Road")))
+            self.assertEqual(len(DatabaseRecordReader.get_records(query, RecordMatch.PREFIX)), len(first) + 1)
+        finally:
+            AppConfig.query_cache_size = prev_size
+
+    def test_reader_cache_disabled(self):
+        prev_size = AppConfig.query_cache_size
+        AppConfig.query_cache_size = 0
+        try:
+            self.assertIsNone(DatabaseRecordReader.query_cache())
+            self.assertIsNotNone(DatabaseRecordReader.get_records(DatabaseRecord("Cache Test")))
+        finally:
+            AppConfig.query_cache_size = prev_size
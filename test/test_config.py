@@ -1,17 +1,18 @@
 import os
+import sys
 import unittest
-import sqlite3
+import subprocess
+from contextlib import contextmanager
 
 from lib.api.auth import WriteAuthRules
 from lib.api.serialize import  SerialFormats
-from lib.api.conf import setup_app_config, AppConfig
+from lib.api import conf
+from lib.api.conf import setup_app_config, AppConfig, APP_CONFIG_INI_PATH
 from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader
 
 # overwrite our defaults to use a test db + table
 DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
-DatabaseRecordWriter.database_driver = sqlite3.connect(DatabaseRecordWriter.database_path)
 DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
-DatabaseRecordReader.database_driver = sqlite3.connect(DatabaseRecordWriter.database_path)
 
 
 class TestConfig(unittest.TestCase):
@@ -41,3 +42,59 @@ class TestConfig(unittest.TestCase):
         AppConfig.change_write_auth_rule(new_rule)
         self.assertEquals(AppConfig.write_auth_rule, new_rule)
         AppConfig.change_write_auth_rule(prev_rule)  # restore to previous
+
+    def test_database_settings_change(self):
+        prev_settings = (AppConfig.synchronous, AppConfig.cache_size, AppConfig.mmap_size, AppConfig.pool_size)
+        AppConfig.change_database_settings(synchronous='full', cache_size=-4000, mmap_size=1048576, pool_size=2)
+        self.assertEqual((AppConfig.synchronous, AppConfig.cache_size, AppConfig.mmap_size, AppConfig.pool_size),
+                         ('FULL', -4000, 1048576, 2))
+        with self.assertRaises(ValueError):
+            AppConfig.change_database_settings(synchronous='sometimes')
+        AppConfig.change_database_settings(*prev_settings)  # restore to previous
+
+    def test_query_cache_settings_change(self):
+        prev_settings = (AppConfig.query_cache_size, AppConfig.query_cache_ttl)
+        AppConfig.change_query_cache_settings(query_cache_size=0, query_cache_ttl=5)
+        self.assertEqual((AppConfig.query_cache_size, AppConfig.query_cache_ttl), (0, 5.0))
+        with self.assertRaises(ValueError):
+            AppConfig.change_query_cache_settings(query_cache_size=-1)
+        AppConfig.change_query_cache_settings(*prev_settings)  # restore to previous
+
+    def test_shard_settings_change(self):
+        prev_settings = (AppConfig.shard_count, AppConfig.shard_layout)
+        AppConfig.change_shard_settings(shard_count='4', shard_layout='records_{shard}')
+        self.assertEqual((AppConfig.shard_count, AppConfig.shard_layout), (4, 'records_{shard}'))
+        with self.assertRaises(ValueError):
+            AppConfig.change_shard_settings(shard_count=0)
+        with self.assertRaises(ValueError):
+            AppConfig.change_shard_settings(shard_layout='records')
+        AppConfig.change_shard_settings(*prev_settings)  # restore to previous
+
+    def test_config_parsed_once(self):
+        setup_app_config()
+        prev_mtime = os.path.getmtime(APP_CONFIG_INI_PATH)
+        with mock_read_config_ini() as calls:
+            self.assertEqual(setup_app_config(), APP_CONFIG_INI_PATH)
+            self.assertEqual(calls, [])
+            setup_app_config(reload=True)
+            self.assertEqual(calls, [APP_CONFIG_INI_PATH])
+        self.assertEqual(os.path.getmtime(APP_CONFIG_INI_PATH), prev_mtime)
+
+    def test_lazy_imports(self):
+        script = "import sys\nimport lib.api.conf, lib.api.record_handler, lib.api.export, lib.api.delta\n" \
+                 "sys.stdout.write(' '.join(sorted(set(['yaml', 'csv', 'configparser', 'multiprocessing', 'numpy', " \
+                 "'difflib']) & set(sys.modules))))"
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.strip(), b"")
+
+
+@contextmanager
+def mock_read_config_ini():
+    calls = []
+    original = conf.read_config_ini
+    conf.read_config_ini = lambda path: calls.append(path) or original(path)
+    try:
+        yield calls
+    finally:
+        conf.read_config_ini = original
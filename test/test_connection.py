@@ -0,0 +1,66 @@
+import os
+import threading
+import unittest
+
+from lib.api.conf import AppConfig
+from lib.api.connection import ConnectionManager
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestConnection(unittest.TestCase):
+    def test_connection_per_thread(self):
+        manager = ConnectionManager.for_path(DatabaseRecordReader.database_path)
+        self.assertIs(manager, ConnectionManager.for_path(DatabaseRecordWriter.database_path))
+        self.assertIs(DatabaseRecordReader.connection(), DatabaseRecordWriter.connection())
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(manager.connection()) or manager.release())
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], DatabaseRecordReader.connection())
+
+    def test_connection_pragmas(self):
+        connection = DatabaseRecordReader.connection()
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(connection.execute("PRAGMA cache_size").fetchone()[0], int(AppConfig.cache_size))
+
+    def test_connection_pool_reuse(self):
+        manager = ConnectionManager(DatabaseRecordReader.database_path, pool_size=1)
+        with manager.connected() as connection:
+            self.assertIs(manager.connection(), connection)
+        results = []
+
+        def borrow():
+            with manager.connected() as thread_connection:
+                results.append(thread_connection)
+
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        thread.join()
+        self.assertIs(results[0], connection)
+        manager.close_all()
+
+    def test_concurrent_readers(self):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.add_record(DatabaseRecord("Thread Reader", 6475550300, "3 Thread Road"))
+        results, errors = [], []
+
+        def read():
+            try:
+                results.append(len(DatabaseRecordReader.get_records(DatabaseRecord("Thread Reader"))))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                DatabaseRecordReader.release_connection()
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(results))
@@ -1,23 +1,28 @@
 import os
 import unittest
-import sqlite3
+import tempfile
 
 from lib.api.auth import WriteAuthRules
-from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch, \
+    RecordOrder, MutationRule, SCHEMA_VERSION, build_record_filter, encode_page_cursor, decode_page_cursor, \
+    read_mutation_rules
 from lib.api.auth import WriteAuthRuleHandler
+from lib.api.connection import ConnectionManager
 
 
 # overwrite our defaults to use a test db + table
 DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
-DatabaseRecordWriter.database_driver = sqlite3.connect(DatabaseRecordWriter.database_path)
 DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
-DatabaseRecordReader.database_driver = sqlite3.connect(DatabaseRecordWriter.database_path)
+
+
+def vars_of(db_record):
+    return db_record.name, db_record.phone, db_record.address
 
 
 class TestDatabase(unittest.TestCase):
     def test_db_create(self):
         self.assertIsNotNone(DatabaseRecordWriter.database_path)
-        self.assertIsNotNone(DatabaseRecordWriter.database_driver)
+        self.assertIsNotNone(DatabaseRecordWriter.connection())
         self.assertTrue(DatabaseRecordWriter.create_records_database())
 
     def test_db_add_record(self):
@@ -28,7 +33,7 @@ class TestDatabase(unittest.TestCase):
         self.assertTrue(DatabaseRecordWriter.add_record(record2))
 
     def test_check_with_auth_rule(self):
-        driver = DatabaseRecordWriter.database_driver
+        driver = DatabaseRecordWriter.connection()
         cursor = driver.cursor()
         record1 = DatabaseRecord("Tim Cook", "6474478145", "1665 Test Court")
         record2 = DatabaseRecord("Matthew Chase", "6472253364", "502 Testing Road")
@@ -63,3 +68,304 @@ class TestDatabase(unittest.TestCase):
         update1 = DatabaseRecord(address="1234 Someroad St")
         self.assertTrue(DatabaseRecordWriter.update_record_address(query1, update1))
         self.assertIsNotNone(DatabaseRecordReader.get_all_records())
+
+    def test_db_add_records_batched(self):
+        import random
+        phone = random.randrange(6470000000, 6479999999)
+        records = [DatabaseRecord("Batch Record {}".format(index), phone, "{} Batch Road".format(index))
+                   for index in range(5)]
+        results = DatabaseRecordWriter.add_records(iter(records), batch_size=2,
+                                                   auth_rule=WriteAuthRules.WRITE_IF_PHONE_UNIQUE)
+        self.assertEqual([result.batch for result in results], [0, 1, 2])
+        self.assertEqual(sum(result.accepted for result in results), 1)
+        self.assertEqual(sum(result.rejected for result in results), 4)
+        self.assertEqual(len(DatabaseRecordReader.get_records(DatabaseRecord(phone=phone))), 1)
+
+    def test_filter_records_with_auth_rule(self):
+        cursor = DatabaseRecordWriter.connection().cursor()
+        record1 = DatabaseRecord("John Kal", "6445221234", "1554 Long St")
+        self.assertTrue(DatabaseRecordWriter.add_record(record1))
+        record2 = DatabaseRecord("Unique Filter Name", "6445221234", "1 Unique Filter St")
+        accepted, rejected = WriteAuthRuleHandler.filter_records_with_auth_rule(
+            DatabaseRecordWriter.records_table, cursor, WriteAuthRules.WRITE_IF_NAME_UNIQUE, [record1, record2])
+        self.assertEqual((accepted, rejected), ([record2], [record1]))
+        accepted, rejected = WriteAuthRuleHandler.filter_records_with_auth_rule(
+            DatabaseRecordWriter.records_table, cursor, WriteAuthRules.WRITE_ALL_NO_RULE, [record1, record2])
+        self.assertEqual((accepted, rejected), ([record1, record2], []))
+        cursor.close()
+
+    def test_db_schema_migration(self):
+        prev_path = DatabaseRecordWriter.database_path
+        handle, DatabaseRecordWriter.database_path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            driver = DatabaseRecordWriter.connection()
+            driver.execute("CREATE TABLE records(name, phone, address)")
+            driver.execute("INSERT INTO records VALUES('John Kal', '6445221234', '1554 Long St')")
+            driver.commit()
+            self.assertTrue(DatabaseRecordWriter.create_records_database())
+            self.assertTrue(DatabaseRecordWriter.create_records_database())
+            self.assertEqual(driver.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+            self.assertEqual(driver.execute("SELECT id, name, phone, address FROM records").fetchall(),
+                             [(1, "John Kal", 6445221234, "1554 Long St")])
+            indexes = [row[1] for row in driver.execute("PRAGMA index_list(records)").fetchall()]
+            self.assertEqual(sorted(indexes), ["records_address_idx", "records_name_idx", "records_phone_idx"])
+        finally:
+            ConnectionManager.for_path(DatabaseRecordWriter.database_path).close_all()
+            for path in [DatabaseRecordWriter.database_path + suffix for suffix in ["", "-wal", "-shm"]]:
+                if os.path.exists(path):
+                    os.remove(path)
+            DatabaseRecordWriter.database_path = prev_path
+
+    def test_build_record_filter(self):
+        self.assertEqual(build_record_filter(DatabaseRecord()), ("1", ()))
+        self.assertEqual(build_record_filter(DatabaseRecord(phone=6445221234)), ("phone = ?", (6445221234,)))
+        self.assertEqual(build_record_filter(DatabaseRecord(phone="647"), RecordMatch.PREFIX),
+                         ("phone BETWEEN ? AND ?", (6470000000, 6479999999)))
+        self.assertEqual(build_record_filter(DatabaseRecord("Jo", address="Long"), RecordMatch.PREFIX),
+                         ("name >= ? and name < ? and address >= ? and address < ?", ("Jo", "Jp", "Long", "Lonh")))
+        self.assertEqual(build_record_filter(DatabaseRecord("John Kal"), RecordMatch.EXACT), ("name = ?", ("John Kal",)))
+
+    def test_phone_prefix_match(self):
+        self.assertEqual(build_record_filter(DatabaseRecord("Jo", "647555"), RecordMatch.PHONE_PREFIX),
+                         ("instr(name, ?) and phone BETWEEN ? AND ?", ("Jo", 6475550000, 6475559999)))
+        where, params = build_record_filter(DatabaseRecord(phone="647"), RecordMatch.PHONE_PREFIX)
+        plan = " ".join(str(row[-1]) for row in DatabaseRecordReader.connection().execute(
+            "EXPLAIN QUERY PLAN SELECT name, phone, address FROM records WHERE {}".format(where), params))
+        self.assertIn("records_phone_idx", plan)
+        self.assertRaises(ValueError, DatabaseRecordReader.count_phone_prefixes, 10)
+
+    def test_count_phone_prefixes(self):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.delete_record(DatabaseRecord(phone="28955"), RecordMatch.PREFIX)
+        DatabaseRecordWriter.add_records([DatabaseRecord("Prefix One", 2895550001, "1 Prefix Road"),
+                                          DatabaseRecord("Prefix Two", 2895550002, "2 Prefix Road"),
+                                          DatabaseRecord("Prefix Three", 2895560001, "3 Prefix Road")])
+        self.assertEqual(DatabaseRecordReader.count_phone_prefixes(6, "28955"), [(289555, 2), (289556, 1)])
+        self.assertEqual(DatabaseRecordReader.count_phone_prefixes(7, 289555), [(2895550, 2)])
+        self.assertEqual(dict(DatabaseRecordReader.count_exchanges(289)).get(289556), 1)
+        total = DatabaseRecordReader.connection().execute("SELECT count(phone) FROM records").fetchone()[0]
+        self.assertEqual(sum(count for _, count in DatabaseRecordReader.count_area_codes()), total)
+        self.assertEqual(len(DatabaseRecordReader.get_records(DatabaseRecord("Prefix", 28955),
+                                                              RecordMatch.PHONE_PREFIX)), 3)
+        DatabaseRecordWriter.delete_record(DatabaseRecord(phone="28955"), RecordMatch.PREFIX)
+
+    def test_get_records_with_match(self):
+        DatabaseRecordWriter.create_records_database()
+        record = DatabaseRecord("Match Test", 6445221299, "12 Match Road")
+        self.assertTrue(DatabaseRecordWriter.add_record(record))
+        self.assertTrue(DatabaseRecordReader.get_records(DatabaseRecord("Match T"), RecordMatch.PREFIX))
+        self.assertTrue(DatabaseRecordReader.get_records(DatabaseRecord(phone="644522"), RecordMatch.PREFIX))
+        self.assertFalse(DatabaseRecordReader.get_records(DatabaseRecord("atch Test"), RecordMatch.PREFIX))
+        self.assertTrue(DatabaseRecordReader.get_records(DatabaseRecord("atch Test"), RecordMatch.SUBSTRING))
+        self.assertFalse(DatabaseRecordReader.get_records(DatabaseRecord("Match Tes"), RecordMatch.EXACT))
+
+    def test_uniqueness_index(self):
+        import random
+        DatabaseRecordWriter.create_records_database()
+        index = DatabaseRecordWriter.enable_uniqueness_index(verify=True)
+        try:
+            cursor = DatabaseRecordWriter.connection().cursor()
+            phone = random.randrange(6470000000, 6479999999)
+            record = DatabaseRecord("Index Test", str(phone), "7 Index Road")
+            self.assertTrue(index.is_unique(WriteAuthRules.WRITE_IF_PHONE_UNIQUE, record))
+            self.assertTrue(DatabaseRecordWriter.add_record(record))
+            # verify mode cross-checks every answer against the db, so these also check the index is in sync
+            self.assertFalse(WriteAuthRuleHandler.can_add_with_auth_rule(
+                DatabaseRecordWriter.records_table, cursor, WriteAuthRules.WRITE_IF_PHONE_UNIQUE,
+                DatabaseRecord("Other Name", phone, "Other Road"), index))
+            self.assertTrue(DatabaseRecordWriter.update_record_phones(DatabaseRecord(phone=str(phone)),
+                                                                      DatabaseRecord(phone=str(phone + 1))))
+            self.assertTrue(WriteAuthRuleHandler.can_add_with_auth_rule(
+                DatabaseRecordWriter.records_table, cursor, WriteAuthRules.WRITE_IF_PHONE_UNIQUE, record, index))
+            accepted, rejected = WriteAuthRuleHandler.filter_records_with_auth_rule(
+                DatabaseRecordWriter.records_table, cursor, WriteAuthRules.WRITE_IF_PHONE_UNIQUE,
+                [record, DatabaseRecord("Index Test", phone + 1, "7 Index Road")], index)
+            self.assertEqual(accepted, [record])
+            self.assertEqual(len(rejected), 1)
+            self.assertTrue(DatabaseRecordWriter.delete_record(DatabaseRecord(phone=phone + 1), RecordMatch.EXACT))
+            self.assertTrue(index.is_unique(WriteAuthRules.WRITE_IF_PHONE_UNIQUE, rejected[0]))
+            cursor.close()
+        finally:
+            DatabaseRecordWriter.disable_uniqueness_index()
+        self.assertIsNone(DatabaseRecordWriter.uniqueness_index())
+
+    def test_write_transaction(self):
+        import random
+        import sqlite3
+        phone = random.randrange(6470000000, 6479999999)
+        count = lambda: sqlite3.connect(DatabaseRecordWriter.database_path).execute(
+            "SELECT count(*) FROM records WHERE phone BETWEEN ? AND ?", (phone, phone + 1)).fetchone()[0]
+        with DatabaseRecordWriter.transaction():
+            DatabaseRecordWriter.add_record(DatabaseRecord("Transaction Test", phone, "1 Group Road"))
+            with DatabaseRecordWriter.transaction():
+                DatabaseRecordWriter.add_record(DatabaseRecord("Transaction Test", phone + 1, "1 Group Road"))
+            self.assertTrue(DatabaseRecordWriter.in_transaction())
+            # other connections only see the writes once the whole group is committed
+            self.assertEqual(count(), 0)
+        self.assertFalse(DatabaseRecordWriter.in_transaction())
+        self.assertEqual(count(), 2)
+
+        index = DatabaseRecordWriter.enable_uniqueness_index(verify=True)
+        try:
+            with self.assertRaises(ZeroDivisionError):
+                with DatabaseRecordWriter.transaction():
+                    DatabaseRecordWriter.delete_record(DatabaseRecord(phone=phone), RecordMatch.EXACT)
+                    1 / 0
+            self.assertEqual(count(), 2)
+            self.assertIsNot(DatabaseRecordWriter.uniqueness_index(), index)
+            self.assertFalse(DatabaseRecordWriter.uniqueness_index().is_unique(
+                WriteAuthRules.WRITE_IF_PHONE_UNIQUE, DatabaseRecord(phone=phone)))
+        finally:
+            DatabaseRecordWriter.disable_uniqueness_index()
+        DatabaseRecordWriter.delete_record(DatabaseRecord("Transaction Test"), RecordMatch.EXACT)
+        self.assertEqual(count(), 0)
+
+    def test_write_savepoint(self):
+        import random
+        import sqlite3
+        phone = random.randrange(6470000000, 6479999999)
+        count = lambda: sqlite3.connect(DatabaseRecordWriter.database_path).execute(
+            "SELECT count(*) FROM records WHERE phone BETWEEN ? AND ?", (phone, phone + 2)).fetchone()[0]
+        with DatabaseRecordWriter.transaction():
+            DatabaseRecordWriter.add_record(DatabaseRecord("Savepoint Test", phone, "1 Step Road"))
+            with self.assertRaises(ZeroDivisionError):
+                with DatabaseRecordWriter.savepoint():
+                    DatabaseRecordWriter.add_record(DatabaseRecord("Savepoint Test", phone + 1, "1 Step Road"))
+                    1 / 0
+            # the failed step is rolled back, the transaction goes on
+            self.assertTrue(DatabaseRecordWriter.in_transaction())
+            with DatabaseRecordWriter.savepoint():
+                DatabaseRecordWriter.add_record(DatabaseRecord("Savepoint Test", phone + 2, "1 Step Road"))
+            self.assertEqual(count(), 0)
+        self.assertEqual(sqlite3.connect(DatabaseRecordWriter.database_path).execute(
+            "SELECT phone FROM records WHERE phone BETWEEN ? AND ? ORDER BY phone", (phone, phone + 2)).fetchall(),
+            [(phone,), (phone + 2,)])
+        DatabaseRecordWriter.delete_record(DatabaseRecord("Savepoint Test"), RecordMatch.EXACT)
+        self.assertEqual(count(), 0)
+
+    def test_apply_rules(self):
+        import random
+        phone = random.randrange(6470000000, 6479999990)
+        DatabaseRecordWriter.delete_record(DatabaseRecord("Bulk "), RecordMatch.PREFIX)
+        DatabaseRecordWriter.add_records([DatabaseRecord("Bulk Ann", phone, "1 Bulk Road"),
+                                          DatabaseRecord("Bulk Ann", phone + 1, "2 Bulk Road"),
+                                          DatabaseRecord("Bulk Bob", phone + 2, "3 Bulk Road"),
+                                          DatabaseRecord("Bulk Cy", phone + 3, "4 Bulk Road")])
+        bulk_records = lambda: sorted(DatabaseRecordReader.get_records(DatabaseRecord("Bulk "), RecordMatch.PREFIX))
+        before = bulk_records()
+        rules = [
+            # targeted multi-field match, only one of the Bulk Ann records
+            MutationRule(DatabaseRecord("Bulk Ann", address="2 Bulk Road"), DatabaseRecord(phone=phone + 9),
+                         RecordMatch.EXACT),
+            MutationRule(DatabaseRecord("Bulk B"), DatabaseRecord(address="30 Bulk Road"), RecordMatch.PREFIX),
+            MutationRule(DatabaseRecord(phone=phone + 3), None, RecordMatch.EXACT),
+            # records already changed by an earlier rule aren't changed again
+            MutationRule(DatabaseRecord("Bulk "), DatabaseRecord(name="Bulk Other"), RecordMatch.PREFIX),
+        ]
+        self.assertEqual(DatabaseRecordWriter.apply_rules(rules, dry_run=True), [1, 1, 1, 1])
+        self.assertEqual(bulk_records(), before)
+
+        index = DatabaseRecordWriter.enable_uniqueness_index(verify=True)
+        try:
+            self.assertEqual(DatabaseRecordWriter.apply_rules(rules), [1, 1, 1, 1])
+            self.assertEqual(bulk_records(), [("Bulk Ann", phone + 9, "2 Bulk Road"),
+                                              ("Bulk Bob", phone + 2, "30 Bulk Road"),
+                                              ("Bulk Other", phone, "1 Bulk Road")])
+            self.assertFalse(index.is_unique(WriteAuthRules.WRITE_IF_PHONE_UNIQUE, DatabaseRecord(phone=phone + 9)))
+            self.assertTrue(index.is_unique(WriteAuthRules.WRITE_IF_PHONE_UNIQUE, DatabaseRecord(phone=phone + 3)))
+        finally:
+            DatabaseRecordWriter.disable_uniqueness_index()
+
+        self.assertRaises(ValueError, DatabaseRecordWriter.apply_rules, [MutationRule(DatabaseRecord(), None,
+                                                                                      RecordMatch.EXACT)])
+        self.assertRaises(ValueError, DatabaseRecordWriter.apply_rules, [MutationRule(DatabaseRecord("Bulk "),
+                                                                                      DatabaseRecord(),
+                                                                                      RecordMatch.PREFIX)])
+        # rules are applied along with the other writes of a transaction
+        with self.assertRaises(ZeroDivisionError):
+            with DatabaseRecordWriter.transaction():
+                DatabaseRecordWriter.apply_rules([MutationRule(DatabaseRecord("Bulk "), None, RecordMatch.PREFIX)])
+                1 / 0
+        self.assertEqual(len(bulk_records()), 3)
+        DatabaseRecordWriter.delete_record(DatabaseRecord("Bulk "), RecordMatch.PREFIX)
+
+    def test_apply_rules_auth_rule(self):
+        import random
+        phone = random.randrange(6470000000, 6479999980)
+        DatabaseRecordWriter.delete_record(DatabaseRecord("Bulk Auth "), RecordMatch.PREFIX)
+        DatabaseRecordWriter.add_records([DatabaseRecord("Bulk Auth {}".format(name), phone + offset, "Auth Road")
+                                          for offset, name in enumerate(["A", "B", "C", "D", "Multi 1", "Multi 2",
+                                                                         "E", "G"])])
+        exact = lambda name, new_phone: MutationRule(DatabaseRecord("Bulk Auth " + name),
+                                                     DatabaseRecord(phone=new_phone), RecordMatch.EXACT)
+        rules = [exact("A", phone + 10),
+                 # the first rule setting a phone keeps it, later ones are rejected
+                 exact("B", phone + 11),
+                 exact("C", phone + 11),
+                 # a rule can't give several records the same phone
+                 MutationRule(DatabaseRecord("Bulk Auth Multi"), DatabaseRecord(phone=phone + 12), RecordMatch.PREFIX),
+                 # phone freed by the first rule
+                 exact("D", phone),
+                 # phone of a record the rules don't change
+                 exact("G", phone + 6)]
+        expected = [1, 1, None, None, 1, None]
+        auth_rule = WriteAuthRules.WRITE_IF_PHONE_UNIQUE
+        self.assertEqual(DatabaseRecordWriter.apply_rules(rules, dry_run=True, auth_rule=auth_rule), expected)
+        self.assertEqual(DatabaseRecordWriter.apply_rules(rules, auth_rule=auth_rule), expected)
+        self.assertEqual(sorted(record[1] for record in DatabaseRecordReader.get_records(DatabaseRecord("Bulk Auth "),
+                                                                                          RecordMatch.PREFIX)),
+                         [phone, phone + 2, phone + 4, phone + 5, phone + 6, phone + 7, phone + 10, phone + 11])
+        DatabaseRecordWriter.delete_record(DatabaseRecord("Bulk Auth "), RecordMatch.PREFIX)
+
+    def test_read_mutation_rules(self):
+        handle, mapping_path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as mapping_file:
+            mapping_file.write("name,phone,address,new_name,new_phone,new_address,match,op\n"
+                               "John,,,,(647) 555-0100,,exact,\n"
+                               ",416,,,,,,delete\n")
+        try:
+            rules = read_mutation_rules(mapping_path, RecordMatch.PREFIX)
+        finally:
+            os.remove(mapping_path)
+        self.assertEqual([(vars_of(rule.query), rule.change and vars_of(rule.change), rule.match) for rule in rules],
+                         [(("John", None, None), (None, 6475550100, None), RecordMatch.EXACT),
+                          ((None, 416, None), None, RecordMatch.PREFIX)])
+
+    def test_record_pagination(self):
+        prev_path = DatabaseRecordWriter.database_path
+        handle, database_path = tempfile.mkstemp()
+        os.close(handle)
+        DatabaseRecordWriter.database_path = DatabaseRecordReader.database_path = database_path
+        try:
+            DatabaseRecordWriter.create_records_database()
+            rows = [(u"Page Test", 6445221000 + index, u"{} Page Road".format(index % 3)) for index in range(7)]
+            rows.append((u"Another Test", None, u"1 Page Road"))
+            DatabaseRecordWriter.add_records(DatabaseRecord(*row) for row in rows)
+            for order_by, field in [(RecordOrder.ID, None), (RecordOrder.NAME, 0), (RecordOrder.PHONE, 1),
+                                    (RecordOrder.ADDRESS, 2)]:
+                expected = [row for _, row in sorted(enumerate(rows), key=lambda item: (
+                    item[0] if field is None else (item[1][field] is not None, item[1][field]), item[0]))]
+                pages, after = [], None
+                while True:
+                    page = DatabaseRecordReader.get_page(limit=3, after=after, order_by=order_by)
+                    pages.extend(page.records)
+                    if page.next_after is None:
+                        break
+                    after = decode_page_cursor(encode_page_cursor(page.next_after))
+                self.assertEqual(pages, expected)
+                self.assertEqual(DatabaseRecordReader.get_all_records(order_by=order_by), expected)
+            self.assertEqual(DatabaseRecordReader.get_records(DatabaseRecord("Page"), order_by=RecordOrder.PHONE,
+                                                              limit=2, offset=1), rows[1:3])
+            self.assertEqual(DatabaseRecordReader.get_all_records(after=(7,)), rows[7:])
+            self.assertRaises(ValueError, DatabaseRecordReader.get_all_records, order_by='age')
+            self.assertRaises(ValueError, decode_page_cursor, "not a cursor")
+            self.assertEqual(DatabaseRecordWriter.update_record_address(DatabaseRecord(address="0 Page"),
+                                                                        DatabaseRecord(address="9 Page Road")).rowcount, 3)
+            self.assertEqual(DatabaseRecordWriter.delete_record(DatabaseRecord("Page Test")).rowcount, 7)
+        finally:
+            ConnectionManager.for_path(database_path).close_all()
+            for path in [database_path + suffix for suffix in ["", "-wal", "-shm"]]:
+                if os.path.exists(path):
+                    os.remove(path)
+            DatabaseRecordWriter.database_path = DatabaseRecordReader.database_path = prev_path
@@ -0,0 +1,91 @@
+import os
+import unittest
+
+from lib.api.conf import AppConfig
+from lib.api.dedup import DuplicateFinder, normalize_address, normalize_name, normalize_phone, soundex
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestDedup(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.delete_record(DatabaseRecord(u"Dedup "), RecordMatch.PREFIX)
+
+    @classmethod
+    def tearDownClass(cls):
+        DatabaseRecordWriter.delete_record(DatabaseRecord(u"Dedup "), RecordMatch.PREFIX)
+
+    def dedup_rows(self):
+        cursor = DatabaseRecordReader.connection().execute("SELECT id, name, phone, address FROM {} WHERE name "
+                                                           "LIKE 'Dedup %' ORDER BY id"
+                                                           .format(DatabaseRecordReader.records_table))
+        try:
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def test_normalize(self):
+        self.assertEqual(normalize_name(u"O'Brien,  John"), u"o brien john")
+        self.assertEqual(normalize_address(u"1554 Long Street, Apt. 2"), u"1554 long st apt 2")
+        self.assertEqual(normalize_address(u"1554 long st"), normalize_address(u"1554 Long Street"))
+        self.assertEqual(normalize_phone(u"+1 (647) 555-0100"), 6475550100)
+        self.assertIsNone(normalize_phone(u"unknown"))
+        self.assertEqual([soundex(word) for word in [u"John", u"Jon", u"Robert", u"Rupert", u"Ashcraft", u"Tymczak"]],
+                         [u"j500", u"j500", u"r163", u"r163", u"a261", u"t522"])
+        self.assertEqual(soundex(u"123"), u"")
+
+    def test_find_in_rows(self):
+        rows = [(1, u"John Kal", 6475550100, u"1554 Long Street"),
+                (2, u"Jon Kal", 6475550100, u"1554 Long St"),
+                (3, u"Jon Kal", None, u"1554 long st."),
+                (4, u"Jane Kal", 6475550199, u"1554 Long Street"),
+                (5, u"Mary Stone", 4165550100, u"8 Elm Road"),
+                (6, u"Mary Stone", 4165550100, u"8 Elm Rd")]
+        result = DuplicateFinder.find_in_rows(rows)
+        self.assertEqual([(group.keep[0], [row[0] for row in group.duplicates]) for group in result.groups],
+                         [(1, [2, 3]), (5, [6])])
+        self.assertEqual(result.groups[0].merged, (u"John Kal", 6475550100, u"1554 Long Street"))
+        self.assertTrue(all(score >= DuplicateFinder.threshold for score in result.groups[0].scores))
+        self.assertEqual((result.stats["records"], result.stats["duplicates"], result.stats["skipped_blocks"]),
+                         (6, 3, 0))
+        # only pairs sharing a block are scored, so Mary Stone is never compared with the Kals
+        self.assertLess(result.stats["scored_pairs"], len(rows) * (len(rows) - 1) // 2)
+        self.assertFalse(DuplicateFinder.find_in_rows(rows, threshold=1.01).groups)
+
+    def test_merge_fills_missing_fields(self):
+        result = DuplicateFinder.find_in_rows([(1, u"Ann Lee", 6475550300, None),
+                                               (2, u"Ann Lee", 6475550300, u"3 Bay St")])
+        group = result.groups[0]
+        self.assertEqual((group.keep[0], group.merged), (2, (u"Ann Lee", 6475550300, u"3 Bay St")))
+
+    def test_apply_report(self):
+        for record in [DatabaseRecord(u"Dedup Johnathan Kalinski", 6475550601, u"16 Dedup Street"),
+                       DatabaseRecord(u"Dedup Jonathan Kalinski", 6475550601, u"16 Dedup St"),
+                       DatabaseRecord(u"Dedup Unrelated Person", 6475550602, u"900 Other Avenue")]:
+            DatabaseRecordWriter.add_record(record)
+        result = DuplicateFinder.find_in_rows(self.dedup_rows())
+        self.assertEqual(len(result.groups), 1)
+        report_path = os.path.join(AppConfig.data_directory, "dedup_report.json")
+        DuplicateFinder.write_report(result, report_path)
+        try:
+            groups = DuplicateFinder.read_report(report_path)
+        finally:
+            os.remove(report_path)
+        self.assertEqual(groups, result.groups)
+
+        self.assertEqual(DuplicateFinder.apply(groups), 1)
+        self.assertEqual([row[1:] for row in self.dedup_rows()],
+                         [(u"Dedup Johnathan Kalinski", 6475550601, u"16 Dedup Street"),
+                          (u"Dedup Unrelated Person", 6475550602, u"900 Other Avenue")])
+        # the duplicates are gone, so applying the same report again changes nothing
+        self.assertRaises(ValueError, DuplicateFinder.apply, groups)
+        self.assertEqual(len(self.dedup_rows()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
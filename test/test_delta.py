@@ -0,0 +1,140 @@
+import os
+import json
+import random
+import unittest
+
+from lib.api.conf import AppConfig
+from lib.api.delta import DeltaExporter, ChangeOp, CHECKPOINT_SUFFIX
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch
+from lib.api.serialize import SerialFormats
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestDelta(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.delete_record(DatabaseRecord(u"Delta "), RecordMatch.PREFIX)
+        DatabaseRecordWriter.add_records([DatabaseRecord(u"Delta Kept", 6475550300, u"5 Delta Road"),
+                                          DatabaseRecord(u"Delta Gone", 6475550301, u"2 Delta Road")])
+
+    def sequence(self):
+        return DeltaExporter.current_sequence(DatabaseRecordReader.connection(), DatabaseRecordReader.records_table)
+
+    def changes_since(self, since):
+        return DeltaExporter.changes_since(DatabaseRecordReader.connection(), DatabaseRecordReader.records_table,
+                                           since)
+
+    def test_changes_are_collapsed(self):
+        since = self.sequence()
+        DatabaseRecordWriter.add_record(DatabaseRecord(u"Delta New", 6475550310, u"10 Delta Road"))
+        DatabaseRecordWriter.update_records_by_all_fields(DatabaseRecord(u"Delta New"),
+                                                          DatabaseRecord(u"Delta Newer", 6475550311, u"11 Delta Road"),
+                                                          RecordMatch.EXACT)
+        DatabaseRecordWriter.add_record(DatabaseRecord(u"Delta Temp", 6475550312, u"12 Delta Road"))
+        DatabaseRecordWriter.delete_record(DatabaseRecord(u"Delta Temp"), RecordMatch.EXACT)
+        delta = self.changes_since(since)
+        self.assertEqual(delta.sequence, self.sequence())
+        self.assertEqual([(change.op, change.old, change.new) for change in delta.changes],
+                         [(ChangeOp.INSERT, None, (u"Delta Newer", 6475550311, u"11 Delta Road"))])
+        self.assertEqual(self.changes_since(delta.sequence).changes, [])
+        self.assertRaises(ValueError, self.changes_since, delta.sequence + 1)
+
+    def test_write_delta(self):
+        phone = random.randrange(6470000000, 6479999999)
+        DatabaseRecordWriter.add_record(DatabaseRecord(u"Delta Phone", phone, u"4 Delta Road"))
+        since = self.sequence()
+        DatabaseRecordWriter.update_record_phones(DatabaseRecord(phone=phone), DatabaseRecord(phone=6475550399))
+        DatabaseRecordWriter.update_record_phones(DatabaseRecord(phone=6475550399), DatabaseRecord(phone=phone))
+        output_path = os.path.join(AppConfig.data_directory, "delta_export.ndjson")
+        delta = DeltaExporter.write_delta(DatabaseRecordReader.connection(), DatabaseRecordReader.records_table, since,
+                                          output_path)
+        with open(output_path) as delta_file:
+            lines = [json.loads(line) for line in delta_file]
+        os.remove(output_path)
+        self.assertEqual(lines[-1], {"checkpoint": delta.sequence, "since": since})
+        self.assertEqual([line["op"] for line in lines[:-1]], [ChangeOp.UPDATE])
+        self.assertEqual(lines[0]["old"], lines[0]["new"])
+
+    def test_refresh_merges_changes(self):
+        for _format in [SerialFormats.CSV, SerialFormats.JSON, SerialFormats.NDJSON, SerialFormats.YAML]:
+            export_path = os.path.join(AppConfig.data_directory, "delta_refresh.{}".format(_format['extension']))
+            for path in [export_path, export_path + CHECKPOINT_SUFFIX]:
+                if os.path.exists(path):
+                    os.remove(path)
+            refresh = lambda: DeltaExporter.refresh(DatabaseRecordReader.connection(),
+                                                    DatabaseRecordReader.records_table, _format, export_path,
+                                                    DatabaseRecordReader.iter_all_records)
+            sequence, merged = refresh()
+            self.assertIsNone(merged)
+            self.assertEqual(DeltaExporter.read_checkpoint(export_path), sequence)
+
+            DatabaseRecordWriter.add_record(DatabaseRecord(u"Delta Merge", 6475550320, u"20 Delta Road"))
+            DatabaseRecordWriter.update_record_address(DatabaseRecord(address=u"5 Delta Road"),
+                                                       DatabaseRecord(address=u"3 Delta Road"))
+            DatabaseRecordWriter.delete_record(DatabaseRecord(u"Delta Gone"), RecordMatch.EXACT)
+            sequence, merged = refresh()
+            self.assertEqual(merged, 3)
+            self.assertEqual(sequence, self.sequence())
+            expected = set((name, int(phone), address) for name, phone, address in DatabaseRecordReader.get_all_records())
+            self.assertEqual(set(_format['reader'].read(export_path)), expected)
+
+            DatabaseRecordWriter.delete_record(DatabaseRecord(u"Delta Merge"), RecordMatch.EXACT)
+            DatabaseRecordWriter.update_record_address(DatabaseRecord(address=u"3 Delta Road"),
+                                                       DatabaseRecord(address=u"5 Delta Road"))
+            DatabaseRecordWriter.add_record(DatabaseRecord(u"Delta Gone", 6475550301, u"2 Delta Road"))
+            os.remove(export_path)
+            os.remove(export_path + CHECKPOINT_SUFFIX)
+
+    def test_merge_appends_inserts(self):
+        formats = [SerialFormats.CSV, SerialFormats.NDJSON, SerialFormats.CSV_GZ, SerialFormats.NDJSON_ZST]
+        for _format in [_format for _format in formats if _format in SerialFormats.ALL_FORMATS]:
+            export_path = os.path.join(AppConfig.data_directory, "delta_append.{}".format(_format['extension']))
+            DeltaExporter.write_full(DatabaseRecordReader.connection(), DatabaseRecordReader.records_table, _format,
+                                     export_path, DatabaseRecordReader.iter_all_records)
+            with open(export_path, 'rb') as export_file:
+                exported = export_file.read()
+
+            DatabaseRecordWriter.add_records([DatabaseRecord(u"Delta Append", 6475550340, u"40 Delta Road"),
+                                              DatabaseRecord(u"Delta Append", 6475550341, u"41 Delta Road")])
+            delta = DeltaExporter.merge(DatabaseRecordReader.connection(), DatabaseRecordReader.records_table,
+                                        _format, export_path)
+            self.assertEqual(len(delta.changes), 2)
+            with open(export_path, 'rb') as export_file:
+                self.assertTrue(export_file.read().startswith(exported))
+            expected = set((name, int(phone), address) for name, phone, address in DatabaseRecordReader.get_all_records())
+            self.assertEqual(set(_format['reader'].read(export_path)), expected)
+
+            DatabaseRecordWriter.delete_record(DatabaseRecord(u"Delta Append"), RecordMatch.EXACT)
+            os.remove(export_path)
+            os.remove(export_path + CHECKPOINT_SUFFIX)
+
+    def test_merge_missing_record(self):
+        export_path = os.path.join(AppConfig.data_directory, "delta_missing.ndjson")
+        DeltaExporter.write_full(DatabaseRecordReader.connection(), DatabaseRecordReader.records_table,
+                                 SerialFormats.NDJSON, export_path, DatabaseRecordReader.iter_all_records)
+        with open(export_path, 'w'):
+            pass
+        DatabaseRecordWriter.update_record_address(DatabaseRecord(address=u"5 Delta Road"),
+                                                   DatabaseRecord(address=u"3 Delta Road"))
+        try:
+            self.assertRaises(ValueError, DeltaExporter.merge, DatabaseRecordReader.connection(),
+                              DatabaseRecordReader.records_table, SerialFormats.NDJSON, export_path)
+            self.assertEqual([path for path in os.listdir(AppConfig.data_directory) if '.merging.' in path], [])
+        finally:
+            DatabaseRecordWriter.update_record_address(DatabaseRecord(address=u"3 Delta Road"),
+                                                       DatabaseRecord(address=u"5 Delta Road"))
+            os.remove(export_path)
+            os.remove(export_path + CHECKPOINT_SUFFIX)
+
+    def test_pruned_changes(self):
+        connection, table = DatabaseRecordReader.connection(), DatabaseRecordReader.records_table
+        DatabaseRecordWriter.add_record(DatabaseRecord(u"Delta Pruned", 6475550330, u"30 Delta Road"))
+        sequence = self.sequence()
+        self.assertGreater(DeltaExporter.prune(connection, table, sequence - 1), 0)
+        self.assertRaises(ValueError, self.changes_since, sequence - 2)
+        self.assertEqual(len(self.changes_since(sequence - 1).changes), 1)
+        self.assertEqual(self.sequence(), sequence)
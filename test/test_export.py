@@ -0,0 +1,86 @@
+import os
+import json
+import unittest
+
+from lib.api.conf import AppConfig
+from lib.api.export import ParallelExporter, MANIFEST_SUFFIX
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+from lib.api.serialize import SerialFormats
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestExport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.add_records(DatabaseRecord("Export Shard {}".format(index), 6475550200 + index,
+                                                        "{} Shard Road".format(index)) for index in range(10))
+
+    def test_shard_ranges(self):
+        ranges = ParallelExporter.shard_ranges(DatabaseRecordReader.connection(),
+                                               DatabaseRecordReader.records_table, 3)
+        self.assertEqual(len(ranges), 3)
+        for (first_id, last_id), (next_first_id, next_last_id) in zip(ranges, ranges[1:]):
+            self.assertEqual(last_id + 1, next_first_id)
+
+    def test_parallel_export_matches_serial_export(self):
+        for _format in AppConfig.supported_serial_formats:
+            if _format['writer'].binary:
+                continue
+            serial_path = os.path.join(AppConfig.data_directory, "serial_export.{}".format(_format['extension']))
+            parallel_path = os.path.join(AppConfig.data_directory, "parallel_export.{}".format(_format['extension']))
+            _format['writer'].write(DatabaseRecordReader.iter_all_records(), serial_path)
+            record_count = ParallelExporter.export(DatabaseRecordReader.connection(),
+                                                   DatabaseRecordReader.database_path,
+                                                   DatabaseRecordReader.records_table, _format, parallel_path, 3)
+            self.assertEqual(record_count, len(DatabaseRecordReader.get_all_records()))
+            with open(serial_path) as serial_file, open(parallel_path) as parallel_file:
+                self.assertEqual(serial_file.read(), parallel_file.read())
+            os.remove(serial_path)
+            os.remove(parallel_path)
+
+    def test_parallel_export_rejects_binary_formats(self):
+        self.assertRaises(ValueError, ParallelExporter.export, DatabaseRecordReader.connection(),
+                          DatabaseRecordReader.database_path, DatabaseRecordReader.records_table, SerialFormats.SNAPSHOT,
+                          os.path.join(AppConfig.data_directory, "parallel_export.pbsnap"), 2)
+
+    def test_parallel_export_binary_manifest(self):
+        # snapshots, plus Arrow/Parquet when pyarrow is installed
+        for _format in SerialFormats.ALL_FORMATS:
+            if not _format['writer'].binary:
+                continue
+            output_path = os.path.join(AppConfig.data_directory, "manifest_export.{}".format(_format['extension']))
+            record_count = ParallelExporter.export(DatabaseRecordReader.connection(),
+                                                   DatabaseRecordReader.database_path,
+                                                   DatabaseRecordReader.records_table, _format, output_path, 2,
+                                                   manifest=True)
+            with open(output_path + MANIFEST_SUFFIX) as manifest_file:
+                manifest = json.load(manifest_file)
+            records = []
+            for part in manifest["parts"]:
+                part_path = os.path.join(AppConfig.data_directory, part["path"])
+                part_records = list(_format['reader'].read(part_path))
+                self.assertEqual(len(part_records), part["records"])
+                records.extend(part_records)
+                os.remove(part_path)
+            os.remove(output_path + MANIFEST_SUFFIX)
+            self.assertEqual(len(records), record_count)
+            self.assertEqual(record_count, len(DatabaseRecordReader.get_all_records()))
+
+    def test_parallel_export_manifest(self):
+        output_path = os.path.join(AppConfig.data_directory, "manifest_export.csv")
+        record_count = ParallelExporter.export(DatabaseRecordReader.connection(), DatabaseRecordReader.database_path,
+                                               DatabaseRecordReader.records_table, AppConfig.supported_serial_formats[0],
+                                               output_path, 2, manifest=True)
+        with open(output_path + MANIFEST_SUFFIX) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest["records"], record_count)
+        for part in manifest["parts"]:
+            part_path = os.path.join(AppConfig.data_directory, part["path"])
+            self.assertEqual(len(list(AppConfig.supported_serial_formats[0]['reader'].read(part_path))),
+                             part["records"])
+            os.remove(part_path)
+        os.remove(output_path + MANIFEST_SUFFIX)
@@ -0,0 +1,66 @@
+import os
+import random
+import unittest
+
+from lib.api.auth import WriteAuthRules
+from lib.api.group_commit import GroupCommitWriter
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestGroupCommit(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+
+    def test_group_commit_adds(self):
+        phones = random.sample(range(6470000000, 6479999999), 20)
+        with GroupCommitWriter(max_batch=8, max_delay=0.05, auth_rule=WriteAuthRules.WRITE_IF_PHONE_UNIQUE) as writer:
+            futures = [writer.add_record(DatabaseRecord("Group Commit", phone, "8 Batch Road")) for phone in phones]
+            results = [future.result(timeout=10) for future in futures]
+        self.assertEqual(results, [True] * len(phones))
+        for phone in phones:
+            self.assertEqual(len(DatabaseRecordReader.get_records(DatabaseRecord(phone=phone))), 1)
+
+    def test_group_commit_rejects_queued_duplicates(self):
+        phone = random.randrange(6470000000, 6479999999)
+        record = DatabaseRecord("Queued Duplicate", phone, "9 Batch Road")
+        with GroupCommitWriter(max_batch=100, max_delay=0.05, auth_rule=WriteAuthRules.WRITE_IF_PHONE_UNIQUE) as writer:
+            futures = [writer.add_record(record), writer.add_record(record),
+                       writer.add_record(DatabaseRecord("Other Duplicate", phone, "10 Batch Road"))]
+            self.assertEqual([future.result(timeout=10) for future in futures], [True, False, False])
+            # already in the database by the time this batch is flushed
+            self.assertFalse(writer.add_record(record).result(timeout=10))
+        self.assertEqual(len(DatabaseRecordReader.get_records(DatabaseRecord(phone=phone))), 1)
+
+    def test_group_commit_batch_checked_with_uniqueness_index(self):
+        phone = random.randrange(6470000000, 6479999999)
+        DatabaseRecordWriter.enable_uniqueness_index()
+        try:
+            with GroupCommitWriter(max_batch=100, max_delay=0.05,
+                                   auth_rule=WriteAuthRules.WRITE_IF_PHONE_UNIQUE) as writer:
+                futures = [writer.add_record(DatabaseRecord("Indexed Batch", phone, "13 Batch Road")),
+                           writer.update_records_by_all_fields(DatabaseRecord("Indexed Nobody"),
+                                                               DatabaseRecord("Indexed Nobody", phone, "1 Road")),
+                           writer.add_record(DatabaseRecord("Indexed Again", phone, "14 Batch Road"))]
+                self.assertEqual([future.result(timeout=10) for future in futures], [True, False, False])
+        finally:
+            DatabaseRecordWriter.disable_uniqueness_index()
+        self.assertEqual(len(DatabaseRecordReader.get_records(DatabaseRecord(phone=phone))), 1)
+
+    def test_group_commit_update(self):
+        phone = random.randrange(6470000000, 6479999999)
+        with GroupCommitWriter(auth_rule=WriteAuthRules.WRITE_IF_PHONE_UNIQUE) as writer:
+            added = writer.add_record(DatabaseRecord("Group Update", phone, "11 Batch Road"))
+            updated = writer.update_records_by_all_fields(DatabaseRecord(phone=phone),
+                                                          DatabaseRecord("Group Updated", phone + 1, "11 Batch Road"))
+            self.assertTrue(added.result(timeout=10))
+        self.assertEqual(updated.result(timeout=10), 1)
+        self.assertEqual(DatabaseRecordReader.get_records(DatabaseRecord(phone=phone + 1))[0][0], "Group Updated")
+
+    def test_group_commit_not_started(self):
+        with self.assertRaises(RuntimeError):
+            GroupCommitWriter().add_record(DatabaseRecord("Not Started", 6475550500, "12 Batch Road"))
@@ -0,0 +1,53 @@
+import os
+import json
+import tempfile
+import unittest
+
+from lib.api.instrument import Instrumentation
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestInstrumentation(unittest.TestCase):
+    def tearDown(self):
+        Instrumentation.disable()
+        Instrumentation.reset()
+
+    def test_phases_and_sql_timings(self):
+        original = DatabaseRecordReader.__dict__['get_records']
+        Instrumentation.enable()
+        self.assertIsNot(DatabaseRecordReader.__dict__['get_records'], original)
+        with Instrumentation.phase('query'):
+            DatabaseRecordWriter.create_records_database()
+            DatabaseRecordReader.get_records(DatabaseRecord(phone="6445"))
+            list(DatabaseRecordReader.iter_all_records())
+        Instrumentation.disable()
+        self.assertIs(DatabaseRecordReader.__dict__['get_records'], original)
+
+        phase = Instrumentation.report()['phases']['query']
+        self.assertEqual(phase['timers']['DatabaseRecordReader.iter_all_records']['calls'], 1)
+        self.assertIn('DatabaseRecordReader.iter_all_records (iteration)', phase['timers'])
+        self.assertTrue(any(text.startswith("SELECT name, phone, address FROM records") for text in phase['sql']))
+        self.assertGreater(phase['seconds'], 0)
+
+    def test_disabled_phase_is_noop(self):
+        with Instrumentation.phase('unused'):
+            DatabaseRecordReader.get_all_records()
+        self.assertEqual(Instrumentation.report()['phases'], {})
+
+    def test_write_json(self):
+        Instrumentation.enable()
+        DatabaseRecordReader.get_all_records()
+        handle, output_path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        try:
+            Instrumentation.write_json(output_path, {'extra': 1})
+            with open(output_path) as output_file:
+                report = json.load(output_file)
+            self.assertEqual(report['extra'], 1)
+            self.assertIn('DatabaseRecordReader.get_all_records', report['phases']['unphased']['timers'])
+        finally:
+            os.remove(output_path)
@@ -0,0 +1,52 @@
+import os
+import unittest
+
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord
+from lib.api.search import FullTextSearch
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+@unittest.skipUnless(FullTextSearch.is_supported(DatabaseRecordWriter.connection()), "SQLite built without FTS5")
+class TestSearch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.add_record(DatabaseRecord("Search Harrington", 6475550101, "77 Fulltext Avenue"))
+        DatabaseRecordWriter.add_record(DatabaseRecord("Jack Quillsby", 6475550103, "3 Typo Lane"))
+
+    def test_search_index_exists(self):
+        self.assertTrue(FullTextSearch.has_index(DatabaseRecordWriter.connection(),
+                                                 DatabaseRecordWriter.records_table))
+        self.assertFalse(FullTextSearch.create_index(DatabaseRecordWriter.connection(),
+                                                     DatabaseRecordWriter.records_table))
+
+    def test_search_substring(self):
+        results = DatabaseRecordReader.search_records("harring")
+        self.assertIn((u"Search Harrington", 6475550101, u"77 Fulltext Avenue"), results)
+        self.assertIn((u"Search Harrington", 6475550101, u"77 Fulltext Avenue"),
+                      DatabaseRecordReader.search_records("ulltext Av"))
+        self.assertFalse(DatabaseRecordReader.search_records("Harington"))
+
+    def test_search_fuzzy(self):
+        results = DatabaseRecordReader.search_records("Serch Harington", fuzzy=True)
+        self.assertEqual(results[0], (u"Search Harrington", 6475550101, u"77 Fulltext Avenue"))
+        self.assertFalse(DatabaseRecordReader.search_records("Qwxz Yvbn", fuzzy=True))
+
+    def test_search_fuzzy_short_words(self):
+        # no trigram in common with "Jack", found through the swapped pair variant
+        self.assertIn((u"Jack Quillsby", 6475550103, u"3 Typo Lane"),
+                      DatabaseRecordReader.search_records("Jakc", fuzzy=True, limit=100))
+        self.assertEqual(FullTextSearch.variants(u"abc")[:4], [u"abc", u"bc", u"ac", u"ab"])
+        self.assertEqual(FullTextSearch.variants(u"Harington"), [u"Harington"])
+
+    def test_search_kept_in_sync(self):
+        DatabaseRecordWriter.add_record(DatabaseRecord("Synced Zebediah", 6475550102, "1 Sync St"))
+        self.assertTrue(DatabaseRecordReader.search_records("Zebediah"))
+        DatabaseRecordWriter.update_record_names(DatabaseRecord("Synced Zebediah"), DatabaseRecord("Synced Zachariah"))
+        self.assertFalse(DatabaseRecordReader.search_records("Zebediah"))
+        self.assertTrue(DatabaseRecordReader.search_records("Zachariah"))
+        DatabaseRecordWriter.delete_record(DatabaseRecord("Synced Zachariah"))
+        self.assertFalse(DatabaseRecordReader.search_records("Zachariah"))
@@ -1,17 +1,14 @@
 import os
 import sys
-import sqlite3
 import unittest
 
 from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader
 from lib.api.conf import AppConfig
-from lib.api.serialize import SerialFormats
+from lib.api.serialize import SerialFormats, compression_of, is_installed
 
 # overwrite our defaults to use a test db + table
 DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
-DatabaseRecordWriter.database_driver = sqlite3.connect(DatabaseRecordWriter.database_path)
 DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
-DatabaseRecordReader.database_driver = sqlite3.connect(DatabaseRecordWriter.database_path)
 
 
 class TestSerialize(unittest.TestCase):
@@ -22,3 +19,77 @@ class TestSerialize(unittest.TestCase):
             sys.stdout.write(output_path)
             AppConfig.serial_format['writer'].write(DatabaseRecordReader.get_all_records(), output_path)
             self.assertTrue(os.path.exists(output_path))
+
+    def test_read_serial_formats(self):
+        for _format in AppConfig.supported_serial_formats:
+            if not _format['reader']:
+                continue
+            output_path = os.path.join(AppConfig.data_directory, "records.{}".format(_format['extension']))
+            _format['writer'].write(DatabaseRecordReader.get_all_records(), output_path)
+            expected = set((result[0], int(result[1]), result[2]) for result in DatabaseRecordReader.get_all_records())
+            self.assertEqual(set(_format['reader'].read(output_path)), expected)
+
+    def test_write_streams_records(self):
+        record_count = len(DatabaseRecordReader.get_all_records())
+        for _format in AppConfig.supported_serial_formats:
+            output_path = os.path.join(AppConfig.data_directory, "records.{}".format(_format['extension']))
+            self.assertEqual(_format['writer'].write(DatabaseRecordReader.iter_all_records(), output_path),
+                             record_count)
+            if _format['reader']:
+                self.assertEqual(len(list(_format['reader'].read(output_path))), record_count)
+
+    def test_non_ascii_records(self):
+        records = [(u"J\xf6rg M\xfcller", 6475550100, u"12 Stra\xdfe, \xc9toile")]
+        for _format in AppConfig.supported_serial_formats:
+            if not _format['reader']:
+                continue
+            output_path = os.path.join(AppConfig.data_directory, "unicode.{}".format(_format['extension']))
+            _format['writer'].write(records, output_path)
+            self.assertEqual(list(_format['reader'].read(output_path)), records)
+            os.remove(output_path)
+
+    def test_compressed_formats(self):
+        self.assertEqual([compression_of(path) for path in ["records.csv.gz", "records.json.zst", "records.json"]],
+                         ["gz", "zst", None])
+        records = DatabaseRecordReader.get_all_records()
+        plain_path = os.path.join(AppConfig.data_directory, "compressed.ndjson")
+        compressed_path = os.path.join(AppConfig.data_directory, "compressed.ndjson.gz")
+        SerialFormats.NDJSON['writer'].write(records, plain_path)
+        SerialFormats.NDJSON_GZ['writer'].write(records, compressed_path)
+        with open(compressed_path, 'rb') as compressed_file:
+            compressed = compressed_file.read()
+        SerialFormats.NDJSON_GZ['writer'].write(records, compressed_path)
+        with open(compressed_path, 'rb') as compressed_file:
+            # same records, same bytes
+            self.assertEqual(compressed_file.read(), compressed)
+        self.assertEqual(compressed[:2], b"\x1f\x8b")
+        self.assertLess(len(compressed), os.path.getsize(plain_path))
+        self.assertEqual(list(SerialFormats.NDJSON_GZ['reader'].read(compressed_path)),
+                         list(SerialFormats.NDJSON['reader'].read(plain_path)))
+        os.remove(plain_path)
+        os.remove(compressed_path)
+
+    def test_optional_formats(self):
+        self.assertFalse(is_installed("phonebook_missing_module"))
+        self.assertEqual(SerialFormats.ARROW in SerialFormats.ALL_FORMATS, is_installed("pyarrow"))
+        self.assertEqual(SerialFormats.JSON_ZST in SerialFormats.ALL_FORMATS, is_installed("zstandard"))
+
+    @unittest.skipUnless(is_installed("pyarrow"), "pyarrow is not installed")
+    def test_columnar_formats(self):
+        records = [(u"Col\xe9 Umnar", 6475550100, u"1 Column Road"), (u"Null Address", 6475550101, None)]
+        for _format in [SerialFormats.ARROW, SerialFormats.PARQUET]:
+            output_path = os.path.join(AppConfig.data_directory, "columnar.{}".format(_format['extension']))
+            _format['writer'].batch_size = 1
+            try:
+                self.assertEqual(_format['writer'].write(iter(records), output_path), len(records))
+            finally:
+                del _format['writer'].batch_size
+            self.assertEqual(list(_format['reader'].read(output_path)), records)
+            # streamed documents are the same as the written files
+            streamed_path = output_path + ".streamed"
+            with open(streamed_path, 'wb') as streamed_file:
+                for chunk in _format['writer'].iter_chunks(records):
+                    streamed_file.write(chunk)
+            self.assertEqual(list(_format['reader'].read(streamed_path)), records)
+            os.remove(output_path)
+            os.remove(streamed_path)
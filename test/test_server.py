@@ -0,0 +1,124 @@
+import os
+import json
+import threading
+import unittest
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+from lib.api.auth import WriteAuthRules
+from lib.api.conf import AppConfig
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch
+from lib.api.serialize import NDJSONReader
+from lib.api.server import RecordServer
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.delete_record(DatabaseRecord(u"Server "), RecordMatch.PREFIX)
+        cls.server = RecordServer(('127.0.0.1', 0), workers=4)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.auth_rule = AppConfig.write_auth_rule
+        AppConfig.write_auth_rule = WriteAuthRules.WRITE_IF_PHONE_UNIQUE
+
+    @classmethod
+    def tearDownClass(cls):
+        AppConfig.write_auth_rule = cls.auth_rule
+        cls.server.shutdown()
+        cls.server.server_close()
+        DatabaseRecordWriter.delete_record(DatabaseRecord(u"Server "), RecordMatch.PREFIX)
+
+    def setUp(self):
+        self.client = HTTPConnection(*self.server.server_address)
+
+    def tearDown(self):
+        self.client.close()
+
+    def request(self, method, path, body=None):
+        self.client.request(method, path, json.dumps(body) if body is not None else None,
+                            {"Content-Type": "application/json"})
+        response = self.client.getresponse()
+        return response.status, response.read()
+
+    def request_json(self, method, path, body=None):
+        status, data = self.request(method, path, body)
+        return status, json.loads(data.decode('utf-8'))
+
+    def test_record_requests(self):
+        # every request goes through the same kept alive connection
+        status, body = self.request_json("POST", "/records", {"name": u"Server Added", "phone": "(647) 555-0700",
+                                                              "address": u"7 Server Road"})
+        self.assertEqual((status, body["added"]["phone"]), (201, 6475550700))
+        status, body = self.request_json("POST", "/records", {"name": u"Server Again", "phone": 6475550700,
+                                                              "address": u"8 Server Road"})
+        self.assertEqual(status, 409)
+        self.assertEqual(self.request_json("POST", "/records", {"name": u"Server Partial"})[0], 400)
+
+        status, body = self.request_json("GET", "/records?name=Server+Added&match=exact")
+        self.assertEqual((status, body["records"]),
+                         (200, [{"name": u"Server Added", "phone": 6475550700, "address": u"7 Server Road"}]))
+        status, body = self.request_json("PATCH", "/records", {"query": {"address": u"7 Server Road"},
+                                                               "set": {"address": u"9 Server Road"}})
+        self.assertEqual((status, body), (200, {"updated": 1, "dry_run": False}))
+        status, body = self.request_json("DELETE", "/records", {"query": {"name": u"Server Added"},
+                                                                "match": "exact", "dry_run": True})
+        self.assertEqual((status, body), (200, {"deleted": 1, "dry_run": True}))
+        status, body = self.request_json("DELETE", "/records", {"query": {"name": u"Server Added"},
+                                                                "match": "exact"})
+        self.assertEqual((status, body), (200, {"deleted": 1, "dry_run": False}))
+        self.assertEqual(self.request_json("DELETE", "/records", {"query": {}})[0], 400)
+
+    def test_paging(self):
+        for index in range(3):
+            self.request("POST", "/records", {"name": u"Server Page {}".format(index), "phone": 6475550710 + index,
+                                              "address": u"10 Server Road"})
+        status, body = self.request_json("GET", "/records?name=Server+Page&match=prefix&limit=2&order=name")
+        self.assertEqual([record["name"] for record in body["records"]], [u"Server Page 0", u"Server Page 1"])
+        status, body = self.request_json("GET", "/records?name=Server+Page&match=prefix&limit=2&order=name&page={}"
+                                         .format(body["next_page"]))
+        self.assertEqual([record["name"] for record in body["records"]], [u"Server Page 2"])
+        self.assertNotIn("next_page", body)
+        self.assertEqual(self.request_json("GET", "/records?order=age")[0], 400)
+
+    def test_errors(self):
+        self.assertEqual(self.request_json("GET", "/missing")[0], 404)
+        self.assertEqual(self.request_json("PATCH", "/export")[0], 405)
+        self.assertEqual(self.request_json("GET", "/records?phone=phone")[0], 400)
+        self.assertEqual(self.request_json("GET", "/export?format=doc")[0], 400)
+
+    def test_streamed_export(self):
+        self.request("POST", "/records", {"name": u"Server Export", "phone": 6475550720,
+                                          "address": u"20 Server Road"})
+        self.client.request("GET", "/export?format=ndjson")
+        response = self.client.getresponse()
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        export_path = os.path.join(AppConfig.data_directory, "server_export.ndjson")
+        with open(export_path, 'wb') as export_file:
+            export_file.write(response.read())
+        try:
+            records = set(NDJSONReader.read(export_path))
+        finally:
+            os.remove(export_path)
+        self.assertIn((u"Server Export", 6475550720, u"20 Server Road"), records)
+        self.assertEqual(len(records), len(set(DatabaseRecordReader.get_all_records())))
+        # compressed formats are compressed as they're streamed
+        self.client.request("GET", "/export?format=ndjson.gz")
+        response = self.client.getresponse()
+        self.assertEqual(response.getheader("Content-Type"), "application/gzip")
+        with open(export_path + ".gz", 'wb') as export_file:
+            export_file.write(response.read())
+        try:
+            self.assertEqual(set(NDJSONReader.read(export_path + ".gz")), records)
+        finally:
+            os.remove(export_path + ".gz")
+        # the connection is still usable after a streamed response
+        self.assertEqual(self.request_json("GET", "/records?phone=6475550720&match=exact")[0], 200)
@@ -0,0 +1,146 @@
+import os
+import threading
+import unittest
+
+from lib.api.auth import WriteAuthRules
+from lib.api.conf import AppConfig
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch, \
+    RecordOrder, MutationRule
+from lib.api.shard import ShardedRecordReader, ShardedRecordWriter, record_handlers, rebalance_shards, \
+    remove_database_files, shard_handlers, shard_of_phone, shard_paths
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+RECORDS = [(u"Shard Alice", 6475550801, u"1 Shard Street"),
+           (u"Shard Bob", 6475550802, u"2 Shard Street"),
+           (u"Shard Carol", 4165550803, u"3 Shard Street"),
+           (u"Shard Dave", 4165550804, u"4 Shard Street"),
+           (u"Shard Erin", 9055550805, u"5 Shard Street"),
+           (u"Shard Frank", 9055550806, u"6 Shard Street")]
+
+
+class TestShard(unittest.TestCase):
+    def setUp(self):
+        self.settings = (AppConfig.shard_count, AppConfig.shard_layout)
+        AppConfig.change_shard_settings(3, 'test_shard_{shard}_of_{count}', quiet=True, save=False)
+        ShardedRecordWriter.create_records_database()
+        ShardedRecordWriter.add_records(DatabaseRecord(*record) for record in RECORDS)
+
+    def tearDown(self):
+        for count in [1, 2, 3]:
+            for path in shard_paths(count, 'test_shard_{shard}_of_{count}'):
+                if path != DatabaseRecordWriter.database_path:
+                    remove_database_files(path)
+        AppConfig.change_shard_settings(*self.settings, quiet=True, save=False)
+
+    def shard_records(self, count=3):
+        return [set(shard_handlers(path)[0].get_all_records()) for path in shard_paths(count)]
+
+    def test_records_routed_by_phone(self):
+        self.assertEqual(record_handlers(), (ShardedRecordReader, ShardedRecordWriter))
+        for index, records in enumerate(self.shard_records()):
+            self.assertEqual(records, set(record for record in RECORDS if shard_of_phone(record[1], 3) == index))
+        self.assertEqual(len(set(shard_of_phone(record[1], 3) for record in RECORDS)), 3)
+        self.assertEqual(shard_of_phone(6475550801, 1), 0)
+
+    def test_fan_out_queries(self):
+        self.assertEqual(ShardedRecordReader.get_records(DatabaseRecord(u"Shard "), RecordMatch.PREFIX,
+                                                         order_by=RecordOrder.NAME), RECORDS)
+        self.assertEqual(list(ShardedRecordReader.iter_all_records(order_by=RecordOrder.PHONE, limit=2)),
+                         [RECORDS[2], RECORDS[3]])
+        self.assertEqual(ShardedRecordReader.get_records(DatabaseRecord(phone=9055550806), RecordMatch.EXACT),
+                         [RECORDS[5]])
+        self.assertEqual(ShardedRecordReader.get_page(limit=4, order_by=RecordOrder.NAME).records, RECORDS[:4])
+        self.assertRaises(ValueError, ShardedRecordReader.get_page, limit=4, after=(1,))
+        self.assertEqual(ShardedRecordReader.count_area_codes(), [(416, 2), (647, 2), (905, 2)])
+
+    def test_auth_rules_across_shards(self):
+        # same name, different shard
+        clash = DatabaseRecord(u"Shard Alice", 4165550890, u"9 Other Road")
+        self.assertNotEqual(shard_of_phone(clash.phone, 3), shard_of_phone(RECORDS[0][1], 3))
+        self.assertFalse(ShardedRecordWriter.can_add(clash, WriteAuthRules.WRITE_IF_NAME_UNIQUE))
+        self.assertEqual(ShardedRecordWriter.add_record(clash, WriteAuthRules.WRITE_IF_NAME_UNIQUE).rowcount, 0)
+        self.assertTrue(ShardedRecordWriter.can_add(clash, WriteAuthRules.WRITE_IF_PHONE_UNIQUE))
+        self.assertFalse(ShardedRecordWriter.can_add(DatabaseRecord(u"New", 6475550801, u"New"),
+                                                     WriteAuthRules.WRITE_IF_PHONE_UNIQUE))
+
+        results = ShardedRecordWriter.add_records([clash, DatabaseRecord(u"Shard Gina", 6475550807, u"7 Shard Street"),
+                                                   DatabaseRecord(u"Shard Gina", 4165550808, u"8 Shard Street")],
+                                                  auth_rule=WriteAuthRules.WRITE_IF_NAME_UNIQUE)
+        self.assertEqual([(result.accepted, result.rejected) for result in results], [(1, 2)])
+        self.assertEqual(len(ShardedRecordReader.get_records(DatabaseRecord(u"Shard Gina"))), 1)
+
+    def test_concurrent_adds_keep_rule(self):
+        threads = [threading.Thread(target=ShardedRecordWriter.add_record,
+                                    args=(DatabaseRecord(u"Shard Race", 6475550900 + index, u"Race Road"),
+                                          WriteAuthRules.WRITE_IF_NAME_UNIQUE))
+                   for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(ShardedRecordReader.get_records(DatabaseRecord(u"Shard Race"))), 1)
+
+    def test_rules_move_changed_phones(self):
+        new_phone = 4165550890
+        self.assertNotEqual(shard_of_phone(new_phone, 3), shard_of_phone(RECORDS[0][1], 3))
+        counts = ShardedRecordWriter.apply_rules([MutationRule(DatabaseRecord(u"Shard Alice"),
+                                                               DatabaseRecord(phone=new_phone), RecordMatch.EXACT),
+                                                  MutationRule(DatabaseRecord(u"Shard Bob"), None, RecordMatch.EXACT)])
+        self.assertEqual(counts, [1, 1])
+        self.assertIn((u"Shard Alice", new_phone, u"1 Shard Street"),
+                      self.shard_records()[shard_of_phone(new_phone, 3)])
+        self.assertEqual(sum(len(records) for records in self.shard_records()), len(RECORDS) - 1)
+        self.assertEqual(ShardedRecordWriter.delete_record(DatabaseRecord(u"Shard "), RecordMatch.PREFIX).rowcount,
+                         len(RECORDS) - 1)
+
+    def test_rules_checked_in_every_shard_first(self):
+        self.assertGreater(len(set(shard_of_phone(record[1], 3) for record in RECORDS)), 1)
+        rule = MutationRule(DatabaseRecord(address=u"Shard Street"), DatabaseRecord(address=u"Z Shard Street"),
+                            RecordMatch.SUBSTRING)
+        # every record gets the same address, which some shard rejects, so no shard may write it
+        self.assertEqual(ShardedRecordWriter.apply_rules([rule], auth_rule=WriteAuthRules.WRITE_IF_ADDRESS_UNIQUE),
+                         [None])
+        self.assertEqual(ShardedRecordReader.get_records(DatabaseRecord(address=u"Z Shard Street")), [])
+        self.assertEqual(ShardedRecordWriter.apply_rules([rule], auth_rule=WriteAuthRules.WRITE_IF_PHONE_UNIQUE),
+                         [len(RECORDS)])
+        self.assertEqual(ShardedRecordWriter.delete_record(DatabaseRecord(u"Shard "), RecordMatch.PREFIX).rowcount,
+                         len(RECORDS))
+
+    def test_rules_checked_across_shards(self):
+        phones = [6475550870 + offset for offset in range(10)]
+        first = phones[0]
+        second = [phone for phone in phones if shard_of_phone(phone, 3) != shard_of_phone(first, 3)][0]
+        ShardedRecordWriter.add_records([DatabaseRecord(u"Shard Gail", first, u"1 Shard Avenue"),
+                                         DatabaseRecord(u"Shard Hank", second, u"2 Shard Avenue")])
+        auth_rule = WriteAuthRules.WRITE_IF_NAME_UNIQUE
+        rules = [
+            # one record in each of two shards would get the same name
+            MutationRule(DatabaseRecord(address=u"Shard Avenue"), DatabaseRecord(u"Shard Same"), RecordMatch.SUBSTRING),
+            # name of a record of another shard
+            MutationRule(DatabaseRecord(phone=first), DatabaseRecord(u"Shard Bob"), RecordMatch.EXACT),
+            MutationRule(DatabaseRecord(u"Shard Alice"), DatabaseRecord(u"Shard Alicia"), RecordMatch.EXACT),
+        ]
+        self.assertEqual(ShardedRecordWriter.apply_rules(rules, dry_run=True, auth_rule=auth_rule), [None, None, 1])
+        self.assertEqual(ShardedRecordWriter.apply_rules(rules, auth_rule=auth_rule), [None, None, 1])
+        self.assertEqual(ShardedRecordReader.get_records(DatabaseRecord(u"Shard Same")), [])
+        self.assertEqual(len(ShardedRecordReader.get_records(DatabaseRecord(u"Shard Bob"), RecordMatch.EXACT)), 1)
+        self.assertEqual(len(ShardedRecordReader.get_records(DatabaseRecord(u"Shard Alicia"), RecordMatch.EXACT)), 1)
+        self.assertEqual(ShardedRecordWriter.delete_record(DatabaseRecord(u"Shard "), RecordMatch.PREFIX).rowcount,
+                         len(RECORDS) + 2)
+
+    def test_rebalance(self):
+        self.assertEqual(rebalance_shards(2, batch_size=4, save=False), len(RECORDS))
+        self.assertEqual(AppConfig.shard_count, 2)
+        self.assertFalse(any(os.path.exists(path) for path in shard_paths(3)))
+        for index, records in enumerate(self.shard_records(2)):
+            self.assertEqual(records, set(record for record in RECORDS if shard_of_phone(record[1], 2) == index))
+        self.assertEqual(rebalance_shards(2, save=False), 0)
+        AppConfig.change_shard_settings(shard_layout='test_shard_{shard}', quiet=True, save=False)
+        self.assertRaises(ValueError, rebalance_shards, 3, save=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
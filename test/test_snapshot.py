@@ -0,0 +1,88 @@
+import os
+import struct
+import unittest
+
+from lib.api.record_handler import DatabaseRecordWriter, DatabaseRecordReader, DatabaseRecord, RecordMatch
+from lib.api.snapshot import RecordSnapshot
+from lib.api.serialize import SnapshotWriter, SnapshotReader, SNAPSHOT_VERSION
+
+# overwrite our defaults to use a test db + table
+DatabaseRecordWriter.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+DatabaseRecordReader.database_path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_database')
+
+
+class TestSnapshot(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DatabaseRecordWriter.create_records_database()
+        DatabaseRecordWriter.add_records([DatabaseRecord(u"Snapshot Zoey", 6475550199, u"9 Columnar Way"),
+                                          DatabaseRecord(u"Snapshot Zoe", 6475551199, u"19 Columnar Way"),
+                                          DatabaseRecord(u"Snap", 6475550550, u"Way")])
+        cls.snapshot = RecordSnapshot.load()
+
+    def test_snapshot_loads_all_records(self):
+        self.assertEqual(len(self.snapshot), len(DatabaseRecordReader.get_all_records()))
+        self.assertEqual([self.snapshot.record(row) for row in range(len(self.snapshot))],
+                         DatabaseRecordReader.get_all_records(order_by='id'))
+        self.assertIsInstance(self.snapshot.memory_usage(), int)
+
+    def test_snapshot_matches_reader(self):
+        queries = [DatabaseRecord(u"Snapshot Zo"), DatabaseRecord(u"hot Zoey"), DatabaseRecord(u"Snap"),
+                   DatabaseRecord(phone=6475550199), DatabaseRecord(phone="647555"), DatabaseRecord(phone="5550"),
+                   DatabaseRecord(u"Snapshot", "647", u"Columnar Way"), DatabaseRecord(address=u"Way"),
+                   DatabaseRecord(u"Snapshot Zoe", address=u"19 Columnar Way"), DatabaseRecord()]
+        for match in RecordMatch.ALL_MATCHES:
+            for query in queries:
+                self.assertEqual(sorted(self.snapshot.get_records(query, match)),
+                                 sorted(DatabaseRecordReader.get_records(query, match)),
+                                 repr((query.name, query.phone, query.address, match)))
+        self.assertRaises(ValueError, self.snapshot.get_records, DatabaseRecord(), 0)
+
+    def test_snapshot_from_records(self):
+        snapshot = RecordSnapshot.from_records([(u"A", 6475550000, u"1 St"), (None, u"n/a", u""), (u"", 1, None),
+                                                (u"Zo\xeb", 6475550001, u"\xc9cole St")])
+        self.assertEqual(snapshot.record(1), (None, u"n/a", u""))
+        self.assertEqual(snapshot.get_records(DatabaseRecord(phone="n/a")), [(None, u"n/a", u"")])
+        self.assertEqual(snapshot.get_records(DatabaseRecord(u"A"), RecordMatch.EXACT), [(u"A", 6475550000, u"1 St")])
+        self.assertEqual(snapshot.get_records(DatabaseRecord(address=u"St")),
+                         [(u"A", 6475550000, u"1 St"), (u"Zo\xeb", 6475550001, u"\xc9cole St")])
+        self.assertEqual(snapshot.get_records(DatabaseRecord(u"o\xeb")), [(u"Zo\xeb", 6475550001, u"\xc9cole St")])
+        self.assertEqual(snapshot.get_records(DatabaseRecord(phone="1"), RecordMatch.EXACT), [(u"", 1, None)])
+
+
+class TestSnapshotFile(unittest.TestCase):
+    records = [(u"Zo\xeb", 6475550001, u"\xc9cole St"), (u"A", 6475550000, u"1 St"), (None, None, None),
+               (u"B", 4165550000, u"2 St"), (u"C", 6475550001, u"")]
+
+    def setUp(self):
+        self.path = os.path.join(os.path.dirname(DatabaseRecordWriter.database_path), 'test_snapshot.pbsnap')
+        self.assertEqual(SnapshotWriter.write(self.records, self.path), len(self.records))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_snapshot_file_records(self):
+        with SnapshotReader(self.path) as snapshot:
+            self.assertEqual(len(snapshot), len(self.records))
+            self.assertEqual(snapshot.record(0), self.records[0])
+            self.assertEqual(snapshot.record(2), (u"", None, u""))
+            self.assertEqual(list(SnapshotReader.read(self.path)), list(snapshot.iter_records()))
+
+    def test_snapshot_file_phone_lookups(self):
+        with SnapshotReader(self.path) as snapshot:
+            self.assertEqual(sorted(snapshot.find_phone("(647) 555-0001")),
+                             [(u"C", 6475550001, u""), (u"Zo\xeb", 6475550001, u"\xc9cole St")])
+            self.assertEqual(snapshot.find_phone(6475550002), [])
+            self.assertEqual([record[1] for record in snapshot.find_phone_prefix("647")],
+                             [6475550000, 6475550001, 6475550001])
+            self.assertEqual(snapshot.find_phone_prefix(416), [(u"B", 4165550000, u"2 St")])
+            self.assertRaises(ValueError, snapshot.find_phone_prefix, "64a")
+
+    def test_snapshot_file_rejects_other_files(self):
+        with open(self.path, 'r+b') as snapshot_file:
+            snapshot_file.seek(8)
+            snapshot_file.write(struct.pack("<H", SNAPSHOT_VERSION + 1))
+        self.assertRaises(ValueError, SnapshotReader, self.path)
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b"Name,Phone,Address\r\n" * 10)
+        self.assertRaises(ValueError, SnapshotReader, self.path)
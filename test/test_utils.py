@@ -0,0 +1,39 @@
+import unittest
+
+from lib import utils
+from lib.utils import phone_number_to_integer_stream, integer_stream_to_phone_number, \
+    phone_numbers_to_integer_streams, integer_streams_to_phone_numbers
+
+
+class TestUtils(unittest.TestCase):
+    def test_phone_number_to_integer_stream(self):
+        for phone in ["(647) 444-1552", "647.444.1552", "+1 647 444 1552", "1-647-444-1552", u"647/444/1552",
+                      "647-444-1552 x12", "(647) 444-1552 ext. 9", "6474441552 #3", 6474441552]:
+            self.assertEqual(phone_number_to_integer_stream(phone), 6474441552)
+        self.assertEqual(phone_number_to_integer_stream("647"), 647)
+        for phone in ["", "647 CALL NOW", "+44 20 7946 0958", "264744415521", None]:
+            with self.assertRaises(ValueError):
+                phone_number_to_integer_stream(phone)
+
+    def test_integer_stream_to_phone_number(self):
+        self.assertEqual(integer_stream_to_phone_number(6474441552), "(647) 444-1552")
+        self.assertEqual(integer_stream_to_phone_number("6470001552"), "(647) 000-1552")
+        with self.assertRaises(ValueError):
+            integer_stream_to_phone_number(647444155)
+
+    def test_batch_phone_functions(self):
+        phones = [6474441552, "6470001552", 9059998888]
+        self.assertEqual(integer_streams_to_phone_numbers(phones),
+                         [integer_stream_to_phone_number(phone) for phone in phones])
+        self.assertEqual(integer_streams_to_phone_numbers([]), [])
+        with self.assertRaises(ValueError):
+            integer_streams_to_phone_numbers([6474441552, 64744415])
+        self.assertEqual(phone_numbers_to_integer_streams(["(647) 444-1552", "+1 905.999.8888"]),
+                         [6474441552, 9059998888])
+
+    @unittest.skipIf(utils.load_numpy() is None, "NumPy is not installed")
+    def test_batch_phone_functions_numpy(self):
+        phones = utils.load_numpy().array([6474441552, 9059998888])
+        self.assertEqual(integer_streams_to_phone_numbers(phones), ["(647) 444-1552", "(905) 999-8888"])
+        with self.assertRaises(ValueError):
+            integer_streams_to_phone_numbers([647444155], use_numpy=True)